@@ -17,10 +17,10 @@ corrections are applied include:
 * E. Vlieg, J. Appl. Cryst. (1997). 30, 532-543
 * C. Schlepuetz et al, Acta Cryst. (2005). A61, 418-425
 
+See ctr_merge for merging symmetry equivalent points.
+
 Todo:
 -----
-* Averaging/merging and merge statistics
-* Integrations/Corrections for rocking scans
 * Add normalized F plots  - divide by |Fctr|
   (need to pass delta_H, delta_K for non-rational surfaces)
 * Lots of optimization to speed up...  
@@ -29,6 +29,7 @@ Todo:
 ##############################################################################
 
 import types, copy
+import multiprocessing
 import numpy as num
 from   matplotlib import pyplot
 import time
@@ -38,11 +39,37 @@ from tdl.modules.utils.mathutil import cosd, sind, tand
 from tdl.modules.utils.mathutil import arccosd, arcsind, arctand
 
 from tdl.modules.ana import image_data
-from tdl.modules.geom.active_area import active_area
+from tdl.modules.peak.peak import voigt
+from tdl.modules.geom.active_area import active_area, active_area_array
+from tdl.modules.geom import polygon
 from tdl.modules.geom import gonio_psic 
 
 DEBUG = False
 
+##############################################################################
+# Column layout of the CtrData point store.  The slit, scale and
+# sample diameter entries are typed copies of the per point corr_params
+# (nan if not defined), the full corr_params dictionaries are kept
+# in the CtrData.corr_params list.  int_hash and corr_hash are the
+# hashes of the integration and correction parameters used to compute
+# the current point values (see CtrData.update)
+CTR_COLUMNS = ['H','K','L','I','Inorm','Ierr','Ibgr','ctot','F','Ferr']
+CTR_DTYPE = num.dtype([('H',float),('K',float),('L',float),
+                       ('I',float),('Inorm',float),('Ierr',float),
+                       ('Ibgr',float),('ctot',float),('F',float),
+                       ('Ferr',float),
+                       ('scan_index',int,(2,)),('scan_type','S16'),
+                       ('geom','S16'),('scale',float),
+                       ('beam_horz',float),('beam_vert',float),
+                       ('det_horz',float),('det_vert',float),
+                       ('sample_dia',float),
+                       ('int_hash','i8'),('corr_hash','i8')])
+CTR_MIN_CAPACITY = 256
+# decimals used to round H and K for grouping points into rods
+ROD_DECIMALS = 3
+# default rocking scan integration parameters (see rocking_scan_F)
+ROCK_PARAMS = {'axis':None,'method':'sum','nbgr':3,'flor':0.0}
+
 ##############################################################################
 def ctr_data(scans,ctr=None,I=None,Inorm=None,Ierr=None,Ibgr=None,
              corr_params=None,scan_type=None):
@@ -88,10 +115,36 @@ class CtrData:
     * ctot  = array of total correction factors
     * F     = array of structure factor magnitudes
     * Ferr  = array of structure factor error bars
+    * hklist = sorted list of the (rounded) HK pairs of the rods
+    * data  = structured array (dtype CTR_DTYPE) holding all the
+      point data. The H..Ferr, scan_index and scan_type attributes
+      are views of its columns.  Note that indexing it with a mask
+      or sorting it returns a copy that is detached from the ctr
+      (and from scan, labels and corr_params), so select or order
+      points with index arrays instead, e.g. idx = ctr.rod_idx(1,0)
+      or idx = num.argsort(ctr.L), then use ctr.F[idx] etc.
+
+    Notes:
+    ------
+    The point data are held in a preallocated store that grows
+    by doubling, the attribute views are updated after each append.
+    Therefore modify the arrays in place (e.g. ctr.F[idx] = x)
+    rather than re-binding the attributes.
+
+    The data array is built on access and its typed corr_params
+    columns (geom, scale, beam_horz etc.) are refreshed from the
+    corr_params dictionaries each time, so they reflect any direct
+    edits of those dictionaries.
+
+    The points are indexed by rod, ie by (H,K) rounded to ROD_DECIMALS,
+    see rod_idx.  The index is updated on append/integrate_point and
+    the L sorted order is cached for each rod.  Use set_bad to flag
+    bad points.
     """
     ##########################################################################
     def __init__(self,scans=[],I='I',Inorm='io',Ierr='Ierr',
-                 Ibgr='Ibgr',corr_params={},scan_type='image'):
+                 Ibgr='Ibgr',corr_params={},scan_type='image',
+                 rock_params=None,nproc=1):
         """
         Initialize the object.
 
@@ -141,7 +194,16 @@ class CtrData:
 
           See the Correction class for more info...
 
-        * scan_type = Type of scans (e.g. 'image', 'phi', etc..)
+        * scan_type = Type of scans (e.g. 'image', 'phi', etc..).
+          For all types other than 'image' the scans are taken as
+          rocking scans, each scan gives one structure factor
+          (see rocking_scan_F).  The scan_type is used as the label
+          of the rocking axis if rock_params['axis'] is not given.
+
+        * rock_params = dictionary of rocking scan integration
+          parameters (see ROCK_PARAMS and rocking_scan_F)
+
+        * nproc = number of processes used to integrate rocking scans
         
         """
         self.fig    = None
@@ -149,26 +211,20 @@ class CtrData:
         self.hklist = None
         self.bad    = []
         self.scan   = []
-        self.scan_index  = []
         #
         self.labels      = {'I':[],'Inorm':[],'Ierr':[],'Ibgr':[]}
         self.corr_params = []
-        self.scan_type   = []
+        self.rock_params = {}
         #
-        self.H     = num.array([],dtype=float)
-        self.K     = num.array([],dtype=float)
-        self.L     = num.array([],dtype=float)
-        self.I     = num.array([],dtype=float)
-        self.Inorm = num.array([],dtype=float)
-        self.Ierr  = num.array([],dtype=float)
-        self.Ibgr  = num.array([],dtype=float)
-        self.ctot  = num.array([],dtype=float)
-        self.F     = num.array([],dtype=float)
-        self.Ferr  = num.array([],dtype=float)
+        self._store = num.zeros(0,dtype=CTR_DTYPE)
+        self._npts  = 0
+        self._set_views()
+        self._init_rod_index()
         #
         self.append_scans(scans,I=I,Inorm=Inorm,Ierr=Ierr,Ibgr=Ibgr,
                           corr_params=corr_params,
-                          scan_type=scan_type)
+                          scan_type=scan_type,rock_params=rock_params,
+                          nproc=nproc)
 
     ##########################################################################
     def __repr__(self,):
@@ -190,9 +246,211 @@ class CtrData:
         except:
             self.cursor = None
 
+    def __getstate__(self,):
+        """
+        pickle the point store (trimmed), not the column views
+        """
+        state = self.__dict__.copy()
+        for key in CTR_COLUMNS + ['data','scan_index','scan_type',
+                                  '_rods','_rod_keys','_rod_cache']:
+            state.pop(key,None)
+        state['_store'] = self._store[:self._npts].copy()
+        state['cursor'] = None
+        return state
+
+    def __setstate__(self,state):
+        """
+        restore from pickle, converts instances pickled before
+        the point store was added
+        """
+        self.__dict__.update(state)
+        if 'rock_params' not in state:
+            self.rock_params = {}
+        if '_store' in state and state['_store'].dtype != CTR_DTYPE:
+            # store from before fields were added
+            old = state['_store']
+            self._store = num.zeros(len(old),dtype=CTR_DTYPE)
+            for key in old.dtype.names:
+                if key in CTR_DTYPE.names:
+                    self._store[key] = old[key]
+        if '_store' not in state:
+            npts = len(state['L'])
+            self._store = num.zeros(npts,dtype=CTR_DTYPE)
+            for key in CTR_COLUMNS:
+                self._store[key] = state[key]
+            if npts > 0:
+                self._store['scan_index'] = num.array(state['scan_index'])
+                self._store['scan_type']  = state['scan_type']
+                self._set_corr_columns(range(npts))
+            self._npts = npts
+        self._set_views()
+        self._init_rod_index()
+        self._index_rods(range(self._npts))
+
+    def __getattr__(self,name):
+        """
+        build ctr.data on access, with the typed corr_params
+        columns resynced from the corr_params dictionaries
+        """
+        if name == 'data':
+            n = self._npts
+            self._set_corr_columns(range(n))
+            return self._store[:n]
+        raise AttributeError, name
+
+    ##########################################################################
+    def _set_views(self,):
+        """
+        bind the column attributes to the point store
+        """
+        n = self._npts
+        for key in CTR_COLUMNS:
+            setattr(self,key,self._store[key][:n])
+        self.scan_index = self._store['scan_index'][:n]
+        self.scan_type  = self._store['scan_type'][:n]
+
+    def _grow(self,nnew):
+        """
+        make room for nnew points (amortized doubling)
+        """
+        need = self._npts + nnew
+        if need > len(self._store):
+            cap = max(need,2*len(self._store),CTR_MIN_CAPACITY)
+            store = num.zeros(cap,dtype=CTR_DTYPE)
+            store[:self._npts] = self._store[:self._npts]
+            self._store = store
+
+    ##########################################################################
+    def _init_rod_index(self,):
+        """
+        rods: (H,K) -> list of point indicies
+        rod_keys: point index -> (H,K)
+        rod_cache: (H,K) -> cached index arrays for the rod
+        """
+        self._rods      = {}
+        self._rod_keys  = {}
+        self._rod_cache = {}
+        self._bad_ver   = 0
+        self.hklist     = []
+
+    def _index_rods(self,idx):
+        """
+        (re)index points in idx, call when H, K or L of the points change
+        """
+        idx = num.asarray(idx,dtype=int)
+        if len(idx) == 0: return
+        Hr = num.around(self.H[idx],decimals=ROD_DECIMALS)
+        Kr = num.around(self.K[idx],decimals=ROD_DECIMALS)
+        for (j,h,k) in zip(idx,Hr,Kr):
+            j   = int(j)
+            key = (float(h),float(k))
+            old = self._rod_keys.get(j)
+            self._rod_cache.pop(key,None)
+            if old == key: continue
+            if old != None:
+                self._rods[old].remove(j)
+                self._rod_cache.pop(old,None)
+                if len(self._rods[old]) == 0: del self._rods[old]
+            if key in self._rods:
+                self._rods[key].append(j)
+            else:
+                self._rods[key] = [j]
+            self._rod_keys[j] = key
+        self.hklist = sorted(self._rods.keys())
+
+    def rod_idx(self,H,K,sort=True,exclude_bad=False):
+        """
+        Get the point indicies of a rod
+
+        Parameters:
+        -----------
+        * H and K are the (rounded, see ROD_DECIMALS) rod indicies
+        * sort is a flag to return the points sorted by L,
+          otherwise they are in increasing point order
+        * exclude_bad is a flag to exclude the bad points
+
+        Outputs:
+        --------
+        * array of point index values
+
+        Example:
+        --------
+        >>idx = ctr.rod_idx(1,0)
+        >>plot(ctr.L[idx],ctr.F[idx])
+        """
+        key = (float(H),float(K))
+        if key not in self._rods:
+            return num.array([],dtype=int)
+        c = self._rod_cache.get(key)
+        if c == None:
+            pts = num.array(sorted(self._rods[key]),dtype=int)
+            c = {'idx':pts,'Lsort':pts[num.argsort(self.L[pts])]}
+            self._rod_cache[key] = c
+        if sort:
+            idx = c['Lsort']
+        else:
+            idx = c['idx']
+        if exclude_bad:
+            bkey = ('good',sort)
+            if c.get(bkey) == None or c[bkey][0] != (self._bad_ver,len(self.bad)):
+                good = idx[~num.in1d(idx,num.array(self.bad,dtype=int))]
+                c[bkey] = ((self._bad_ver,len(self.bad)),good)
+            idx = c[bkey][1]
+        return idx
+
+    def set_bad(self,idx,bad=True):
+        """
+        Flag point(s) as bad (bad=True) or good (bad=False)
+        """
+        if type(idx) not in (types.ListType,types.TupleType,num.ndarray):
+            idx = [idx]
+        for j in idx:
+            j = int(j)
+            if bad == True:
+                if j not in self.bad:
+                    self.bad.append(j)
+            elif j in self.bad:
+                self.bad.remove(j)
+        self._bad_ver = self._bad_ver + 1
+
+    ##########################################################################
+    def _set_corr_columns(self,idx):
+        """
+        update the typed corr_params columns for points in idx
+        (call after changing corr_params)
+        """
+        # points often share the same corr_params dictionary
+        groups = {}
+        for j in idx:
+            key = id(self.corr_params[j])
+            if key in groups:
+                groups[key].append(j)
+            else:
+                groups[key] = [j]
+        for pts in groups.values():
+            pts = num.array(pts,dtype=int)
+            cp  = self.corr_params[pts[0]]
+            if cp == None: cp = {}
+            self._store['geom'][pts]  = cp.get('geom','') or ''
+            self._store['scale'][pts] = _float_or_nan(cp.get('scale'))
+            beam = cp.get('beam_slits')
+            if type(beam) != types.DictType: beam = {}
+            self._store['beam_horz'][pts] = _float_or_nan(beam.get('horz'))
+            self._store['beam_vert'][pts] = _float_or_nan(beam.get('vert'))
+            det = cp.get('det_slits')
+            if type(det) != types.DictType: det = {}
+            self._store['det_horz'][pts] = _float_or_nan(det.get('horz'))
+            self._store['det_vert'][pts] = _float_or_nan(det.get('vert'))
+            sample = _sample_descr(cp.get('sample'))
+            if type(sample) in (types.FloatType,types.IntType):
+                self._store['sample_dia'][pts] = sample
+            else:
+                self._store['sample_dia'][pts] = num.nan
+
     ##########################################################################
     def append_scans(self,scans,I=None,Inorm=None,Ierr=None,Ibgr=None,
-                     corr_params=None,scan_type=None):
+                     corr_params=None,scan_type=None,rock_params=None,
+                     nproc=1):
         """
         Append new scan data
 
@@ -205,6 +463,9 @@ class CtrData:
 
         For any argument with None passed we use previous defined
         values - based on the last exisiting data point.  
+
+        Rocking scans (scan_type != 'image') are integrated with
+        nproc processes (see integrate_rocking_scans)
         """
         if type(scans) != types.ListType:
             scans = [scans]
@@ -217,44 +478,74 @@ class CtrData:
         if corr_params == None: corr_params = self.corr_params[-1]
         if scan_type == None:   scan_type = self.scan_type[-1]
 
+        # integrate rocking scans (in parallel)
+        if scan_type != 'image':
+            rock_params = _rock_params(rock_params,scan_type)
+            rock = integrate_rocking_scans(scans,I=I,Inorm=Inorm,Ierr=Ierr,
+                                           corr_params=corr_params,
+                                           rock_params=rock_params,
+                                           nproc=nproc)
+        else:
+            rock = [None]*len(scans)
+
         # get all the data parsed out of each scan and append
-        for scan in scans:
-            data = self._scan_data(scan,I,Inorm,Ierr,Ibgr,corr_params,scan_type)
+        for (scan,r) in zip(scans,rock):
+            data = self._scan_data(scan,I,Inorm,Ierr,Ibgr,corr_params,
+                                   scan_type,rock=r)
             if data == None: return
 
             #self.scan.append([])
             self.scan.append(scan)
-            #
-            self.scan_index.extend(data['scan_index'])
-            self.labels['I'].extend(data['I_lbl'])
-            self.labels['Inorm'].extend(data['Inorm_lbl'])
-            self.labels['Ierr'].extend(data['Ierr_lbl'])
-            self.labels['Ibgr'].extend(data['Ibgr_lbl'])
-            self.corr_params.extend(data['corr_params'])
-            self.scan_type.extend(data['scan_type'])
-            #
-            self.H     = num.append(self.H,data['H'])
-            self.K     = num.append(self.K,data['K'])
-            self.L     = num.append(self.L,data['L'])
-            self.I     = num.append(self.I,data['I'])
-            self.Inorm = num.append(self.Inorm,data['Inorm'])
-            self.Ierr  = num.append(self.Ierr,data['Ierr'])
-            self.Ibgr  = num.append(self.Ibgr,data['Ibgr'])
-            self.ctot  = num.append(self.ctot,data['ctot'])
-            self.F     = num.append(self.F,data['F'])
-            self.Ferr  = num.append(self.Ferr,data['Ferr'])
-        # make a list of stored hk's
-        self.hklist = find_HKs(self)
+            self._append_points(data)
+        self._set_views()
         
     ##########################################################################
-    def _scan_data(self,scan,I,Inorm,Ierr,Ibgr,corr_params,scan_type):
+    def _append_points(self,data):
+        """
+        Append point data to the store.  data is a dictionary
+        in the format returned by _scan_data
+        """
+        self.labels['I'].extend(data['I_lbl'])
+        self.labels['Inorm'].extend(data['Inorm_lbl'])
+        self.labels['Ierr'].extend(data['Ierr_lbl'])
+        self.labels['Ibgr'].extend(data['Ibgr_lbl'])
+        self.corr_params.extend(data['corr_params'])
+        #
+        nnew = len(data['L'])
+        if nnew == 0: return
+        self._grow(nnew)
+        (j0,j1) = (self._npts,self._npts+nnew)
+        for (j,rp) in enumerate(data.get('rock_params',[])):
+            if rp != None: self.rock_params[j0+j] = rp
+        new = self._store[j0:j1]
+        for key in CTR_COLUMNS:
+            new[key] = data[key]
+        new['scan_index'] = num.array(data['scan_index'])
+        new['scan_type']  = data['scan_type']
+        self._npts = j1
+        self._set_corr_columns(range(j0,j1))
+        self._set_views()
+        # index the new points by rod (also updates self.hklist)
+        self._index_rods(range(j0,j1))
+        if 'int_hash' in data:
+            new['int_hash']  = data['int_hash']
+            new['corr_hash'] = data['corr_hash']
+        else:
+            self._set_hashes(range(j0,j1))
+
+    ##########################################################################
+    def _scan_data(self,scan,I,Inorm,Ierr,Ibgr,corr_params,scan_type,
+                   rock=None):
         """
         Parse scan into data...
+
+        For rocking scans rock is the result of rocking_scan_F
+        (computed if None)
         """
         data = {'scan_index':[],'I_lbl':[],'Inorm_lbl':[],
                 'Ierr_lbl':[],'Ibgr_lbl':[],'corr_params':[],'scan_type':[],
                 'H':[],'K':[],'L':[],'I':[],'Inorm':[],'Ierr':[],'Ibgr':[],
-                'ctot':[],'F':[],'Ferr':[]}
+                'ctot':[],'F':[],'Ferr':[],'rock_params':[]}
 
         # compute a scan index
         scan_idx = len(self.scan)
@@ -264,6 +555,7 @@ class CtrData:
             if scan.image._is_integrated == False:
                 scan.image.integrate()
             npts = int(scan.dims[0])
+            (H,K,L) = _scan_columns(scan,['H','K','L'],range(npts))
             for j in range(npts):
                 data['scan_index'].append((scan_idx,j))
                 data['I_lbl'].append(I)
@@ -273,9 +565,9 @@ class CtrData:
                 data['corr_params'].append(corr_params)
                 data['scan_type'].append(scan_type)
                 #
-                data['H'].append(scan['H'][j])
-                data['K'].append(scan['K'][j])
-                data['L'].append(scan['L'][j])
+                data['H'].append(H[j])
+                data['K'].append(K[j])
+                data['L'].append(L[j])
                 # get F
                 d = image_point_F(scan,j,I=I,Inorm=Inorm,
                                   Ierr=Ierr,Ibgr=Ibgr,
@@ -287,6 +579,23 @@ class CtrData:
                 data['ctot'].append(d['ctot'])
                 data['F'].append(d['F'])
                 data['Ferr'].append(d['Ferr'])
+                data['rock_params'].append(None)
+        # rocking scan -> one point per scan
+        else:
+            if rock == None:
+                rock = rocking_scan_F(scan,I=I,Inorm=Inorm,Ierr=Ierr,
+                                      corr_params=corr_params,
+                                      rock_params=_rock_params(None,scan_type))
+            data['scan_index'].append((scan_idx,rock['point']))
+            data['I_lbl'].append(I)
+            data['Inorm_lbl'].append(Inorm)
+            data['Ierr_lbl'].append(Ierr)
+            data['Ibgr_lbl'].append(Ibgr)
+            data['corr_params'].append(corr_params)
+            data['scan_type'].append(scan_type)
+            data['rock_params'].append(rock['rock_params'])
+            for key in ('H','K','L','I','Inorm','Ierr','Ibgr','ctot','F','Ferr'):
+                data[key].append(rock[key])
         return data
 
     ##########################################################################
@@ -313,6 +622,14 @@ class CtrData:
         * Ierr       = Intensity error label
         * Ibgr       = Intensity background label
         * corr_params = CTR correction parameters
+
+        If scan type is a rocking scan the following kw arguments
+        may be used (as well as bad, plot, fig, the labels and
+        corr_params listed above)
+
+        * rock_params = rocking scan integration parameters, or
+          the individual parameters (see ROCK_PARAMS):
+          axis, method, nbgr, flor
         
         """
         if DEBUG: tm = time.time()
@@ -320,12 +637,8 @@ class CtrData:
 
         bad = kw.get('bad')
         if bad != None:
-            if bad == True:
-                if idx not in self.bad:
-                    self.bad.append(idx)
-            elif bad == False:
-                if idx in self.bad:
-                    self.bad.remove(idx)
+            if bad == True or bad == False:
+                self.set_bad(idx,bad=bad)
             else:
                 print "Warning: bad should be True/False"
 
@@ -368,9 +681,11 @@ class CtrData:
             self.labels['Inorm'][idx] = Inorm
             self.labels['Ierr'][idx]  = Ierr
             self.corr_params[idx]     = corr_params
-            self.H[idx]               = scan['H'][point]
-            self.K[idx]               = scan['K'][point]
-            self.L[idx]               = scan['L'][point]
+            self._set_corr_columns([idx])
+            (H,K,L) = _scan_columns(scan,['H','K','L'],[point])[:,0]
+            self.H[idx]               = H
+            self.K[idx]               = K
+            self.L[idx]               = L
             self.I[idx]               = d['I']
             self.Inorm[idx]           = d['Inorm']
             self.Ierr[idx]            = d['Ierr']
@@ -378,16 +693,242 @@ class CtrData:
             self.ctot[idx]            = d['ctot']
             self.F[idx]               = d['F']
             self.Ferr[idx]            = d['Ferr']
+            self._index_rods([idx])
         # Rocking scan data
         else:
-            # note if rocking scans are implemented
-            # make sure to compute corrections using the
-            # correct angles, e.g. the angles from the
-            # center of the scan (or at the start)
-            print "No other scan types implemented"
+            # the corrections are computed using the angles
+            # at the peak center (see rocking_scan_F)
+            (scan_idx,point) = self.scan_index[idx]
+            scan = self.scan[scan_idx]
+            rp = kw.get('rock_params')
+            if rp == None:
+                rp = self.rock_params.get(idx)
+            rp = _rock_params(rp,self.scan_type[idx])
+            for key in ROCK_PARAMS.keys():
+                if key in kw: rp[key] = kw[key]
+            I           = kw.get('I',self.labels['I'][idx])
+            Inorm       = kw.get('Inorm',self.labels['Inorm'][idx])
+            Ierr        = kw.get('Ierr', self.labels['Ierr'][idx])
+            corr_params = kw.get('corr_params',self.corr_params[idx])
+            d = rocking_scan_F(scan,I=I,Inorm=Inorm,Ierr=Ierr,
+                               corr_params=corr_params,rock_params=rp,
+                               plot=kw.get('plot',False),fig=kw.get('fig'))
+            # store results
+            self.labels['I'][idx]     = I
+            self.labels['Inorm'][idx] = Inorm
+            self.labels['Ierr'][idx]  = Ierr
+            self.corr_params[idx]     = corr_params
+            self.rock_params[idx]     = d['rock_params']
+            self._set_corr_columns([idx])
+            self.scan_index[idx]      = (scan_idx,d['point'])
+            for key in CTR_COLUMNS:
+                getattr(self,key)[idx] = d[key]
+            self._index_rods([idx])
+        self._set_hashes([idx])
         if DEBUG: print "Integration time(s)=",time.time()-tm
         return 
 
+    ##########################################################################
+    def _int_params(self,idx):
+        """
+        the parameters the integration of point idx depends on
+        """
+        (scan_idx,point) = self.scan_index[idx]
+        par = [self.labels['I'][idx],self.labels['Inorm'][idx],
+               self.labels['Ierr'][idx],self.labels['Ibgr'][idx],
+               idx in self.bad]
+        if self.scan_type[idx] == 'image':
+            try:
+                image = self.scan[scan_idx].image
+                par.extend([image.rois[point],image.rotangle[point],
+                            image.bgrpar[point]])
+            except:
+                pass
+        else:
+            par.append(self.rock_params.get(idx))
+        return par
+
+    def _calc_hashes(self,idx):
+        """
+        hashes of the current integration and correction parameters
+        of the points in idx
+        """
+        idx = num.asarray(idx,dtype=int)
+        ih  = num.zeros(len(idx),dtype='i8')
+        ch  = num.zeros(len(idx),dtype='i8')
+        cph = {}
+        for (k,j) in enumerate(idx):
+            ih[k] = _param_hash(self._int_params(j))
+            cp = self.corr_params[j]
+            if id(cp) not in cph:
+                cph[id(cp)] = _param_hash(cp)
+            ch[k] = cph[id(cp)]
+        return (ih,ch)
+
+    def _set_hashes(self,idx,integration=True):
+        """
+        mark the points in idx as up to date.  If integration is
+        False only the correction hash is set
+        """
+        idx = num.asarray(idx,dtype=int)
+        if len(idx) == 0: return
+        (ih,ch) = self._calc_hashes(idx)
+        if integration:
+            self._store['int_hash'][idx] = ih
+        self._store['corr_hash'][idx] = ch
+
+    def dirty(self,idx=None):
+        """
+        Find the points whose parameters changed since they were
+        last computed
+
+        Parameters:
+        -----------
+        * idx is a list of point indicies (default is all points)
+
+        Outputs:
+        --------
+        * (int_idx,corr_idx) arrays of the points that need to be
+          re-integrated, and the points for which only the
+          correction factors need to be re-computed
+        """
+        if idx is None:
+            idx = range(len(self.L))
+        idx = num.asarray(idx,dtype=int)
+        (ih,ch) = self._calc_hashes(idx)
+        int_dirty  = ih != self._store['int_hash'][idx]
+        corr_dirty = (ch != self._store['corr_hash'][idx]) & ~int_dirty
+        return (idx[int_dirty],idx[corr_dirty])
+
+    def update(self,idx=None,verbose=False):
+        """
+        Re-compute the points whose parameters have changed, ie after
+        changing parameters with set_params (or directly).  Images are
+        only re-integrated for points whose integration parameters
+        (labels, roi, rotangle, background or bad flag) changed.  If only
+        the correction parameters changed just the correction factors
+        (and F, Ferr) are re-computed.
+
+        Parameters:
+        -----------
+        * idx is a list of point indicies (default is all points)
+        * verbose is a flag to print the number of updated points
+
+        Outputs:
+        --------
+        * (int_idx,corr_idx) the re-integrated points and the points
+          with only re-computed corrections (see dirty)
+
+        Example:
+        --------
+        >>for j in range(len(ctr.L)):
+        >>    set_params(ctr,j,corrpar={'det_slits':{'horz':2.,'vert':1.}})
+        >>ctr.update()
+        """
+        (int_idx,corr_idx) = self.dirty(idx)
+        # re-integrate images, grouped by scan
+        groups = {}
+        image_idx = []
+        for j in int_idx:
+            j = int(j)
+            if self.scan_type[j] == 'image':
+                scan_idx = self.scan_index[j][0]
+                if scan_idx not in groups: groups[scan_idx] = []
+                groups[scan_idx].append(j)
+                image_idx.append(j)
+            else:
+                self.integrate_point(j)
+        for scan_idx in groups.keys():
+            scan   = self.scan[scan_idx]
+            pidx   = groups[scan_idx]
+            points = [self.scan_index[j][1] for j in pidx]
+            bad    = [p for (j,p) in zip(pidx,points) if j in self.bad]
+            if scan.image._is_init() == False:
+                scan.image._init_image()
+            scan.image.integrate(idx=points,bad_points=bad)
+            # one column lookup per set of labels
+            lgroups = {}
+            for (j,p) in zip(pidx,points):
+                lbls = tuple([self.labels[k][j] for k in ('I','Inorm','Ierr','Ibgr')])
+                if lbls not in lgroups: lgroups[lbls] = ([],[])
+                lgroups[lbls][0].append(j)
+                lgroups[lbls][1].append(p)
+            for lbls in lgroups.keys():
+                (jj,pp) = lgroups[lbls]
+                (self.I[jj],self.Inorm[jj],self.Ierr[jj],self.Ibgr[jj]) = \
+                    _scan_columns(scan,list(lbls),pp)
+        # corrections (and F) for the re-integrated images and the
+        # points with changed correction params
+        cidx = image_idx + [int(j) for j in corr_idx]
+        if len(cidx) > 0:
+            self.update_corrections(cidx)
+        self._set_hashes(image_idx)
+        if verbose:
+            print "Re-integrated %i points, updated corrections of %i points" % \
+                  (len(int_idx),len(corr_idx))
+        return (int_idx,corr_idx)
+
+    ##########################################################################
+    def update_corrections(self,idx=None,corr_params=None):
+        """
+        Re-compute the correction factors (and F, Ferr) for a set
+        of points using the array correction engine, e.g. after
+        changing the slit settings or sample description.
+
+        Parameters:
+        -----------
+        * idx is a list of point indicies, if None all points are updated
+        * corr_params are new correction parameters applied to
+          each point in idx.  If None the existing parameters are used
+
+        Example:
+        --------
+        >>cp = {'geom':'psic','beam_slits':{'horz':.6,'vert':.8},
+                'det_slits':{'horz':20.,'vert':10.5},
+                'sample':{'dia':10.},'scale':1e6}
+        >>ctr.update_corrections(corr_params=cp)
+        """
+        if idx == None:
+            idx = range(len(self.L))
+        # group the points by scan, correction params and type
+        # (rocking scan points use the angles at the peak center)
+        groups = {}
+        for j in idx:
+            if corr_params != None:
+                self.corr_params[j] = corr_params
+            (scan_idx,point) = self.scan_index[j]
+            key = (scan_idx,id(self.corr_params[j]),
+                   self.scan_type[j] == 'image')
+            if key not in groups: groups[key] = []
+            groups[key].append(j)
+        for key in groups.keys():
+            (scan_idx,cpid,is_image) = key
+            pidx   = num.array(groups[key],dtype=int)
+            points = [self.scan_index[j][1] for j in pidx]
+            cp     = self.corr_params[pidx[0]]
+            scan   = self.scan[scan_idx]
+            if cp == None:
+                ctot  = num.ones(len(pidx))
+                scale = 1.
+            else:
+                scale = cp.get('scale')
+                if scale == None: scale = 1.
+                scale = float(scale)
+                corr  = _get_corr_array(scan,points,cp)
+                if corr == None:
+                    ctot = num.ones(len(pidx))
+                elif is_image:
+                    ctot = corr.ctot_stationary()
+                else:
+                    ctot = corr.ctot_rocking()
+            (F,Ferr) = calc_F(self.I[pidx],self.Inorm[pidx],self.Ierr[pidx],
+                              ctot,scale=scale)
+            self.ctot[pidx] = ctot
+            self.F[pidx]    = F
+            self.Ferr[pidx] = Ferr
+            self._set_corr_columns(pidx)
+            self._set_hashes(pidx,integration=False)
+
     ##########################################################################
     def hk_plot(self,H,K,fig=None,cursor=True,verbose=True,spnt=None):
         """
@@ -812,18 +1353,7 @@ def find_HKs(ctr,hkdecimal=3):
     """
     find all the unique HK pairs in the data set
     """
-    hkvals = []
-    npts = len(ctr.L)
-    H = num.around(ctr.H,decimals=hkdecimal)
-    K = num.around(ctr.K,decimals=hkdecimal)
-    s = []
-    for j in range(npts):
-        s = (H[j],K[j]) 
-        if s not in hkvals:
-            hkvals.append(s)
-    # sort the hkvals
-    hkvals.sort()
-    return hkvals
+    return sorted(_rod_groups(ctr,hkdecimal=hkdecimal).keys())
 
 ##########################################################################
 def HK_idx(ctr,H,K,hkdecimal=3):
@@ -838,14 +1368,34 @@ def HK_idx(ctr,H,K,hkdecimal=3):
     Lset = ctr.K[idx]
     Fset = ctr.F[idx]
     """
+    if hkdecimal == ROD_DECIMALS and hasattr(ctr,'rod_idx'):
+        return (ctr.rod_idx(H,K,sort=False),)
+    groups = _rod_groups(ctr,hkdecimal=hkdecimal)
+    idx = groups.get((float(H),float(K)),num.array([],dtype=int))
+    return (idx,)
+
+def _rod_groups(ctr,hkdecimal=3):
+    """
+    Return a dictionary of (H,K) -> point index arrays
+    (uses the rod index of the ctr object when possible)
+    """
+    if hkdecimal == ROD_DECIMALS and hasattr(ctr,'rod_idx'):
+        groups = {}
+        for key in ctr.hklist:
+            groups[key] = ctr.rod_idx(key[0],key[1],sort=False)
+        return groups
     Hrnd = num.around(ctr.H,decimals=hkdecimal)
     Krnd = num.around(ctr.K,decimals=hkdecimal)
-    idx1 = num.where(Hrnd==H)
-    if len(idx1) == 0:
-        return idx1
-    idx2 = num.where(Krnd[idx1]==K)
-    idx = (idx1[0][idx2],)
-    return idx
+    groups = {}
+    for j in range(len(Hrnd)):
+        key = (float(Hrnd[j]),float(Krnd[j]))
+        if key in groups:
+            groups[key].append(j)
+        else:
+            groups[key] = [j]
+    for key in groups.keys():
+        groups[key] = num.array(groups[key],dtype=int)
+    return groups
 
 ##########################################################################
 def sort_data(ctr,hkdecimal=3):
@@ -862,47 +1412,27 @@ def sort_data(ctr,hkdecimal=3):
       values to for sorting.  
 
     """
-    scan_idx = ctr.scan_index
-    npts = len(ctr.F)
-
-    #find all unique sets
-    hkvals = find_HKs(ctr,hkdecimal=hkdecimal)
-
-    # put data in correct set
-    nsets = len(hkvals)
-    hkset = []
-    for j in range(nsets):
-        hkset.append({'H':[],'K':[],'L':[],'F':[],'Ferr':[],
-                      'I':[],'Inorm':[],'Ierr':[],'Ibgr':[],
-                      'point_idx':[]})
-    for j in range(nsets):
-        s = hkvals[j]
-        idx = HK_idx(ctr,s[0],s[1],hkdecimal=hkdecimal)
-        hkset[j]['H']     = num.around(ctr.H[idx],decimals=hkdecimal)
-        hkset[j]['K']     = num.around(ctr.K[idx],decimals=hkdecimal)
-        hkset[j]['L']     = ctr.L[idx]
-        hkset[j]['F']     = ctr.F[idx]
-        hkset[j]['Ferr']  = ctr.Ferr[idx]
-        hkset[j]['I']     = ctr.I[idx]
-        hkset[j]['Inorm'] = ctr.Inorm[idx]
-        hkset[j]['Ierr']  = ctr.Ierr[idx]
-        hkset[j]['Ibgr']  = ctr.Ibgr[idx]
-        hkset[j]['point_idx'] = idx[0]
-
-    # now sort each set by L
-    for j in range(nsets):
-        lidx = num.argsort(hkset[j]['L'])
-        hkset[j]['H'] = hkset[j]['H'][lidx]
-        hkset[j]['K'] = hkset[j]['K'][lidx]
-        hkset[j]['L'] = hkset[j]['L'][lidx]
-        hkset[j]['F'] = hkset[j]['F'][lidx]
-        hkset[j]['Ferr'] = hkset[j]['Ferr'][lidx]
-        hkset[j]['I'] = hkset[j]['I'][lidx]
-        hkset[j]['Inorm'] = hkset[j]['Inorm'][lidx]
-        hkset[j]['Ierr'] = hkset[j]['Ierr'][lidx]
-        hkset[j]['Ibgr'] = hkset[j]['Ibgr'][lidx]
-        hkset[j]['point_idx'] = hkset[j]['point_idx'][lidx]
-
+    use_index = (hkdecimal == ROD_DECIMALS and hasattr(ctr,'rod_idx'))
+    groups = _rod_groups(ctr,hkdecimal=hkdecimal)
+    hkset  = []
+    for s in sorted(groups.keys()):
+        if use_index:
+            idx = ctr.rod_idx(s[0],s[1],sort=True)
+        else:
+            idx = groups[s]
+            idx = idx[num.argsort(ctr.L[idx])]
+        d = {}
+        d['H']     = num.around(ctr.H[idx],decimals=hkdecimal)
+        d['K']     = num.around(ctr.K[idx],decimals=hkdecimal)
+        d['L']     = ctr.L[idx]
+        d['F']     = ctr.F[idx]
+        d['Ferr']  = ctr.Ferr[idx]
+        d['I']     = ctr.I[idx]
+        d['Inorm'] = ctr.Inorm[idx]
+        d['Ierr']  = ctr.Ierr[idx]
+        d['Ibgr']  = ctr.Ibgr[idx]
+        d['point_idx'] = idx
+        hkset.append(d)
     return hkset
 
 ##############################################################################
@@ -913,10 +1443,8 @@ def image_point_F(scan,point,I='I',Inorm='io',Ierr='Ierr',Ibgr='Ibgr',
     """
     d = {'I':0.0,'Inorm':0.0,'Ierr':0.0,'Ibgr':0.0,'F':0.0,'Ferr':0.0,
          'ctot':1.0,'alpha':0.0,'beta':0.0}
-    d['I']     = scan[I][point]
-    d['Inorm'] = scan[Inorm][point]
-    d['Ierr']  = scan[Ierr][point]
-    d['Ibgr']  = scan[Ibgr][point]
+    (d['I'],d['Inorm'],d['Ierr'],d['Ibgr']) = \
+        _scan_columns(scan,[I,Inorm,Ierr,Ibgr],[point])[:,0]
     if corr_params == None:
         d['ctot'] = 1.0
         scale = 1.0
@@ -945,6 +1473,235 @@ def image_point_F(scan,point,I='I',Inorm='io',Ierr='Ierr',Ibgr='Ibgr',
     
     return d
 
+##############################################################################
+def rocking_scan_F(scan,I='I',Inorm='io',Ierr='Ierr',corr_params={},
+                   rock_params=None,plot=False,fig=None):
+    """
+    compute F from a rocking scan
+
+    Parameters:
+    -----------
+    * scan is a scan data object
+    * I, Inorm and Ierr are the labels of the intensity, normalization
+      and intensity error arrays (if Ierr is not found in the scan
+      sqrt(I) is used)
+    * corr_params are the correction parameters (see CtrData)
+    * rock_params is a dictionary of integration parameters
+      (missing values are taken from ROCK_PARAMS):
+      - 'axis' is the label of the rocking axis (default is
+        the scans primary axis)
+      - 'method' is 'sum' or 'fit'.  'sum' sums the background
+        subtracted intensities, using a linear background fit to
+        nbgr points at each end of the scan.  'fit' fits a
+        psuedo-voigt peak (see peak.voigt, flor is the fixed
+        lorentzian fraction) on a linear background and takes the
+        integrated intensity from the fitted peak area
+      - 'nbgr' number of end points used for the background
+        (nbgr = 0 -> no background for the 'sum' method)
+      - 'flor' lorentzian fraction of the peak shape
+    * plot is a flag to plot the integration
+
+    Outputs:
+    --------
+    * dictionary with the integrated values (I, Inorm, Ierr, Ibgr),
+      the total correction (ctot), F, Ferr, the H, K, L values
+      at the peak center, the scan point closest to the peak center
+      ('point'), the peak center ('cen') and the rock_params used
+
+    Notes:
+    ------
+    The intensities are normalized point by point and the
+    integrated intensity is given in units of (counts x axis units)
+    at the average normalization (returned as Inorm).  The corrections
+    (see ctot_rocking) are computed using the angles of the scan
+    point closest to the peak center.
+    """
+    rp = _rock_params(rock_params,None)
+    axis = rp['axis']
+    if axis == None:
+        axis = scan.primary_axis[0]
+    rp['axis'] = axis
+    x  = num.asarray(scan[axis],dtype=float)
+    y  = num.asarray(scan[I],dtype=float)
+    nrm = num.asarray(scan[Inorm],dtype=float)
+    if nrm.ndim == 0: nrm = nrm + num.zeros(len(y))
+    try:
+        yerr = num.asarray(scan[Ierr],dtype=float)
+    except:
+        yerr = num.sqrt(num.abs(y))
+    # normalize to the average normalization
+    order = num.argsort(x)
+    (x,y,yerr,nrm) = (x[order],y[order],yerr[order],nrm[order])
+    norm0 = num.mean(nrm)
+    yn  = y*norm0/nrm
+    en  = num.where(yerr > 0,yerr,1.)*norm0/nrm
+    dx  = num.abs(x[-1]-x[0])/max(len(x)-1,1)
+    #
+    if rp['method'] == 'fit':
+        d = _rock_fit(x,yn,en,dx,nbgr=rp['nbgr'],flor=rp['flor'])
+    else:
+        d = _rock_sum(x,yn,en,dx,nbgr=rp['nbgr'])
+    # scan point closest to the peak center
+    point = int(order[num.argmin(num.abs(x - d['cen']))])
+    d['point'] = point
+    d['Inorm'] = norm0
+    (d['H'],d['K'],d['L']) = _scan_columns(scan,['H','K','L'],[point])[:,0]
+    d['rock_params'] = rp
+    # corrections
+    if corr_params == None:
+        d['ctot'] = 1.0
+        scale = 1.0
+    else:
+        scale  = corr_params.get('scale')
+        if scale == None: scale = 1.
+        scale  = float(scale)
+        corr = _get_corr(scan,point,corr_params)
+        if corr == None:
+            d['ctot'] = 1.0
+        else:
+            d['ctot'] = corr.ctot_rocking()
+    (F,Ferr) = calc_F(d['I'],d['Inorm'],d['Ierr'],d['ctot'],scale=scale)
+    d['F']    = float(F)
+    d['Ferr'] = float(Ferr)
+    if plot:
+        if fig != None:
+            pyplot.figure(fig)
+        else:
+            pyplot.figure()
+        pyplot.clf()
+        pyplot.errorbar(x,yn,en,fmt='bo')
+        pyplot.plot(x,d['bgr'],'k-')
+        if 'yfit' in d:
+            pyplot.plot(x,d['yfit'],'r-')
+        pyplot.axvline(d['cen'],color='g')
+        pyplot.xlabel(str(axis))
+        pyplot.title("I = %g +/- %g" % (d['I'],d['Ierr']))
+    return d
+
+def _rock_params(rock_params,scan_type):
+    """
+    copy of the rocking scan parameters with missing values
+    from ROCK_PARAMS (scan_type is used as the default axis)
+    """
+    rp = copy.copy(ROCK_PARAMS)
+    if rock_params != None:
+        rp.update(rock_params)
+    if rp['axis'] == None and scan_type not in (None,'image'):
+        rp['axis'] = scan_type
+    return rp
+
+def _rock_bgr(x,y,e,nbgr):
+    """
+    weighted linear background fit to nbgr points at each end.
+    returns (coefs,cov) with coefs = [slope,offset]
+    """
+    npts = len(x)
+    if nbgr <= 0 or npts < 2*nbgr + 1:
+        return (num.zeros(2),num.zeros((2,2)))
+    idx = num.concatenate((num.arange(nbgr),num.arange(npts-nbgr,npts)))
+    A = num.array([x[idx],num.ones(len(idx))]).T
+    w = 1./e[idx]**2
+    cov = num.linalg.inv(num.dot(A.T*w,A))
+    coefs = num.dot(cov,num.dot(A.T*w,y[idx]))
+    return (coefs,cov)
+
+def _rock_sum(x,y,e,dx,nbgr=3):
+    """
+    background subtracted sum of a rocking scan
+    """
+    (coefs,cov) = _rock_bgr(x,y,e,nbgr)
+    bgr = coefs[0]*x + coefs[1]
+    net = y - bgr
+    d = {'bgr':bgr}
+    d['I']    = num.sum(net)*dx
+    d['Ibgr'] = num.sum(bgr)*dx
+    # error from the points and the background line
+    g = num.array([num.sum(x),len(x)])*dx
+    var = num.sum(e**2)*dx**2 + num.dot(g,num.dot(cov,g))
+    d['Ierr'] = num.sqrt(var)
+    # centroid of the net intensity
+    if num.sum(net) > 0:
+        d['cen'] = num.sum(x*net)/num.sum(net)
+    else:
+        d['cen'] = x[num.argmax(y)]
+    return d
+
+def _rock_fit(x,y,e,dx,nbgr=3,flor=0.0):
+    """
+    fit a psuedo-voigt peak on a linear background to a rocking scan
+    """
+    from scipy.optimize import leastsq
+    (coefs,cov) = _rock_bgr(x,y,e,max(nbgr,1))
+    bgr0 = coefs[0]*x + coefs[1]
+    jmax = num.argmax(y - bgr0)
+    mag  = (y - bgr0)[jmax]
+    half = num.where((y - bgr0) >= 0.5*mag)[0]
+    fwhm = max(num.abs(x[half[-1]] - x[half[0]]),dx)
+    p0 = [x[jmax],fwhm,mag,coefs[0],coefs[1]]
+    def _model(p):
+        return voigt(x,p[0],p[1],p[2],flor) + p[3]*x + p[4]
+    def _resid(p):
+        return (y - _model(p))/e
+    (p,pcov,info,msg,ier) = leastsq(_resid,p0,full_output=1)
+    # area of the psuedo-voigt peak (gauss + lorentz areas).
+    # the model is even in the width so the fit may return it
+    # with either sign
+    c = flor*num.pi/2. + (1.-flor)*1.0644670
+    fwhm = abs(p[1])
+    area = c*fwhm*p[2]
+    d = {'cen':p[0],'fwhm':fwhm,'bgr':p[3]*x + p[4],'yfit':_model(p)}
+    d['I']    = area
+    d['Ibgr'] = num.sum(d['bgr'])*dx
+    if pcov is not None:
+        g = num.array([0.,c*p[2]*num.sign(p[1]),c*fwhm,0.,0.])
+        d['Ierr'] = num.sqrt(abs(num.dot(g,num.dot(pcov,g))))
+    else:
+        d['Ierr'] = abs(area)
+    if ier not in (1,2,3,4) or not (x[0] <= p[0] <= x[-1]):
+        print "Warning: rocking scan fit may have failed", msg
+    return d
+
+##############################################################################
+def integrate_rocking_scans(scans,I='I',Inorm='io',Ierr='Ierr',
+                            corr_params={},rock_params=None,nproc=1):
+    """
+    Integrate a list of rocking scans (see rocking_scan_F)
+
+    Parameters:
+    -----------
+    * scans is a list of scan data objects
+    * nproc is the number of processes to use (None uses all cpus)
+    * see rocking_scan_F for the other arguments
+
+    Outputs:
+    --------
+    * list of the rocking_scan_F results (one for each scan)
+    """
+    if type(scans) != types.ListType:
+        scans = [scans]
+    if len(scans) == 0: return []
+    if (nproc == None) or (nproc < 1):
+        nproc = multiprocessing.cpu_count()
+    nproc = min(nproc,len(scans))
+    tasks = [(scan,I,Inorm,Ierr,corr_params,rock_params) for scan in scans]
+    if nproc <= 1:
+        return map(_rock_task,tasks)
+    pool = multiprocessing.Pool(nproc)
+    try:
+        results = pool.map(_rock_task,tasks)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def _rock_task(args):
+    """
+    worker function for integrate_rocking_scans
+    """
+    (scan,I,Inorm,Ierr,corr_params,rock_params) = args
+    return rocking_scan_F(scan,I=I,Inorm=Inorm,Ierr=Ierr,
+                          corr_params=corr_params,rock_params=rock_params)
+
 ##############################################################################
 def _get_corr(scan,point,corr_params):
     """
@@ -955,6 +1712,7 @@ def _get_corr(scan,point,corr_params):
     det    = corr_params.get('det_slits')
     sample = corr_params.get('sample')
     # get gonio instance for corrections
+    # (psic_from_spec caches the orientation calc for each unique G)
     if geom == 'psic':
         gonio = gonio_psic.psic_from_spec(scan['G'])
         _update_psic_angles(gonio,scan,point)
@@ -965,6 +1723,71 @@ def _get_corr(scan,point,corr_params):
         corr = None
     return corr
 
+##############################################################################
+def _param_hash(x):
+    """
+    hash of a (nested) parameter structure (dicts, lists, arrays...)
+    """
+    return hash(repr(_hashable(x)))
+
+def _hashable(x):
+    if type(x) == types.DictType:
+        return tuple(sorted([(k,_hashable(v)) for (k,v) in x.items()]))
+    elif type(x) in (types.ListType,types.TupleType):
+        return tuple([_hashable(v) for v in x])
+    elif isinstance(x,num.ndarray):
+        return _hashable(x.tolist())
+    elif isinstance(x,num.generic):
+        return x.item()
+    return x
+
+##############################################################################
+def _float_or_nan(x):
+    try:
+        return float(x)
+    except:
+        return num.nan
+
+##############################################################################
+def calc_F(I,Inorm,Ierr,ctot,scale=1.):
+    """
+    compute F and Ferr from arrays of intensities, normalization,
+    errors and correction factors (see image_point_F)
+    """
+    I     = num.asarray(I,dtype=float)
+    Inorm = num.asarray(Inorm,dtype=float)
+    Ierr  = num.asarray(Ierr,dtype=float)
+    ctot  = num.asarray(ctot,dtype=float)
+    ok    = (I > 0.) & (Inorm > 0.)
+    I_    = num.where(ok,I,1.)
+    In_   = num.where(ok,Inorm,1.)
+    yn     = scale*I_/In_
+    yn_err = yn * num.sqrt( (Ierr/I_)**2. + 1./In_ )
+    with num.errstate(invalid='ignore'):
+        F    = num.where(ok,num.sqrt(ctot*yn),0.)
+        Ferr = num.where(ok,num.sqrt(ctot*yn_err),0.)
+    return (F,Ferr)
+
+##############################################################################
+def _get_corr_array(scan,points,corr_params):
+    """
+    get CtrCorrectionPsicArray instance for a list of scan points
+    """
+    geom   = corr_params.get('geom','psic')
+    beam   = corr_params.get('beam_slits',{})
+    det    = corr_params.get('det_slits')
+    sample = corr_params.get('sample')
+    if geom == 'psic':
+        gonio  = gonio_psic.psic_from_spec(scan['G'])
+        angles = _psic_angle_arrays(scan,points)
+        corr   = CtrCorrectionPsicArray(gonio=gonio,angles=angles,
+                                        beam_slits=beam,det_slits=det,
+                                        sample=sample)
+    else:
+        print "Geometry %s not implemented" % geom
+        corr = None
+    return corr
+
 ##############################################################################
 def get_params(ctr,point):
     """
@@ -1101,6 +1924,10 @@ def set_params(ctr,point,intpar={},corrpar={}):
             ctr.corr_params[point]['sample']['polygon'] = _getpar(corrpar.get('sample polygon'))
         if corrpar.get('sample angles')!=None:
             ctr.corr_params[point]['sample']['angles'] = _getpar(corrpar.get('sample angles'))
+        # update the typed columns of all points sharing these params
+        cp  = ctr.corr_params[point]
+        idx = [j for j in range(len(ctr.corr_params)) if ctr.corr_params[j] is cp]
+        ctr._set_corr_columns(idx)
     
 ##############################################################################
 def _update_psic_angles(gonio,scan,point,verbose=True):
@@ -1180,6 +2007,79 @@ def _update_psic_angles(gonio,scan,point,verbose=True):
     gonio.set_angles(phi=phi,chi=chi,eta=eta,
                      mu=mu,nu=nu,delta=delta)
 
+##############################################################################
+def _psic_angle_arrays(scan,points,verbose=True):
+    """
+    given a scandata object and a list of scan points return
+    a dictionary of psic angle arrays (see _update_psic_angles).
+    Missing angles are returned as None
+    """
+    try:
+        npts = int(scan.dims[0])
+    except:
+        npts = scan.get('dims', (1,0))[0]
+    try: 
+        scan_name = scan.name
+    except: 
+        scan_name = ''
+    points = num.asarray(points,dtype=int)
+    angles = {}
+    for (key,lbl) in (('phi','phi'),('chi','chi'),('eta','eta'),
+                      ('mu','mu'),('nu','nu'),('delta','del')):
+        try:
+            val = _scan_columns(scan,[lbl],points,npts=npts)[0]
+        except:
+            val = None
+        if val is None and verbose==True:
+            print "Warning no %s angle" % lbl, scan_name
+        angles[key] = val
+    return angles
+
+##############################################################################
+def _scan_columns(scan,labels,points,npts=None):
+    """
+    return the values of labels at the scan points as a
+    (len(labels) x len(points)) array, see ScanData.get_columns.
+    Scans without get_columns are indexed label by label
+    (npts is then the expected length of the arrays)
+    """
+    if hasattr(scan,'get_columns'):
+        return scan.get_columns(labels,points=points)
+    points = num.asarray(points,dtype=int)
+    out = num.empty((len(labels),len(points)),dtype=float)
+    for (j,lbl) in enumerate(labels):
+        val = num.ravel(scan[lbl])
+        if len(val) == 1:
+            out[j] = val[0]
+        elif (npts != None) and (len(val) != npts):
+            raise ValueError, "Label '%s' has %i values, expected %i" % \
+                  (lbl,len(val),npts)
+        else:
+            out[j] = val[points]
+    return out
+
+##############################################################################
+def _sample_descr(sample):
+    """
+    Parse the sample description (see CtrCorrectionPsic).
+    Returns either None (no sample correction), the diameter
+    of a round sample, or a list [polygon,angles]
+    """
+    if type(sample) != types.DictType:
+        return sample
+    sample_dia    = sample.get('dia',0.)
+    sample_vecs   = sample.get('polygon',None)
+    sample_rect   = sample.get('rect',None)
+    sample_angles = sample.get('angles',{})
+    if sample_dia == None: sample_dia = 0.
+    if sample_vecs == None and sample_rect != None:
+        sample_vecs = polygon.rect_polygon(sample_rect[0],sample_rect[1])
+    if sample_vecs != None and sample_dia <= 0.:
+        return [sample_vecs,sample_angles]
+    elif sample_dia > 0.:
+        return sample_dia
+    return None
+
 ##############################################################################
 class CtrCorrectionPsic:
     """
@@ -1229,6 +2129,9 @@ class CtrCorrectionPsic:
         sample['polygon'] = [[1.,1.], [.5,1.5], [-1.,1.],
                              [-1.,-1.],[0.,.5],[1.,-1.]]
         sample['angles']  = {'phi':108.0007,'chi':0.4831}
+        sample['rect'] = [width,length] may be given instead of the
+                         polygon for a rectangular sample, width is
+                         along x and length along y (at the given angles)
 
         polygon = [[x,y,z],[x,y,z],[x,y,z],....]
                   is a list of vectors that describe the shape of
@@ -1304,6 +2207,24 @@ class CtrCorrectionPsic:
             print "   Total=%f" % ct
         return ct
 
+    def ctot_rocking(self,plot=False,fig=None):
+        """
+        correction factors for rocking scans (integrated intensities)
+        """
+        cp = self.polarization()
+        cl = self.lorentz_scan()
+        cr = self.rod_intercept()
+        ca = self.active_area(plot=plot,fig=fig)
+        ct = (cp)*(cl)*(cr)*(ca)
+        if plot == True:
+            print "Correction factors (mult by I)" 
+            print "   Polarization=%f" % cp
+            print "   Lorentz=%f" % cl
+            print "   Rod intercept=%f" % cr
+            print "   Area=%f" % ca
+            print "   Total=%f" % ct
+        return ct
+
     ##########################################################################
     def lorentz_stationary(self):
         """
@@ -1377,7 +2298,7 @@ class CtrCorrectionPsic:
         nu    = self.gonio.angles['nu']
         p = 1. - ( cosd(delta) * sind(nu) )**2.
         if fh != 1.0:
-            p = fh * c_p + (1.-fh)*(1.0 - (sind(delta))**2.)
+            p = fh * p + (1.-fh)*(1.0 - (sind(delta))**2.)
         if p == 0.:
             cp = 0.
         else:
@@ -1429,21 +2350,10 @@ class CtrCorrectionPsic:
                                           nu=self.gonio.angles['nu'],
                                           delta=self.gonio.angles['delta'])
         # get sample poly
-        if type(self.sample) == types.DictType:
-            sample_dia    = self.sample.get('dia',0.)
-            sample_vecs   = self.sample.get('polygon',None)
-            sample_angles = self.sample.get('angles',{})
-            #
-            if sample_vecs != None and sample_dia <= 0.:
-                sample = gonio_psic.sample_vectors(sample_vecs,
-                                                   angles=sample_angles,
-                                                   gonio=self.gonio)
-            elif sample_dia > 0.:
-                sample = sample_dia
-            else:
-                sample = None
-        else:
-            sample = self.sample
+        sample = _sample_descr(self.sample)
+        if type(sample) == types.ListType:
+            sample = gonio_psic.sample_vectors(sample[0],angles=sample[1],
+                                               gonio=self.gonio)
 
         # compute active_area
         (A_beam,A_int) = active_area(self.gonio.nm,ki=self.gonio.ki,
@@ -1456,6 +2366,154 @@ class CtrCorrectionPsic:
             
         return ca
 
+##############################################################################
+class CtrCorrectionPsicArray:
+    """
+    Array version of CtrCorrectionPsic.  Computes the correction
+    factors for all points of a scan in one call.
+
+    Notes:
+    ------
+    The corrections are identical to those computed by
+    CtrCorrectionPsic (see that class for the definitions of the
+    correction factors, slits and sample description).  The only
+    difference is that the goniometer angles are passed as arrays,
+    and each method returns an array of correction factors (one
+    for each set of angles).  The gonio instance is used only
+    for the orientation (UB) and wavelength, its angles are not
+    changed.
+    """
+    def __init__(self,gonio=None,angles={},beam_slits={},det_slits=None,
+                 sample={}):
+        """
+        Initialize
+
+        Parameters:
+        -----------
+        * gonio is a goniometer instance holding the orientation
+        * angles is a dictionary of angle arrays, e.g.
+          {'phi':phi,'chi':chi,'eta':eta,'mu':mu,'nu':nu,'delta':delta}
+          any missing angles are taken from the gonio instance
+        * beam_slits are dictionary defining the incident beam aperature
+        * det_slits are a dictionary defining the detector aperature
+        * sample is a dictionary describing the sample geometry
+        """
+        self.gonio      = gonio
+        self.beam_slits = beam_slits
+        self.det_slits  = det_slits
+        self.sample     = sample
+        # fraction horz polarization
+        self.fh         = 1.0
+        self.angles = {}
+        for key in ('phi','chi','eta','mu','nu','delta'):
+            val = angles.get(key)
+            if val is None: val = gonio.angles[key]
+            self.angles[key] = num.atleast_1d(num.asarray(val,dtype=float))
+        self.pangles = gonio.calc_array(**self.angles)
+        self.npts    = len(self.pangles['tth'])
+
+    ##########################################################################
+    def ctot_stationary(self):
+        """
+        correction factors for stationary measurements (e.g. images)
+        """
+        cp = self.polarization()
+        cl = self.lorentz_stationary()
+        ca = self.active_area()
+        return (cp)*(cl)*(ca)
+
+    def ctot_rocking(self):
+        """
+        correction factors for rocking scans (integrated intensities)
+        """
+        cp = self.polarization()
+        cl = self.lorentz_scan()
+        cr = self.rod_intercept()
+        ca = self.active_area()
+        return (cp)*(cl)*(cr)*(ca)
+
+    ##########################################################################
+    def lorentz_stationary(self):
+        """
+        Lorentz factor for a stationary (image) measurement
+        """
+        return sind(self.pangles['beta'])
+
+    ##########################################################################
+    def lorentz_scan(self):
+        """
+        Lorentz factor for a generic scan
+        """
+        return sind(self.pangles['tth'])
+
+    ##########################################################################
+    def rod_intercept(self,):
+        """
+        Rod intercept correction (rocking scans)
+        """
+        return cosd(self.pangles['beta'])
+
+    ##########################################################################
+    def polarization(self,):
+        """
+        Polarization correction factor
+        """
+        fh    = self.fh
+        delta = self.angles['delta']
+        nu    = self.angles['nu']
+        p = 1. - ( cosd(delta) * sind(nu) )**2.
+        if fh != 1.0:
+            p = fh * p + (1.-fh)*(1.0 - (sind(delta))**2.)
+        p  = num.resize(p,self.npts)
+        cp = num.zeros(self.npts)
+        idx = num.where(p != 0.)
+        cp[idx] = 1./p[idx]
+        return cp
+
+    ##########################################################################
+    def active_area(self,):
+        """
+        Active area correction (c_a = A_beam/A_int**2)
+        """
+        ca = num.zeros(self.npts)
+        if self.beam_slits == {} or self.beam_slits == None:
+            print "Warning beam slits not specified"
+            return ca + 1.0
+        alpha = self.pangles['alpha']
+        beta  = self.pangles['beta']
+        idx   = num.where((alpha >= 0.0)&(beta >= 0.0))[0]
+        if len(idx) == 0: return ca
+
+        # beam vectors
+        beam = gonio_psic.beam_vectors(h=self.beam_slits['horz'],
+                                       v=self.beam_slits['vert'])
+        # det vectors, rotate the nu = delta = 0 vectors
+        if self.det_slits == None:
+            det = None
+        else:
+            det = gonio_psic.det_vectors(h=self.det_slits['horz'],
+                                         v=self.det_slits['vert'])
+            D   = gonio_psic.calc_D(nu=self.angles['nu'][idx],
+                                    delta=self.angles['delta'][idx])
+            det = num.einsum('nij,kj->nki',D,num.array(det))
+        # sample, phi frame vectors are rotated to the m-frame
+        sample = _sample_descr(self.sample)
+        if type(sample) == types.ListType:
+            sample = gonio_psic.sample_vectors(sample[0],angles=sample[1])
+            # 2D vectors are [x,y,0] (see gonio_psic.sample_vectors)
+            sample = num.array([[p[0],p[1],0.] if len(p)==2 else p
+                                for p in sample],dtype=float)
+            sample = num.einsum('nij,kj->nki',self.pangles['Z'][idx],sample)
+
+        # compute active_area
+        (A_beam,A_int) = active_area_array(self.pangles['nm'][idx],
+                                           ki=self.pangles['ki'][idx],
+                                           kr=self.pangles['kr'][idx],
+                                           beam=beam,det=det,sample=sample)
+        jdx = num.where(A_int != 0.)[0]
+        ca[idx[jdx]] = A_beam[jdx]/(A_int[jdx]**2)
+        return ca
+
 ##############################################################################
 ##############################################################################
 def test1():
@@ -1472,6 +2530,39 @@ def test1():
                             det_slits=det_slits,sample=sample)
     ct = cor.ctot_stationary(plot=True)
 
+def test_corr_array(npts=25):
+    """
+    Check that CtrCorrectionPsicArray gives the same corrections as
+    CtrCorrectionPsic point by point (round and polygon samples,
+    with and without detector slits)
+    """
+    psic = gonio_psic.test2(show=False)
+    r = num.random.RandomState(0)
+    angles = {'phi':r.uniform(100.,120.,npts),'chi':r.uniform(-1.,1.,npts),
+              'eta':r.uniform(0.,5.,npts),'mu':r.uniform(1.,4.,npts),
+              'nu':r.uniform(0.,60.,npts),'delta':r.uniform(0.,40.,npts)}
+    beam_slits = {'horz':.6,'vert':.8}
+    samples = [{'dia':3.},
+               {'polygon':[[1.,1.], [.5,1.5], [-1.,1.], [-1.,-1.],
+                           [0.,.5],[1.,-1.]],
+                'angles':{'phi':108.0007,'chi':0.4831}}]
+    for sample in samples:
+        for det_slits in ({'horz':2.0,'vert':1.5},None):
+            cora = CtrCorrectionPsicArray(gonio=psic,angles=angles,
+                                          beam_slits=beam_slits,
+                                          det_slits=det_slits,sample=sample)
+            ct_s = cora.ctot_stationary()
+            ct_r = cora.ctot_rocking()
+            for j in range(npts):
+                psic.set_angles(**dict([(k,v[j]) for (k,v) in angles.items()]))
+                cor = CtrCorrectionPsic(gonio=psic,beam_slits=beam_slits,
+                                        det_slits=det_slits,sample=sample)
+                assert num.allclose(cor.ctot_stationary(),ct_s[j],
+                                    rtol=1e-9,atol=0.), "ctot_stationary"
+                assert num.allclose(cor.ctot_rocking(),ct_r[j],
+                                    rtol=1e-9,atol=0.), "ctot_rocking"
+    print "CtrCorrectionPsicArray matches CtrCorrectionPsic"
+
 ##############################################################################
 if __name__ == "__main__":
     """
@@ -0,0 +1,367 @@
+"""
+Merging of symmetry equivalent and repeated CTR data points.
+
+Authors / Modifications:
+------------------------
+* T. Trainor (tptrainor@alaska.edu)
+
+Notes:
+------
+The points of a CtrData set are mapped onto an asymmetric unit of
+reciprocal space using the point group of the surface plane group
+(the glide/centering parts of the plane group only affect the phases
+and extinctions, not which rods are equivalent).  Without anomalous
+scattering Friedel's law F(H,K,L) = F(-H,-K,-L) also applies, ie each
+in-plane operation R combined with inversion maps (H,K,L) onto
+(-R(H,K),-L).
+
+Within each (asymmetric unit) rod the points are sorted in L and
+points closer than Ltol in L are grouped together.  Each group is
+reduced to a single point with the weighted mean (w = 1/Ferr^2) of F.
+
+The agreement between equivalent points is summarized by the
+agreement factors
+
+    R    = sum(|F - <F>|) / sum(F)
+    Rw   = sqrt( sum(w*(F - <F>)^2) / sum(w*F^2) )
+    chi2 = sum(w*(F - <F>)^2) / (Nobs - Nunique)
+
+If the statistical errors underestimate the spread of the equivalent
+points (chi2 > 1) a fractional systematic error (eps) is estimated
+such that chi2 = 1 when the point errors are taken as
+
+    Ferr_tot = sqrt( Ferr^2 + (eps*F)^2 )
+
+The merged errors are then computed from these total errors.
+
+Example:
+--------
+>>m = merge_ctr(ctr,group='p4mm',Ltol=0.02)
+>>print_merge_stats(m)
+>>write_merged(m,'merged.dat',bragg=(2.,2.))
+>>dat = ctrfitcalcs.read_data('merged.dat')
+
+"""
+##############################################################################
+
+import types
+import numpy as num
+
+from tdl.modules.ana.ctr_data import ROD_DECIMALS
+
+##############################################################################
+# point group generators acting on the (H,K) reciprocal lattice
+# indicies (column vector).  For the oblique/rectangular groups the
+# mirror is taken perpendicular to a (H,K)->(-H,K).  The hexagonal
+# groups assume gamma = 120 (real space).
+_GEN_2   = [[-1, 0],[ 0,-1]]
+_GEN_M   = [[-1, 0],[ 0, 1]]
+_GEN_4   = [[ 0,-1],[ 1, 0]]
+_GEN_3   = [[ 0, 1],[-1,-1]]
+_GEN_6   = [[ 1, 1],[-1, 0]]
+_GEN_M1  = [[ 0,-1],[-1, 0]]
+_GEN_1M  = [[ 0, 1],[ 1, 0]]
+
+POINT_GROUPS = {'1':[],
+                '2':[_GEN_2],
+                'm':[_GEN_M],
+                '2mm':[_GEN_2,_GEN_M],
+                '4':[_GEN_4],
+                '4mm':[_GEN_4,_GEN_M],
+                '3':[_GEN_3],
+                '3m1':[_GEN_3,_GEN_M1],
+                '31m':[_GEN_3,_GEN_1M],
+                '6':[_GEN_6],
+                '6mm':[_GEN_6,_GEN_1M]}
+
+# plane group -> point group
+PLANE_GROUPS = {'p1':'1','p2':'2',
+                'pm':'m','pg':'m','cm':'m',
+                'p2mm':'2mm','p2mg':'2mm','p2gg':'2mm','c2mm':'2mm',
+                'p4':'4','p4mm':'4mm','p4gm':'4mm',
+                'p3':'3','p3m1':'3m1','p31m':'31m',
+                'p6':'6','p6mm':'6mm'}
+
+##############################################################################
+def symmetry_ops(group='p1',friedel=True):
+    """
+    Get the symmetry operations for a plane (or point) group
+
+    Parameters:
+    -----------
+    * group is the plane group (see PLANE_GROUPS) or point group
+      (see POINT_GROUPS) name, or a list of 2x2 (H,K) matricies
+      used as generators
+    * friedel is a flag to include Friedel pairs, ie
+      (H,K,L) -> (-H,-K,-L)
+
+    Outputs:
+    --------
+    * (R,Ls) where R is a (nops,2,2) integer array of the
+      operations acting on (H,K) and Ls is a (nops,) array
+      of the sign applied to L.
+    """
+    if type(group) == types.StringType:
+        name = group.strip()
+        name = PLANE_GROUPS.get(name,name)
+        if name not in POINT_GROUPS:
+            raise ValueError, "Unknown plane group %s" % group
+        gens = POINT_GROUPS[name]
+    else:
+        gens = group
+    # close the group
+    ops = [num.identity(2,dtype=int)]
+    gens = [num.array(g,dtype=int) for g in gens]
+    new = True
+    while new:
+        new = False
+        for a in list(ops):
+            for g in gens:
+                op = num.dot(g,a)
+                if not any([num.all(op == b) for b in ops]):
+                    ops.append(op)
+                    new = True
+    R  = num.array(ops,dtype=int)
+    Ls = num.ones(len(ops),dtype=int)
+    if friedel:
+        R  = num.concatenate((R,-R))
+        Ls = num.concatenate((Ls,-Ls))
+    return (R,Ls)
+
+##############################################################################
+def asym_unit(H,K,L,group='p1',friedel=True,hkdecimal=ROD_DECIMALS):
+    """
+    Map (H,K,L) points onto the asymmetric unit
+
+    Parameters:
+    -----------
+    * H,K,L are arrays of the point indicies
+    * group is the plane group (see symmetry_ops)
+    * friedel is a flag to include Friedel pairs
+    * hkdecimal is the number of decimals used to round H and K
+
+    Outputs:
+    --------
+    * (H,K,L,op) where H and K are the rounded indicies and L
+      the (possibly sign changed) L values of the equivalent points
+      in the asymmetric unit, op is the index of the operation
+      (see symmetry_ops) that maps each point.
+
+    Notes:
+    ------
+    Of all the equivalent points the one with the largest H, then
+    the largest K, then the largest L is taken as the representative.
+    Therefore if (H,K,L) and (H,K,-L) are equivalent, the point
+    with L >= 0 is used.
+    """
+    H = num.around(num.asarray(H,dtype=float),decimals=hkdecimal)
+    K = num.around(num.asarray(K,dtype=float),decimals=hkdecimal)
+    L = num.asarray(L,dtype=float)
+    (R,Ls) = symmetry_ops(group,friedel=friedel)
+    # (nops,npts) equivalent points
+    # (+ 0. avoids -0.)
+    Hn = num.around(R[:,0,0:1]*H + R[:,0,1:2]*K,decimals=hkdecimal) + 0.
+    Kn = num.around(R[:,1,0:1]*H + R[:,1,1:2]*K,decimals=hkdecimal) + 0.
+    Ln = Ls[:,num.newaxis]*L
+    sel = (Hn == Hn.max(axis=0))
+    Kt  = num.where(sel,Kn,-num.inf)
+    sel = sel & (Kt == Kt.max(axis=0))
+    Lt  = num.where(sel,Ln,-num.inf)
+    sel = sel & (Lt == Lt.max(axis=0))
+    op  = num.argmax(sel,axis=0)
+    j   = num.arange(len(H))
+    return (Hn[op,j],Kn[op,j],Ln[op,j],op)
+
+##############################################################################
+def merge_ctr(ctr,group='p1',friedel=True,Ltol=0.01,syst=None,
+              exclude_bad=True,hkdecimal=ROD_DECIMALS):
+    """
+    Merge symmetry equivalent and repeated points of a CtrData set
+
+    Parameters:
+    -----------
+    * ctr is a CtrData instance
+    * group is the plane group (see symmetry_ops)
+    * friedel is a flag to include Friedel pairs as equivalent
+    * Ltol is the L tolerance, points of the same rod within
+      Ltol of each other (in L) are merged
+    * syst is the fractional systematic error added (in quadrature)
+      to the point errors.  If None it is estimated from the
+      agreement of the equivalent points (see Notes of this module)
+    * exclude_bad is a flag to exclude the points flagged as bad
+      (points with F or Ferr that are not finite or Ferr <= 0 are
+      always excluded)
+    * hkdecimal is the number of decimals used to round H and K
+
+    Outputs:
+    --------
+    * dictionary of the merged data sorted by rod and L:
+      - 'H','K','L','F','Ferr' the merged points (L is the
+        mean L value of the merged points)
+      - 'Ferr_stat' the error of the weighted mean from the point
+        errors only
+      - 'Fstd' the standard deviation of the merged points
+        (0 for single points)
+      - 'nobs' the number of merged points
+      - 'point_idx' the index of the ctr points used and 'merge_idx'
+        the index of the merged point each of these maps onto
+      - 'stats' the merge statistics (see merge_stats)
+    """
+    idx = num.arange(len(ctr.L))
+    ok  = num.isfinite(ctr.F) & num.isfinite(ctr.Ferr) & (ctr.Ferr > 0)
+    if exclude_bad and len(ctr.bad) > 0:
+        ok[num.array(ctr.bad,dtype=int)] = False
+    idx = idx[ok]
+    (H,K,L,op) = asym_unit(ctr.H[idx],ctr.K[idx],ctr.L[idx],group=group,
+                           friedel=friedel,hkdecimal=hkdecimal)
+    F    = ctr.F[idx]
+    Ferr = ctr.Ferr[idx]
+    # sort by rod then L and group along L
+    order = num.lexsort((L,K,H))
+    (idx,H,K,L,F,Ferr) = (idx[order],H[order],K[order],L[order],
+                          F[order],Ferr[order])
+    if len(idx) > 0:
+        brk = num.ones(len(idx),dtype=bool)
+        brk[1:] = (H[1:] != H[:-1]) | (K[1:] != K[:-1]) | \
+                  (num.diff(L) > Ltol)
+        gidx = num.cumsum(brk) - 1
+        ngrp = gidx[-1] + 1
+    else:
+        brk  = num.zeros(0,dtype=bool)
+        gidx = num.zeros(0,dtype=int)
+        ngrp = 0
+    nobs = num.bincount(gidx,minlength=ngrp)
+    # systematic error
+    if syst == None:
+        syst = _estimate_syst(F,Ferr,gidx,ngrp)
+    (Fm,Fm_err) = _weighted_mean(F,Ferr,gidx,ngrp,syst)
+    (tmp,Fm_stat) = _weighted_mean(F,Ferr,gidx,ngrp,0.)
+    Lm = num.bincount(gidx,weights=L,minlength=ngrp)/num.maximum(nobs,1)
+    dev = F - Fm[gidx]
+    Fstd = num.sqrt(num.bincount(gidx,weights=dev**2,minlength=ngrp) /
+                    num.maximum(nobs-1,1))
+    m = {'H':H[brk],'K':K[brk],'L':Lm,'F':Fm,'Ferr':Fm_err,
+         'Ferr_stat':Fm_stat,'Fstd':Fstd,'nobs':nobs,
+         'point_idx':idx,'merge_idx':gidx}
+    m['stats'] = merge_stats(F,Ferr,gidx,ngrp)
+    m['stats']['syst']  = syst
+    m['stats']['group'] = group
+    return m
+
+def _weighted_mean(F,Ferr,gidx,ngrp,syst=0.):
+    """
+    weighted mean and error of the grouped points
+    """
+    w  = 1./(Ferr**2 + (syst*F)**2)
+    sw = num.bincount(gidx,weights=w,minlength=ngrp)
+    sw = num.where(sw > 0,sw,num.nan)
+    Fm = num.bincount(gidx,weights=w*F,minlength=ngrp)/sw
+    return (Fm,1./num.sqrt(sw))
+
+def _chi2(F,Ferr,gidx,ngrp,syst=0.):
+    """
+    reduced chi2 of the grouped points about their weighted means
+    """
+    dof = len(F) - ngrp
+    if dof <= 0: return 0.
+    w  = 1./(Ferr**2 + (syst*F)**2)
+    (Fm,tmp) = _weighted_mean(F,Ferr,gidx,ngrp,syst)
+    return num.sum(w*(F-Fm[gidx])**2)/dof
+
+def _estimate_syst(F,Ferr,gidx,ngrp,tol=1.0e-4,maxsyst=1.0):
+    """
+    fractional systematic error for which chi2 = 1
+    (0 if chi2 <= 1 without systematic error)
+    """
+    if _chi2(F,Ferr,gidx,ngrp,0.) <= 1.: return 0.
+    if _chi2(F,Ferr,gidx,ngrp,maxsyst) > 1.: return maxsyst
+    (lo,hi) = (0.,maxsyst)
+    while hi - lo > tol:
+        mid = 0.5*(lo + hi)
+        if _chi2(F,Ferr,gidx,ngrp,mid) > 1.:
+            lo = mid
+        else:
+            hi = mid
+    return hi
+
+##############################################################################
+def merge_stats(F,Ferr,gidx,ngrp):
+    """
+    Agreement factors of grouped points
+
+    Parameters:
+    -----------
+    * F and Ferr are the point values and errors
+    * gidx is the group index of each point
+    * ngrp is the number of groups
+
+    Outputs:
+    --------
+    * dictionary with 'R', 'Rw' and 'chi2' (computed using only the
+      groups with more than one point), 'nobs' number of points,
+      'nunique' number of groups, 'nmulti' number of groups with
+      more than one point and 'redundancy' = nobs/nunique
+    """
+    nobs = num.bincount(gidx,minlength=ngrp)
+    multi = (nobs > 1)[gidx]
+    (Fm,tmp) = _weighted_mean(F,Ferr,gidx,ngrp,0.)
+    dev = (F - Fm[gidx])[multi]
+    Fs  = F[multi]
+    w   = 1./Ferr[multi]**2
+    stats = {'nobs':len(F),'nunique':ngrp,
+             'nmulti':int(num.sum(nobs > 1)),
+             'redundancy':float(len(F))/max(ngrp,1)}
+    if len(Fs) > 0 and num.sum(num.abs(Fs)) > 0:
+        stats['R']  = num.sum(num.abs(dev))/num.sum(num.abs(Fs))
+        stats['Rw'] = num.sqrt(num.sum(w*dev**2)/num.sum(w*Fs**2))
+    else:
+        stats['R']  = 0.
+        stats['Rw'] = 0.
+    stats['chi2'] = _chi2(F,Ferr,gidx,ngrp,0.)
+    return stats
+
+def print_merge_stats(m):
+    """
+    Print the merge statistics of a merged data set (see merge_ctr)
+    """
+    s = m['stats']
+    print "Plane group: %s" % str(s['group'])
+    print "Number of points = %i, unique = %i (redundancy = %6.3f)" % \
+          (s['nobs'],s['nunique'],s['redundancy'])
+    print "Number of points with equivalents = %i" % s['nmulti']
+    print "R = %6.4f, Rw = %6.4f, chi2 = %6.4f" % (s['R'],s['Rw'],s['chi2'])
+    print "Systematic error = %6.4f" % s['syst']
+
+##############################################################################
+def write_merged(m,fname='merged.dat',bragg=(0.,1.)):
+    """
+    Write merged data in the format read by ctrfitcalcs.read_data
+
+    Parameters:
+    -----------
+    * m is the merged data (see merge_ctr)
+    * fname is the file name
+    * bragg gives the Bragg peak L position (Lb) and the L spacing
+      of the Bragg peaks (Db) for each rod, used for the roughness
+      calculation.  It is either a tuple (Lb,Db) for all rods, a
+      dictionary {(H,K):(Lb,Db)} or a function f(H,K) -> (Lb,Db)
+
+    Notes:
+    ------
+    read_data skips points with L = 0
+    """
+    f = open(fname,'w')
+    f.write("%% %5s %5s %8s %12s %12s %6s %6s\n" % ('H','K','L','F','Ferr',
+                                                    'Lb','Db'))
+    for j in range(len(m['L'])):
+        (H,K) = (m['H'][j],m['K'][j])
+        if callable(bragg):
+            (Lb,Db) = bragg(H,K)
+        elif type(bragg) == types.DictType:
+            (Lb,Db) = bragg[(H,K)]
+        else:
+            (Lb,Db) = bragg
+        line = "%7.3f %5.3f %8.4f %12.6g %12.6g %6.3f %6.3f\n" % \
+               (H,K,m['L'][j],m['F'][j],m['Ferr'][j],Lb,Db)
+        f.write(line)
+    f.close()
@@ -0,0 +1,363 @@
+"""
+Reciprocal space gridding of image scans
+
+Authors / Modifications:
+------------------------
+* T. Trainor (tptrainor@alaska.edu)
+
+Notes:
+------
+The pixels of each image of a scan are mapped to (H,K,L) (see
+geom.pixel_q) and binned into a regular (H,K,L) grid.  For each bin
+the grid accumulates
+
+    I     = sum of the pixel intensities
+    hits  = number of pixels
+    norm  = sum of the normalization value (eg io) of the pixels
+
+so that the normalized intensity of a bin is I/norm and its error
+(counting statistics) sqrt(I)/norm.  Since only these sums are kept
+the frames are processed one at a time (memory is bounded by the grid
+size), and grids computed from different frames (or scans) can be
+added together.  grid_scan uses this to split the frames of a scan
+over several processes.
+
+Example:
+--------
+>>pm   = pixel_q.PixelMap(psic,distance=1000.,pixel_size=0.172,
+                          center=(97,243),shape=(195,487))
+>>grid = HklGrid(H=(0.9,1.1,41),K=(-0.1,0.1,41),L=(0.5,3.5,301))
+>>grid_scan(scan,pm,grid,norm='io',nproc=4)
+>>(I,Ierr) = grid.get_data()
+>>grid.plot_slice(L=2.0)
+"""
+##############################################################################
+
+import copy
+import itertools
+import multiprocessing
+import numpy as num
+from matplotlib import pyplot
+
+from tdl.modules.ana.ctr_data import _psic_angle_arrays
+
+##############################################################################
+class HklGrid:
+    """
+    Regular (H,K,L) grid of binned intensities
+    """
+    def __init__(self,H=(0.,1.,11),K=(0.,1.,11),L=(0.,1.,11)):
+        """
+        Parameters:
+        -----------
+        * H, K and L are (min,max,nbins) tuples defining the grid.
+          min and max are the bin centers of the first and last
+          bins (nbins = 1 gives a single bin of width max-min
+          centered on (min+max)/2)
+        """
+        self.axes  = []
+        self.delta = []
+        self.edges = []
+        for (vmin,vmax,n) in (H,K,L):
+            (vmin,vmax,n) = (float(vmin),float(vmax),int(n))
+            if n > 1:
+                d = (vmax - vmin)/(n - 1)
+                self.axes.append(num.linspace(vmin,vmax,n))
+            else:
+                d = vmax - vmin
+                self.axes.append(num.array([0.5*(vmin+vmax)]))
+            if d <= 0:
+                raise ValueError, "Grid max must be larger than min"
+            self.delta.append(d)
+            self.edges.append(self.axes[-1][0] - 0.5*d)
+        self.shape = (len(self.axes[0]),len(self.axes[1]),len(self.axes[2]))
+        self.size  = self.shape[0]*self.shape[1]*self.shape[2]
+        self.clear()
+
+    def __repr__(self,):
+        lout = "HKL grid: shape = (%i,%i,%i)\n" % self.shape
+        for (lbl,ax) in zip(('H','K','L'),self.axes):
+            lout = "%s%s = %g to %g\n" % (lout,lbl,ax[0],ax[-1])
+        lout = "%sNumber of frames = %i\n" % (lout,self.nframes)
+        return lout
+
+    def clear(self,):
+        """
+        Zero the grid
+        """
+        self.I     = num.zeros(self.shape,dtype=float)
+        self.hits  = num.zeros(self.shape,dtype=int)
+        self.norm  = num.zeros(self.shape,dtype=float)
+        self.nframes = 0
+
+    def copy(self,):
+        """
+        Return an empty grid with the same bins
+        """
+        grid = copy.copy(self)
+        grid.clear()
+        return grid
+
+    ##########################################################################
+    def bin_index(self,H,K,L):
+        """
+        Return the flat bin index of each point (-1 if outside the grid)
+        """
+        idx  = None
+        good = None
+        for (j,x) in enumerate((H,K,L)):
+            x = num.asarray(x,dtype=float).ravel()
+            b = num.floor((x - self.edges[j])/self.delta[j]).astype(int)
+            g = (b >= 0) & (b < self.shape[j])
+            if idx is None:
+                (idx,good) = (b,g)
+            else:
+                idx  = idx*self.shape[j] + b
+                good = good & g
+        return num.where(good,idx,-1)
+
+    def add_frame(self,image,H,K,L,norm=1.,mask=None):
+        """
+        Add an image to the grid
+
+        Parameters:
+        -----------
+        * image is the image (2D array)
+        * H, K and L are the pixel hkl maps (same shape as image)
+        * norm is the normalization (eg io) of the image
+        * mask is an optional boolean array, only pixels with mask
+          True are added
+        """
+        image = num.asarray(image,dtype=float).ravel()
+        idx   = self.bin_index(H,K,L)
+        good  = (idx >= 0) & num.isfinite(image)
+        if mask is not None:
+            good = good & num.asarray(mask,dtype=bool).ravel()
+        idx   = idx[good]
+        I     = num.bincount(idx,weights=image[good],minlength=self.size)
+        hits  = num.bincount(idx,minlength=self.size)
+        self.I    += I.reshape(self.shape)
+        self.hits += hits.reshape(self.shape)
+        self.norm += float(norm)*hits.reshape(self.shape)
+        self.nframes = self.nframes + 1
+
+    def add_grid(self,grid):
+        """
+        Add the data of another grid (with the same bins)
+        """
+        if grid.shape != self.shape:
+            raise ValueError, "Grids must have the same shape"
+        self.I     += grid.I
+        self.hits  += grid.hits
+        self.norm  += grid.norm
+        self.nframes = self.nframes + grid.nframes
+
+    def __iadd__(self,grid):
+        self.add_grid(grid)
+        return self
+
+    ##########################################################################
+    def get_data(self,):
+        """
+        Return the normalized intensities and errors
+
+        Outputs:
+        --------
+        * (I,Ierr) arrays with the grid shape, I = I/norm and
+          Ierr = sqrt(I)/norm.  Empty bins are nan
+        """
+        ok = self.norm > 0
+        n  = num.where(ok,self.norm,1.)
+        I  = num.where(ok,self.I/n,num.nan)
+        Ierr = num.where(ok,num.sqrt(num.abs(self.I))/n,num.nan)
+        return (I,Ierr)
+
+    def get_slice(self,H=None,K=None,L=None):
+        """
+        Return the normalized intensities of the plane through the
+        grid at the given H, K or L value (give only one).
+
+        Outputs:
+        --------
+        * (x,y,I) where x and y are the axes of the slice
+        """
+        (I,Ierr) = self.get_data()
+        for (j,val) in enumerate((H,K,L)):
+            if val != None:
+                k = int(num.argmin(num.abs(self.axes[j]-val)))
+                ax = [self.axes[i] for i in range(3) if i != j]
+                return (ax[0],ax[1],num.take(I,k,axis=j))
+        raise ValueError, "Give H, K or L"
+
+    def plot_slice(self,H=None,K=None,L=None,fig=None,log=False):
+        """
+        Plot a slice (see get_slice)
+        """
+        (x,y,I) = self.get_slice(H=H,K=K,L=L)
+        if fig != None:
+            pyplot.figure(fig)
+        else:
+            pyplot.figure()
+        pyplot.clf()
+        if log:
+            I = num.log10(num.where(I > 0,I,num.nan))
+        pyplot.imshow(I.T,origin='lower',aspect='auto',
+                      extent=(x[0],x[-1],y[0],y[-1]))
+        pyplot.colorbar()
+
+##############################################################################
+def grid_images(grid,images,hkl,norm=None,mask=None):
+    """
+    Add a sequence of images to a grid
+
+    Parameters:
+    -----------
+    * grid is a HklGrid instance
+    * images is a list (or any iterable) of images
+    * hkl is an iterable of (H,K,L) pixel maps, one for each image
+      (eg PixelMap.calc_hkl_scan)
+    * norm is a list of the image normalization values (default 1)
+    * mask is an optional boolean mask applied to all images
+
+    Notes:
+    ------
+    The images and hkl maps are only accessed one at a time, so
+    generators can be used to keep memory bounded.
+    """
+    j = 0
+    for (image,(H,K,L)) in itertools.izip(images,hkl):
+        if norm is None:
+            nrm = 1.
+        else:
+            nrm = norm[j]
+        grid.add_frame(image,H,K,L,norm=nrm,mask=mask)
+        j = j + 1
+    return grid
+
+##############################################################################
+def grid_scan(scan,pixmap,grid,norm='io',points=None,mask=None,nproc=1,
+              block_size=None):
+    """
+    Grid the images of a scan
+
+    Parameters:
+    -----------
+    * scan is a ScanData instance with an ImageScan (scan.image) and
+      the psic angles
+    * pixmap is a geom.pixel_q.PixelMap instance
+    * grid is the HklGrid instance the data are added to
+    * norm is the label of the normalization array (None for no
+      normalization)
+    * points is a list of the scan points to use (default is all)
+    * mask is an optional boolean mask applied to all images
+    * nproc is the number of processes (None uses all cpus)
+    * block_size is the number of frames each process handles at
+      a time (default spreads the frames evenly over the processes,
+      up to 16 frames per block)
+
+    Notes:
+    ------
+    Each process accumulates its block of frames into its own grid
+    and the results are added to grid.  The frames are read (and sent to
+    the workers) in rounds of nproc blocks so memory stays bounded.
+    """
+    npts = len(scan.image.image)
+    if points is None: points = range(npts)
+    points = list(points)
+    if len(points) == 0: return grid
+    angles = _psic_angle_arrays(scan,points)
+    if norm != None:
+        nrm = num.asarray(scan[norm],dtype=float)[points]
+    else:
+        nrm = num.ones(len(points))
+    if (nproc == None) or (nproc < 1):
+        nproc = multiprocessing.cpu_count()
+    if block_size == None:
+        block_size = min(16,int(num.ceil(float(len(points))/nproc)))
+    block_size = max(1,int(block_size))
+    blocks = []
+    for j in range(0,len(points),block_size):
+        blocks.append(range(j,min(j+block_size,len(points))))
+
+    def _task(blk):
+        ang = {}
+        for (key,val) in angles.items():
+            if val is not None: ang[key] = val[blk]
+        images = [scan.image.image[points[j]] for j in blk]
+        return (pixmap,grid.copy(),images,ang,nrm[blk],mask)
+
+    pool = None
+    if (nproc > 1) and (len(blocks) > 1):
+        pool = multiprocessing.Pool(min(nproc,len(blocks)))
+    try:
+        for j in range(0,len(blocks),max(nproc,1)):
+            tasks = [_task(blk) for blk in blocks[j:j+nproc]]
+            if pool != None:
+                results = pool.map(_grid_block,tasks)
+            else:
+                results = map(_grid_block,tasks)
+            for res in results:
+                grid.add_grid(res)
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
+    return grid
+
+def _grid_block(args):
+    """
+    Grid a block of frames (worker function for grid_scan)
+    """
+    (pixmap,grid,images,angles,norm,mask) = args
+    hkl = pixmap.calc_hkl_scan(**angles)
+    return grid_images(grid,images,hkl,norm=norm,mask=mask)
+
+##############################################################################
+def test_grid(npts=6):
+    """
+    Check the binned grid against a histogram of the pixel hkl
+    values of each frame, and grid_scan with several processes
+    against a single process
+    """
+    from tdl.modules.geom import gonio_psic, pixel_q
+    from tdl.modules.ana import scan_data, image_data
+    psic = gonio_psic.test2(show=False)
+    pm = pixel_q.PixelMap(psic,distance=1000.,pixel_size=0.172,
+                          center=(97,243),shape=(195,487))
+    r = num.random.RandomState(0)
+    images = [r.poisson(5,pm.shape).astype(float) for j in range(npts)]
+    io = r.uniform(1.e5,2.e5,npts)
+    eta = num.linspace(-0.5,0.5,npts)
+    ang = psic.angles
+    pos = {'phi':ang['phi'],'chi':ang['chi'],'eta':eta,'mu':ang['mu'],
+           'nu':ang['nu'],'del':ang['delta']}
+    scan = scan_data.ScanData(name='grid',dims=[npts],scalers={'io':io},
+                              positioners=pos,primary_axis=['eta'],
+                              primary_det=['io'],
+                              image=image_data.ImageScan(image=images))
+    grid = HklGrid(H=(-0.5,0.5,21),K=(-0.5,0.5,21),L=(5.5,6.5,51))
+    grid_scan(scan,pm,grid,norm='io',nproc=1)
+    # reference histogram
+    edges = [grid.edges[j] + grid.delta[j]*num.arange(grid.shape[j]+1)
+             for j in range(3)]
+    I = num.zeros(grid.shape)
+    norm = num.zeros(grid.shape)
+    for (j,(H,K,L)) in enumerate(pm.calc_hkl_scan(eta=eta)):
+        pts = num.array([H.ravel(),K.ravel(),L.ravel()]).T
+        I += num.histogramdd(pts,bins=edges,weights=images[j].ravel())[0]
+        norm += io[j]*num.histogramdd(pts,bins=edges)[0]
+    assert num.allclose(grid.I,I) and num.allclose(grid.norm,norm), \
+           "grid against histogram"
+    grid2 = grid.copy()
+    grid_scan(scan,pm,grid2,norm='io',nproc=2,block_size=2)
+    assert num.allclose(grid2.I,grid.I) and \
+           num.array_equal(grid2.hits,grid.hits) and \
+           num.allclose(grid2.norm,grid.norm), "grid_scan nproc"
+    print "HklGrid matches the histogram of the pixel hkl values"
+
+##############################################################################
+if __name__ == "__main__":
+    """
+    test
+    """
+    test_grid()
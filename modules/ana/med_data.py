@@ -14,6 +14,7 @@ import numpy as num
 from   matplotlib import pyplot
 
 from tdl.modules.spectra import deadtime
+from tdl.modules.spectra import roi as roi_mod
 from tdl.modules.spectra import medfile_cars
 from tdl.modules.spectra import medfile_emsa
 
@@ -127,7 +128,18 @@ class MedScan:
     Attributes:
     -----------
     * med is a list of med objects
+    * cor_factors is an array (points x detectors) of the deadtime
+      correction factors from the last call to update_deadtime
+    * icr is an array (points x detectors) of the computed input count
+      rates (NaN if not computed)
 
+    Notes:
+    ------
+    The deadtime corrections for the whole scan are computed at once by
+    update_deadtime (or update_tau) and stored in cor_factors, the factors
+    are also set on each mca so Med.get_data and get_rois use them
+    without recomputing.  get_cor_factors reads the factors back from
+    the mcas, so corrections updated on a single med or mca are used.
     """
     ########################################################################
     def __init__(self,med=[],**kws):
@@ -163,6 +175,8 @@ class MedScan:
         """
         if type(med) != types.ListType: med = [med]
         self.med = med
+        self.cor_factors = None
+        self.icr = None
         self.init_params(params=kws)
 
     ########################################################################
@@ -200,15 +214,102 @@ class MedScan:
         if len(params) > 0:
             for m in self.med:
                 m.init_params(params)
+            # correction factors may have changed
+            self.cor_factors = None
+            self.icr = None
 
     ################################################################
     def update_tau(self,tau):
         """
-        update med tau factors
+        update med tau factors and recompute the
+        deadtime corrections (see update_deadtime)
+        """
+        self.update_deadtime(tau=tau)
+
+    ################################################################
+    def update_deadtime(self,tau=None):
+        """
+        Compute the deadtime correction factors for all points and
+        detectors at once.
+
+        Parameters:
+        -----------
+        * tau:  mca deadtime tau values
+          None --> recompute correction factors with current taus
+          []   --> Turn off correction, ie set taus to -1
+          single value (or single valued list) --> assign to all mcas
+          list (or array) --> assign to individual mcas
+
+        Outputs:
+        --------
+        * the correction factors, array (points x detectors).  These are
+          also stored as self.cor_factors and set on each mca
+        """
+        npnt = len(self.med)
+        ndet = self.med[0].n_detectors
+        if tau is not None:
+            tau = self._tau_array(tau,ndet)
+            if tau is None: return self.get_cor_factors()
+            for m in self.med:
+                for k in range(ndet):
+                    m.mca[k].tau = tau[k]
+        c = self.get_count_arrays()
+        (cor,icr) = deadtime.calc_correction_array(c['real_time'],c['live_time'],
+                                                   c['total_counts'],
+                                                   c['input_counts'],c['tau'])
+        for j in range(npnt):
+            for k in range(ndet):
+                mca = self.med[j].mca[k]
+                mca.cor_factor = cor[j,k]
+                if mca.tau >= 0 and (mca.live_time > 0) and (mca.real_time > 0):
+                    if num.isnan(icr[j,k]):
+                        mca.icr_calc = None
+                    else:
+                        mca.icr_calc = icr[j,k]
+        self.cor_factors = cor
+        self.icr = icr
+        return cor
+
+    def _tau_array(self,tau,ndet):
+        """
+        expand tau to an array of ndet values (see update_deadtime)
+        """
+        if type(tau) == num.ndarray: tau = list(tau)
+        if type(tau) == types.TupleType: tau = list(tau)
+        if tau == []:
+            return num.zeros(ndet) - 1.0
+        if isinstance(tau,(float,int)):
+            return num.zeros(ndet) + tau
+        if type(tau) == types.ListType:
+            if len(tau) == 1:
+                return num.zeros(ndet) + tau[0]
+            elif len(tau) == ndet:
+                return num.array(tau,dtype=float)
+            else:
+                print "Error: tau array must be of length %d" % ndet
+                return None
+        print "Failure assigning tau values - Type error"
+        return None
+
+    ################################################################
+    def get_count_arrays(self):
+        """
+        return a dictionary of the detector count values, each
+        an array dimensioned (points x detectors):
+        'real_time','live_time','total_counts','input_counts','tau'
         """
         npnt = len(self.med)
+        ndet = self.med[0].n_detectors
+        keys = ('real_time','live_time','total_counts','input_counts','tau')
+        c = {}
+        for key in keys:
+            c[key] = num.zeros((npnt,ndet))
         for j in range(npnt):
-            self.med[j].update_correction(tau)
+            for k in range(ndet):
+                mca = self.med[j].mca[k]
+                for key in keys:
+                    c[key][j,k] = getattr(mca,key)
+        return c
 
     ################################################################
     def get_tau(self):
@@ -236,15 +337,117 @@ class MedScan:
         >>ocr = medscan.ocr()
         >>ocr_detector_1 = ocr[1]
         """
-        ndet = self.med[0].n_detectors
+        c   = self.get_count_arrays()
+        ocr = c['total_counts']/c['live_time']
+        return num.transpose(ocr)
+
+    ################################################################
+    def get_data_stack(self):
+        """
+        return the raw (uncorrected) mca data of all the meds as an
+        array dimensioned (points x detectors x channels)
+        """
+        npnt   = len(self.med)
+        ndet   = self.med[0].n_detectors
+        nchans = len(self.med[0].mca[0].data)
+        data   = num.zeros((npnt,ndet,nchans),dtype=num.int)
+        for j in range(npnt):
+            for k in range(ndet):
+                data[j,k,:] = self.med[j].mca[k].data
+        return data
+
+    def get_cor_factors(self):
+        """
+        return the deadtime correction factors as an array
+        dimensioned (points x detectors)
+
+        The factors are always read from the mcas so changes made on
+        a single med or mca (eg Mca.update_correction) are used.
+        """
         npnt = len(self.med)
-        ocr  = num.zeros((npnt,ndet))
+        ndet = self.med[0].n_detectors
+        cor  = num.ones((npnt,ndet))
         for j in range(npnt):
             for k in range(ndet):
-                tot = self.med[j].mca[k].total_counts
-                lt  = self.med[j].mca[k].live_time
-                ocr[j][k] = float(tot)/float(lt)
-        return num.transpose(ocr)
+                cor[j,k] = self.med[j].mca[k].cor_factor
+        self.cor_factors = cor
+        return cor.copy()
+
+    def get_good_mask(self):
+        """
+        return a boolean array (points x detectors) that is
+        False for detectors in the bad_mca_idx list of each med
+        """
+        npnt = len(self.med)
+        ndet = self.med[0].n_detectors
+        good = num.ones((npnt,ndet),dtype=bool)
+        for j in range(npnt):
+            for k in self.med[j].bad_mca_idx:
+                good[j,k] = False
+        return good
+
+    ################################################################
+    def get_rois(self,labels=None,bgr_width=None,correct=True):
+        """
+        compute the roi total and net counts for all points and
+        detectors at once (see roi.calc_rois)
+
+        Parameters:
+        -----------
+        * labels is a list of roi labels, default is all the roi
+          labels defined for the first med
+        * bgr_width is the number of background channels, default
+          uses the bgr_width of each roi
+        * correct = True to apply the deadtime correction
+
+        Outputs:
+        --------
+        * dictionary with
+          - 'labels': list of roi labels
+          - 'total': (points x detectors x nrois) array of total counts
+          - 'net': (points x detectors x nrois) array of net counts
+          - 'total_sum', 'net_sum': (points x nrois) arrays summed over
+            the good detectors
+          Bad detectors and rois not defined for a detector are zero.
+
+        Example:
+        --------
+        >>r = medscan.get_rois()
+        >>fe = r['net_sum'][:,r['labels'].index('Fe ka')]
+        """
+        ndet = self.med[0].n_detectors
+        mcas = self.med[0].mca
+        if labels == None:
+            labels = []
+            for m in mcas:
+                for r in getattr(m,'rois',[]):
+                    if r.label not in labels: labels.append(r.label)
+        nrois = len(labels)
+        # empty roi for detectors without the label
+        left  = num.zeros((ndet,nrois),dtype=num.int)
+        right = num.zeros((ndet,nrois),dtype=num.int) - 1
+        bw    = num.zeros((ndet,nrois),dtype=num.int)
+        for k in range(ndet):
+            for r in getattr(mcas[k],'rois',[]):
+                if r.label in labels:
+                    i = labels.index(r.label)
+                    left[k,i]  = r.left
+                    right[k,i] = r.right
+                    if bgr_width == None:
+                        bw[k,i] = r.bgr_width
+                    else:
+                        bw[k,i] = bgr_width
+        data = self.get_data_stack()
+        if correct:
+            cor = self.get_cor_factors()
+        else:
+            cor = None
+        (total,net) = roi_mod.calc_rois(data,left,right,bgr_width=bw,cor=cor)
+        good  = self.get_good_mask()[:,:,num.newaxis]
+        total = total * good
+        net   = net * good
+        return {'labels':labels,'total':total,'net':net,
+                'total_sum':total.sum(axis=1),'net_sum':net.sum(axis=1)}
 
     ################################################################
     #def med2xrf(self,xrf_params={},lines=None,det_idx=0,emin=-1.,emax=-1.):
@@ -21,10 +21,22 @@ root/med_data/...
 root/xrf_data/...  
 root/ctr_data/...  
 
+The ctr_data sets are versioned (see CTR_ARCHIVE_VERSION).  In
+the current format each point column of the CtrData is a compressed,
+chunked array and the correction parameters are stored once for each
+unique parameter dictionary.  Sets written before the format was
+versioned (version 0) can still be read.
+
 Examples:
 --------
->>write_ctrdata(ctr,file='ctr.h5')
->>ctr = read_ctrdata(file='ctr.h5',name='ctr')
+>>write_ctrdata('ctr.h5',ctr,setname='ctr')
+>>ctr = read_ctrdata('ctr.h5',setname='ctr')
+>>
+>>list_ctrdata('ctr.h5')
+>>arc = read_ctrdata('ctr.h5',setname='ctr',lazy=True)
+>>F = arc['F']
+>>ctr = arc.get_ctr(scans=False)
+>>arc.close()
 
 Todo:
 -----
@@ -32,13 +44,14 @@ Todo:
   and CtrData to file.  
 * have to do writing of med and xrf
 * have to make read methods that will read the files and return the
-  appropriate class instances.  
+  appropriate class instances (done for CtrData).  
 """
 ################################################################################
 
 import types
 import os
 import copy
+import ast
 import numpy as num
 
 try:
@@ -50,10 +63,17 @@ from tdl.modules.ana import scan_data
 from tdl.modules.ana import image_data
 from tdl.modules.ana import ctr_data
 
+# ctr archive format version
+CTR_ARCHIVE_VERSION = 1
+# chunk length (points) and compression of the ctr archive columns
+CTR_CHUNK_SIZE = 4096
+CTR_COMPLEVEL  = 5
+
 ################################################################################
-def get_file(fname,path=None):
+def get_file(fname,path=None,mode=None):
     """
     Open / create file
+    (mode = 'r' opens an existing file read only)
     """
     try:
         if path != None:
@@ -62,7 +82,9 @@ def get_file(fname,path=None):
         else:
             fname = os.path.abspath(fname)
         #print fname
-        if os.path.exists(fname):
+        if mode == 'r':
+            h = tables.openFile(fname,mode="r")
+        elif os.path.exists(fname):
             h = tables.openFile(fname,mode="a")
         else:
             h = tables.openFile(fname,mode="w",title="Scan Data Archive")
@@ -116,41 +138,59 @@ def _cleanup():
     tables.file.close_open_files()
 
 ################################################################################
-def write_ctrdata(fname,ctr,setname='ctr',path=None,overwrite=True):
-    """
-    Write scan data
+def write_ctrdata(fname,ctr,setname='ctr',path=None,overwrite=True,
+                  scans=True,complevel=CTR_COMPLEVEL):
+    """
+    Write ctr data
+
+    Parameters:
+    -----------
+    * fname is the file name
+    * ctr is the CtrData instance
+    * setname is the name of the set in the file (use different set
+      names to store multiple ctr data sets in a single file)
+    * path is the file path
+    * overwrite is a flag to overwrite an existing set
+    * scans is a flag to also write the scan (and image) data
+    * complevel is the compression level (0-9) for the ctr columns
     """
     h = get_file(fname,path)
     if h == None: return
 
     # write all scans
+    scan_sets = []
+    if scans:
+        try:
+            for j in range(len(ctr.scan)):
+                d = _scan_data(ctr.scan[j])
+                scanname = "%s_S%03d" % (setname,j)
+                _write_scan(h,d,scanname,overwrite=overwrite)
+                if hasattr(ctr.scan[j],'image'):
+                    im = _image_data(ctr.scan[j].image)
+                    _write_image(h,im,scanname,overwrite=overwrite)
+                scan_sets.append(scanname)
+        except:
+            _cleanup()
+            print "Unable to write scandata"
+            return
+    # now write ctr data
     try:
-        for j in range(len(ctr.scan)):
-            d = _scan_data(ctr.scan[j])
-            scanname = "%s_S%03d" % (setname,j)
-            _write_scan(h,d,scanname,overwrite=overwrite)
-            if hasattr(ctr.scan[j],'image'):
-                im = _image_data(ctr.scan[j].image)
-                _write_image(h,im,scanname,overwrite=overwrite)
+        d = _ctr_data(ctr)
+        d['scan_sets'] = scan_sets
+        _write_ctr(h,d,setname,overwrite=overwrite,complevel=complevel)
     except:
         _cleanup()
-        print "Unable to write scandata"
-    # now write ctr data
-    #try:
-    d = _ctr_data(ctr)
-    _write_ctr(h,d,setname,overwrite=overwrite)
-    #except:
-    #    _cleanup()
-    #    print "Unable to write scandata"
+        print "Unable to write ctrdata"
+        return
     h.close()
     return d
 
 ################################################################################
-def _write_ctr(h,data,setname='ctr',overwrite=True):
+def _write_ctr(h,data,setname='ctr',overwrite=True,complevel=CTR_COMPLEVEL):
     """
-    note create array stores any homogeneous data type,
-    and remembers what it is so you get back correct
-    type when you read it back in (except tuples->lists)
+    Write the ctr data dictionary (see _ctr_data).  The point columns
+    are written as compressed chunked arrays, the corr_params as a
+    string array of the unique parameter dictionaries.
     """
     if not hasattr(h.root,'ctr_data'):
         h.createGroup(h.root,'ctr_data',"Ctr Data")
@@ -165,115 +205,338 @@ def _write_ctr(h,data,setname='ctr',overwrite=True):
             h.createGroup(h.root.ctr_data,setname,"Ctr Data")
     else:
         h.createGroup(h.root.ctr_data,setname,"Ctr Data")
-    # add data
-    """
-    class CtrTable(table.IsDescription):
-        I_lbl  = StringCol(16)
-        In_lbl = StringCol(16)
-        Ie_lbl = StringCol(16)
-        Ib_lbl = StringCol(16)
-        stype  = StringCol(16)
-    """
     grp0 = '/ctr_data/' + setname
-    if len(data['bad'])>0:
-        h.createArray(grp0,'bad',data['bad'],'bad points')
-    h.createArray(grp0,'scan_index',data['scan_index'],'scan_index')
-    h.createArray(grp0,'scan_type',data['scan_type'],'scan_type')
-    h.createArray(grp0,'Ilbl',data['I_lbl'],'I_lbl')
-    h.createArray(grp0,'Inorm_lbl',data['In_lbl'],'Inorm_lbl')
-    h.createArray(grp0,'Ierr_lbl',data['Ie_lbl'],'Ierr_lbl')
-    h.createArray(grp0,'Ibgr_lbl',data['Ib_lbl'],'Ibgr_lbl')
+    grp  = h.getNode('/ctr_data',setname)
+    grp._v_attrs.format  = 'ctr_data'
+    grp._v_attrs.version = CTR_ARCHIVE_VERSION
+    grp._v_attrs.npts    = data['npts']
     #
-    h.createArray(grp0,'H',data['H'],'H')
-    h.createArray(grp0,'K',data['K'],'K')
-    h.createArray(grp0,'L',data['L'],'L')
-    h.createArray(grp0,'I',data['I'],'I')
-    h.createArray(grp0,'Inorm',data['In'],'Inorm')
-    h.createArray(grp0,'Ierr',data['Ie'],'Ierr')
-    h.createArray(grp0,'Ibgr',data['Ib'],'Ibgr')
-    h.createArray(grp0,'ctot',data['c'],'ctot')
-    h.createArray(grp0,'F',data['F'],'F')
-    h.createArray(grp0,'Ferr',data['Fe'],'Ferr')
-    h.createArray(grp0,'beam_slit_horz',data['beam_slit_horz'],'beam_slit_horz') 
-    h.createArray(grp0,'beam_slit_vert',data['beam_slit_vert'],'beam_slit_vert')
-    h.createArray(grp0,'det_slit_horz',data['det_slit_horz'],'det_slit_horz') 
-    h.createArray(grp0,'det_slit_vert',data['det_slit_vert'],'det_slit_vert')
-    h.createArray(grp0,'geom',data['geom'],'geom')
-    h.createArray(grp0,'scale',data['scale'],'scale')
-    h.createArray(grp0,'sdia',data['sdia'],'sdia')
-    h.createArray(grp0,'spoly',data['spoly'],'spoly')
-    if type(data['sangle']) == types.DictType:
-        for name,val in data['sangle'].items():
-            name = 'sangle_'+name
-            h.createArray(grp0,name,val,name)
-    else:
-        h.createArray(grp0,'sangle',data['sangle'],'sangle')
+    filters = tables.Filters(complevel=complevel,complib='zlib',shuffle=True)
+    if data['npts'] > 0:
+        for (name,val) in data['columns'].items():
+            _write_column(h,grp0,name,val,filters)
+    if len(data['bad']) > 0:
+        h.createArray(grp0,'bad',num.array(data['bad'],dtype=int),'bad points')
+    if len(data['corr_params']) > 0:
+        h.createArray(grp0,'corr_params',data['corr_params'],'corr_params')
+    if len(data['scan_sets']) > 0:
+        h.createArray(grp0,'scan_sets',data['scan_sets'],'scan_sets')
+    if len(data.get('rock_params','')) > 0:
+        h.createArray(grp0,'rock_params',[data['rock_params']],'rock_params')
+
+def _write_column(h,grp,name,val,filters):
+    """
+    write a compressed, chunked array
+    """
+    val   = num.ascontiguousarray(val)
+    atom  = tables.Atom.from_dtype(val.dtype)
+    chunk = (min(len(val),CTR_CHUNK_SIZE),) + val.shape[1:]
+    node  = h.createCArray(grp,name,atom,val.shape,name,
+                           filters=filters,chunkshape=chunk)
+    node[:] = val
 
 ################################################################################
 def _ctr_data(ctr):
     """
     Turn a ctr data object into dictionary of arrays
+
+    Outputs:
+    --------
+    * dictionary with:
+      - 'npts' number of points
+      - 'columns' dictionary of point arrays, ie all the
+        columns of ctr.data (see ctr_data.CTR_DTYPE), the labels,
+        and 'corr_id' the index of each points corr_params in
+        the 'corr_params' list
+      - 'corr_params' list of the unique corr_params dictionaries
+        (as repr strings)
+      - 'bad' list of bad points
+      - 'rock_params' the rocking scan parameters (repr string of
+        the point index -> params dictionary, empty if no rocking scans)
     """
     if not isinstance(ctr,ctr_data.CtrData):
         print "Warning data is not a CtrData instance"
     npts = len(ctr.L)
+    d = {'npts':npts,'columns':{},'bad':list(ctr.bad)}
+    data = ctr.data
+    for name in data.dtype.names:
+        d['columns'][name] = data[name]
+    for (lbl,key) in (('I_lbl','I'),('Inorm_lbl','Inorm'),
+                      ('Ierr_lbl','Ierr'),('Ibgr_lbl','Ibgr')):
+        d['columns'][lbl] = num.array(ctr.labels[key][:npts],dtype=str)
+    # unique corr_params (points often share the same dictionary)
+    ids = {}
+    d['corr_params'] = []
+    corr_id = num.zeros(npts,dtype=int)
+    for j in range(npts):
+        cp  = ctr.corr_params[j]
+        key = id(cp)
+        if key not in ids:
+            ids[key] = len(d['corr_params'])
+            d['corr_params'].append(repr(_to_builtin(cp)))
+        corr_id[j] = ids[key]
+    d['columns']['corr_id'] = corr_id
+    d['rock_params'] = ''
+    if len(getattr(ctr,'rock_params',{})) > 0:
+        d['rock_params'] = repr(_to_builtin(ctr.rock_params))
+    return d
+
+def _to_builtin(x):
+    """
+    convert numpy arrays/values in (nested) dicts and lists to python
+    types so they can be written (and read back) as repr strings
+    """
+    if type(x) == types.DictType:
+        return dict([(k,_to_builtin(v)) for (k,v) in x.items()])
+    elif type(x) in (types.ListType,types.TupleType):
+        return type(x)([_to_builtin(v) for v in x])
+    elif isinstance(x,num.ndarray):
+        return _to_builtin(x.tolist())
+    elif isinstance(x,num.generic):
+        return x.item()
+    return x
+
+################################################################################
+def read_ctrdata(fname,setname='ctr',path=None,scans=True,lazy=False):
+    """
+    Read ctr data
+
+    Parameters:
+    -----------
+    * fname is the file name
+    * setname is the name of the ctr set in the file (see list_ctrdata)
+    * path is the file path
+    * scans is a flag to also read the scan (and image) data
+      (needed to re-integrate the data)
+    * lazy is a flag to return a CtrArchive instance rather than
+      reading the data (see CtrArchive)
+
+    Outputs:
+    --------
+    * CtrData instance (or CtrArchive instance if lazy = True)
+    """
+    if lazy:
+        return CtrArchive(fname,setname=setname,path=path)
+    h = get_file(fname,path,mode='r')
+    if h == None: return
+    try:
+        ctr = _read_ctr(h,setname,scans=scans)
+    except:
+        _cleanup()
+        print "Unable to read ctrdata"
+        return
+    h.close()
+    return ctr
+
+def list_ctrdata(fname,path=None,display=True):
+    """
+    List the ctr data sets in a file
+
+    Outputs:
+    --------
+    * if display is False returns a list of (setname,version,npts)
+    """
+    h = get_file(fname,path,mode='r')
+    if h == None: return
+    ll = []
+    if hasattr(h.root,'ctr_data'):
+        for name in sorted(h.root.ctr_data._v_children.keys()):
+            grp = h.getNode('/ctr_data',name)
+            version = _ctr_version(grp)
+            if version > 0:
+                npts = int(grp._v_attrs.npts)
+            else:
+                npts = len(grp.L)
+            ll.append((name,version,npts))
+    h.close()
+    if display:
+        for (name,version,npts) in ll:
+            print "%s: version=%i, npts=%i" % (name,version,npts)
+        return
+    return ll
+
+def _ctr_version(grp):
+    """ archive version of a ctr_data group """
+    if 'version' in grp._v_attrs._f_list():
+        return int(grp._v_attrs.version)
+    return 0
+
+def _read_ctr(h,setname,scans=True,columns=None):
+    """
+    Read a ctr set and return a CtrData instance.  columns may
+    be a dictionary of point arrays that have already been read
+    """
+    grp = h.getNode('/ctr_data',setname)
+    version = _ctr_version(grp)
+    if version == 0:
+        d = _read_ctr_v0(h,grp)
+    else:
+        d = _read_ctr_v1(h,grp,columns=columns)
+    scan_list = []
+    if scans:
+        for name in d['scan_sets']:
+            scan_list.append(_read_scan_obj(h,name))
+    ctr = ctr_data.CtrData()
+    ctr.scan = scan_list
+    ctr.bad  = d['bad']
+    ctr._append_points(d)
+    return ctr
+
+def _read_ctr_v1(h,grp,columns=None):
+    """
+    read a (version 1) ctr set into the format used by
+    CtrData._append_points
+    """
+    if columns == None: columns = {}
+    npts  = int(grp._v_attrs.npts)
+    names = grp._v_children.keys()
+    def _col(name):
+        if name in columns: return columns[name]
+        return grp._v_children[name].read()
     d = {}
-    d['bad']        = ctr.bad
-    d['scan_index'] = ctr.scan_index
-    d['scan_type']  = ctr.scan_type
-    d['I_lbl']      = ctr.labels['I']
-    d['In_lbl']     = ctr.labels['Inorm']
-    d['Ie_lbl']     = ctr.labels['Ierr']
-    d['Ib_lbl']     = ctr.labels['Ibgr']
-    d['H']  = ctr.H   
-    d['K']  = ctr.K     
-    d['L']  = ctr.L    
-    d['I']  = ctr.I     
-    d['In'] = ctr.Inorm 
-    d['Ie'] = ctr.Ierr  
-    d['Ib'] = ctr.Ibgr  
-    d['c']  = ctr.ctot  
-    d['F']  = ctr.F     
-    d['Fe'] = ctr.Ferr
-    #
-    d['beam_slit_horz'] = []
-    d['beam_slit_vert'] = []
-    d['det_slit_horz'] = []
-    d['det_slit_vert'] = []
-    d['geom'] = []
-    d['scale'] = []
-    d['sdia'] = []
-    d['spoly'] = []
-    d['sangle'] = []
+    if npts > 0:
+        for name in ctr_data.CTR_COLUMNS + ['scan_index','scan_type']:
+            d[name] = _col(name)
+        for lbl in ('I_lbl','Inorm_lbl','Ierr_lbl','Ibgr_lbl'):
+            d[lbl] = [str(x) for x in _col(lbl)]
+        if 'int_hash' in names and 'corr_hash' in names:
+            d['int_hash']  = _col('int_hash')
+            d['corr_hash'] = _col('corr_hash')
+        corr_id = _col('corr_id')
+    else:
+        for name in ctr_data.CTR_COLUMNS + ['scan_index','scan_type']:
+            d[name] = []
+        for lbl in ('I_lbl','Inorm_lbl','Ierr_lbl','Ibgr_lbl'):
+            d[lbl] = []
+        corr_id = []
+    d['scan_type'] = [str(x) for x in d['scan_type']]
+    if 'corr_params' in names:
+        cps = [ast.literal_eval(str(x)) for x in grp.corr_params.read()]
+    else:
+        cps = []
+    d['corr_params'] = [cps[j] for j in corr_id]
+    if 'bad' in names:
+        d['bad'] = [int(j) for j in grp.bad.read()]
+    else:
+        d['bad'] = []
+    if 'scan_sets' in names:
+        d['scan_sets'] = [str(x) for x in grp.scan_sets.read()]
+    else:
+        d['scan_sets'] = []
+    if 'rock_params' in names:
+        rp = ast.literal_eval(str(grp.rock_params.read()[0]))
+        d['rock_params'] = [rp.get(j) for j in range(npts)]
+    return d
+
+def _read_ctr_v0(h,grp):
+    """
+    read a ctr set written before the archive was versioned
+    """
+    names = grp._v_children.keys()
+    def _col(name):
+        if name in names:
+            return grp._v_children[name].read()
+        return None
+    d = {}
+    for name in ctr_data.CTR_COLUMNS + ['scan_index','scan_type']:
+        d[name] = _col(name)
+    npts = len(d['L'])
+    for (lbl,name) in (('I_lbl','Ilbl'),('Inorm_lbl','Inorm_lbl'),
+                       ('Ierr_lbl','Ierr_lbl'),('Ibgr_lbl','Ibgr_lbl')):
+        d[lbl] = [str(x) for x in _col(name)]
+    d['scan_type'] = [str(x) for x in d['scan_type']]
+    # rebuild the corr params
+    sangle = {}
+    for name in names:
+        if name.startswith('sangle_'):
+            sangle[name[7:]] = _col(name)
+    d['corr_params'] = []
     for j in range(npts):
-        d['geom'].append(ctr.corr_params[j].get('geom',''))
-        d['scale'].append(ctr.corr_params[j].get('scale',1.0))
-        if ctr.corr_params[j]['beam_slits'] != None:
-            d['beam_slit_horz'].append(ctr.corr_params[j]['beam_slits'].get('horz',0.))
-            d['beam_slit_vert'].append(ctr.corr_params[j]['beam_slits'].get('vert',0.))
-        else:
-            d['beam_slit_horz'].append(0.)
-            d['beam_slit_vert'].append(0.)
-        if ctr.corr_params[j]['det_slits'] != None:
-            d['det_slit_horz'].append(ctr.corr_params[j]['det_slits'].get('horz',0.))
-            d['det_slit_vert'].append(ctr.corr_params[j]['det_slits'].get('vert',0.))
-        else:
-            d['det_slit_horz'].append(0.)
-            d['det_slit_vert'].append(0.)
-        d['sdia'].append(ctr.corr_params[j]['sample'].get('dia',0.0))
-        d['spoly'].append(ctr.corr_params[j]['sample'].get('polygon',0.0))
-        d['sangle'].append(ctr.corr_params[j]['sample'].get('angles',0.0))
-    if type(d['sangle'][0]) == types.DictType:
-        tmp = {}
-        names = d['sangle'][0].keys()
-        for key in names:
-            tmp[key] = []
-        for sa in d['sangle']:
-            for key in names:
-                tmp[key].append(sa.get(key,0.))
-        d['sangle'] = tmp
+        cp = {'geom':str(_col('geom')[j]),'scale':_col('scale')[j]}
+        # zero was written for missing slits, dia or polygon
+        for (key,name) in (('beam_slits','beam_slit'),('det_slits','det_slit')):
+            (horz,vert) = (_col(name+'_horz')[j],_col(name+'_vert')[j])
+            if horz == 0.0 and vert == 0.0:
+                cp[key] = None
+            else:
+                cp[key] = {'horz':horz,'vert':vert}
+        sample = {}
+        if _col('sdia')[j] != 0.0:
+            sample['dia'] = _col('sdia')[j]
+        spoly = _col('spoly')
+        if spoly is not None and num.ndim(spoly[j]) > 0:
+            sample['polygon'] = spoly[j]
+        if len(sangle) > 0:
+            sample['angles'] = dict([(k,v[j]) for (k,v) in sangle.items()])
+        cp['sample'] = sample
+        d['corr_params'].append(_to_builtin(cp))
+    if 'bad' in names:
+        d['bad'] = [int(j) for j in grp.bad.read()]
+    else:
+        d['bad'] = []
+    # scan sets were written as setname_Sxxx
+    d['scan_sets'] = []
+    if hasattr(h.root,'scan_data'):
+        prefix = grp._v_name + '_S'
+        d['scan_sets'] = sorted([n for n in h.root.scan_data._v_children.keys()
+                                 if n.startswith(prefix)])
     return d
 
+################################################################################
+class CtrArchive:
+    """
+    Lazy access to a ctr data set in an hdf archive.  The file is
+    kept open (read only) and columns are only read when requested.
+
+    Example:
+    --------
+    >>arc = CtrArchive('ctr.h5',setname='ctr')
+    >>arc.keys()
+    >>L = arc['L']               # read a column
+    >>F = arc.column('F')[0:100] # read part of a column
+    >>ctr = arc.get_ctr()        # read everything -> CtrData
+    >>arc.close()
+    """
+    def __init__(self,fname,setname='ctr',path=None):
+        self.h = get_file(fname,path,mode='r')
+        self.setname = setname
+        self.grp     = self.h.getNode('/ctr_data',setname)
+        self.version = _ctr_version(self.grp)
+        self._cache  = {}
+
+    def __repr__(self,):
+        lout = "CTR ARCHIVE %s:%s\n" % (self.h.filename,self.setname)
+        lout = "%sVersion = %i\n" % (lout,self.version)
+        lout = "%sNumber of points = %i\n" % (lout,len(self))
+        return lout
+
+    def __len__(self,):
+        if self.version > 0:
+            return int(self.grp._v_attrs.npts)
+        return len(self.grp.L)
+
+    def keys(self,):
+        """ list of the column names """
+        return sorted(self.grp._v_children.keys())
+
+    def column(self,name):
+        """ return the hdf node of a column (supports slicing) """
+        return self.grp._v_children[name]
+
+    def __getitem__(self,name):
+        """ read a column (the result is cached) """
+        if name not in self._cache:
+            self._cache[name] = self.column(name).read()
+        return self._cache[name]
+
+    def get_ctr(self,scans=True):
+        """ read the data set and return a CtrData instance """
+        return _read_ctr(self.h,self.setname,scans=scans,columns=self._cache)
+
+    def close(self,):
+        self._cache = {}
+        self.h.close()
+
 ################################################################################
 def write_scandata(fname,data,setname=None,path=None,overwrite=True):
     """
@@ -508,7 +771,7 @@ def read_scandata(file,setname,path=None):
     """
     Read data
     """
-    h = get_file(file,path)
+    h = get_file(file,path,mode='r')
     if h==None: return
     data = _read_scan(h,setname)
     h.close()
@@ -523,15 +786,119 @@ def _read_scan(h,setname):
     try:
         grp = '/scan_data/' + setname
         #items = getattr(h,grp)
-        items  = h.getNode('/scans',setname)
+        items  = h.getNode('/scan_data',setname)
         names = items._v_children.keys()
     except:
         return data
     for n in names:
         node  = h.getNode(grp,n)
-        data[n] = node.read()
+        if isinstance(node,tables.Group):
+            data[n] = {}
+            for (name,child) in node._v_children.items():
+                data[n][name] = child.read()
+        else:
+            data[n] = node.read()
     return data
 
+def _read_scan_obj(h,setname):
+    """
+    read a scan set (and its images) into a ScanData instance
+    """
+    d = _read_scan(h,setname)
+    image = None
+    if hasattr(h.root,'image_data'):
+        if setname in h.root.image_data._v_children.keys():
+            image = _read_image(h,setname)
+    primary_axis = [str(x) for x in d.get('primary_axis',[])]
+    primary_det  = [str(x) for x in d.get('primary_det',[])]
+    scan = scan_data.ScanData(name=str(d.get('name','')),
+                              dims=[int(x) for x in d.get('dims',[])],
+                              scalers=d.get('scalar',{}),
+                              positioners=d.get('positioners',{}),
+                              primary_axis=primary_axis,
+                              primary_det=primary_det,
+                              state=d.get('state',{}),
+                              image=image)
+    return scan
+
+def _read_image(h,setname):
+    """
+    read image data (see _image_data) into an ImageScan instance
+    """
+    grp    = h.getNode('/image_data',setname)
+    nodes  = grp._v_children
+    images = [num.array(im) for im in nodes['images'].read()]
+    im = image_data.ImageScan(image=images)
+    npts = len(images)
+    im.rois     = [list(r) for r in nodes['rois'].read()]
+    im.rotangle = list(nodes['rotangle'].read())
+    im.im_max   = list(nodes['im_max'].read())
+    for key in im.peaks.keys():
+        if key in nodes:
+            im.peaks[key] = num.array(nodes[key].read(),dtype=float)
+    for key in image_data.IMG_BGR_PARAMS.keys():
+        if key in nodes:
+            val = nodes[key].read()
+            for j in range(npts):
+                im.bgrpar[j][key] = _to_builtin(val[j])
+    im._is_integrated = True
+    return im
+
+################################################################################
+def test_ctr_archive(npts=50):
+    """
+    Write a CtrData set to a (version 1) archive and check that
+    read_ctrdata and CtrArchive return the same data
+    """
+    import tempfile
+    r = num.random.RandomState(0)
+    cp1 = {'geom':'psic','scale':1.e6,'beam_slits':{'horz':.6,'vert':.8},
+           'det_slits':{'horz':2.,'vert':1.5},'sample':{'dia':3.}}
+    cp2 = {'geom':'psic','scale':1.,'beam_slits':{'horz':.6,'vert':.8},
+           'det_slits':None,'sample':{'polygon':[[1.,1.],[-1.,1.],[-1.,-1.]],
+                                      'angles':{'phi':108.,'chi':0.48}}}
+    d = {}
+    for name in ctr_data.CTR_COLUMNS:
+        d[name] = r.uniform(0.,10.,npts)
+    d['scan_index'] = [(j/10,j%10) for j in range(npts)]
+    d['scan_type']  = ['image']*(npts-1) + ['phi']
+    d['I_lbl']      = ['I']*npts
+    d['Inorm_lbl']  = ['io']*npts
+    d['Ierr_lbl']   = ['Ierr']*npts
+    d['Ibgr_lbl']   = ['Ibgr']*npts
+    d['corr_params'] = [cp1]*(npts/2) + [cp2]*(npts - npts/2)
+    d['rock_params'] = [None]*(npts-1) + [{'axis':'phi','method':'fit',
+                                           'nbgr':3,'flor':0.0}]
+    ctr = ctr_data.CtrData()
+    ctr._append_points(d)
+    ctr.bad = [3,7]
+    (fd,fname) = tempfile.mkstemp(suffix='.h5')
+    os.close(fd)
+    os.remove(fname)
+    try:
+        write_ctrdata(fname,ctr,scans=False)
+        ctr2 = read_ctrdata(fname,scans=False)
+        arc  = read_ctrdata(fname,lazy=True)
+        try:
+            assert arc.version == CTR_ARCHIVE_VERSION, "archive version"
+            assert num.allclose(arc['F'],ctr.F), "lazy column"
+        finally:
+            arc.close()
+    finally:
+        if os.path.exists(fname): os.remove(fname)
+    (data,data2) = (ctr.data,ctr2.data)
+    for name in data.dtype.names:
+        if data.dtype[name].kind == 'f':
+            ok = num.allclose(data[name],data2[name],equal_nan=True)
+        else:
+            ok = num.array_equal(data[name],data2[name])
+        assert ok, "column %s" % name
+    assert ctr2.labels == ctr.labels, "labels"
+    assert ctr2.corr_params == ctr.corr_params, "corr_params"
+    assert ctr2.corr_params[0] is ctr2.corr_params[1], "shared corr_params"
+    assert ctr2.bad == ctr.bad, "bad points"
+    assert ctr2.rock_params == ctr.rock_params, "rock_params"
+    print "ctr archive round trip ok"
 
 ################################################################################
 ################################################################################
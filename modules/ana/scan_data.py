@@ -7,7 +7,7 @@ Authors/Modifications:
 
 Todo:
 -----
-* Check on the merge and append methods
+* Check on the append method
 """
 #######################################################################
 
@@ -20,6 +20,10 @@ from tdl.modules.ana import image_data
 from tdl.modules.ana import xrf_data
 from tdl.modules.spectra import deadtime
 
+#######################################################################
+# containers searched by ScanData.__getitem__, in order of precedence
+LABEL_SOURCES = ['xrf','image','scalers','positioners','state']
+
 #######################################################################
 class ScanData:
     """
@@ -44,6 +48,16 @@ class ScanData:
     * xrf = XrfScan object, holds one xrf instance per point
     * image = ImageScan object, holds one image instance per point
 
+    Data are accessed by label, ie scan['io'], which searches the
+    xrf peaks, image peaks, scalers, positioners and state (in that
+    order).  The labels are resolved through an index (label ->
+    container).  The index is kept up to date by __setitem__ and is
+    rebuilt when a container is replaced or a label is not found in
+    the index (or no longer in its container), so a lookup of a known
+    label does not depend on the number of labels.  If labels are
+    added directly to one of the containers that shadow a label of
+    another container, call reindex.  Use get_columns to get several
+    arrays at once.
     """
     ################################################################
     def __init__(self,name='',dims=[],scalers={},positioners={},
@@ -94,23 +108,82 @@ class ScanData:
                 self.image = image_data.ImageScan(image=image,rois=image_rois)
 
     ########################################################################
-    """
+    def __getstate__(self,):
+        """
+        pickle without the label index
+        """
+        state = self.__dict__.copy()
+        state.pop('_label_index',None)
+        state.pop('_label_sig',None)
+        return state
+
+    ########################################################################
+    def _label_containers(self,):
+        """
+        Return a list of (source,container) in order of precedence
+        """
+        out = []
+        for src in LABEL_SOURCES:
+            if src in ('xrf','image'):
+                if hasattr(self,src):
+                    out.append((src,getattr(self,src).peaks))
+            else:
+                out.append((src,getattr(self,src)))
+        return out
+
+    def _get_label_index(self,):
+        """
+        Return the label index, rebuilt if any of the containers
+        were replaced
+        """
+        if getattr(self,'_label_sig',None) != _label_sig(self._label_containers()):
+            self.reindex()
+        return self._label_index
+
+    def _find_label(self,arg):
+        """
+        Return the container that holds label arg (or None).  The
+        index is rebuilt once if arg is not in the index or its
+        container no longer holds it (ie labels added/removed/renamed)
+        """
+        c = self._get_label_index().get(arg)
+        if (c == None) or (arg not in c):
+            self.reindex()
+            c = self._label_index.get(arg)
+        return c
+
+    def reindex(self,):
+        """
+        Rebuild the label index
+        """
+        cont  = self._label_containers()
+        index = {}
+        # lowest precedence first so higher precedence wins
+        for (src,c) in cont[::-1]:
+            for key in c.keys():
+                index[key] = c
+        self._label_index = index
+        self._label_sig   = _label_sig(cont)
+
+    ########################################################################
     def __setitem__(self,arg,val):
-        # note this currenlty craps for sub arrays.
-        # ie x[0][0].  In such a case arg is a tuple
-        # first is the name, the rest are the subscripts
-        # but it could work using x['a',10]=100 etc...
-        
-        #print arg, type(arg)
-        #print val, type(val)
-        if type(arg) == types.StringType:
-            if arg.startswith("_"):
-                raise TypeError, "Private attribute"
-        #if hasattr(self,arg):
-        #    setattr(self,arg,val)
-        setattr(self,arg,val)
-        return
-    """
+        """
+        Set items.  If the label exists the value is replaced in
+        the container that holds it, new labels are added to scalers
+        """
+        if type(arg) != types.StringType:
+            raise TypeError, "Label must be a string"
+        c = self._find_label(arg)
+        if c != None:
+            c[arg] = val
+            return
+        # new label, add to scalers and the index
+        self.scalers[arg] = val
+        self._label_index[arg] = self.scalers
+
+    def __contains__(self,arg):
+        return self._find_label(arg) != None
+
     ########################################################################
     def __getitem__(self,arg):
         """
@@ -118,28 +191,9 @@ class ScanData:
         spectra, images, scalers, positioners, state
         """
         if type(arg) == types.StringType:
-            #if arg.startswith("_"):
-            #    raise TypeError, "Private attribute"
-            #return getattr(self,arg)
-            if hasattr(self,'xrf'):
-                for key in self.xrf.peaks.keys():
-                    if key == arg:
-                        return self.xrf.peaks[key]
-            #
-            if hasattr(self,'image'):
-                for key in self.image.peaks.keys():
-                    if key == arg:
-                        return self.image.peaks[key]
-            #
-            for key in self.scalers.keys():
-                if key == arg:
-                    return self.scalers[key]
-            for key in self.positioners.keys():
-                if key == arg:
-                    return self.positioners[key]
-            for key in self.state.keys():
-                if key == arg:
-                    return self.state[key]
+            c = self._find_label(arg)
+            if c != None:
+                return c.get(arg)
         elif type(arg) == types.TupleType:
             # handle data['med',2] etc...
             if len(arg) == 2:
@@ -197,6 +251,49 @@ class ScanData:
         #
         return lout
     
+    ################################################################
+    def get_columns(self,labels,points=None):
+        """
+        Return the data for several labels as a single 2D array
+
+        Parameters:
+        -----------
+        * labels is a list of labels (see __getitem__)
+        * points is an optional list of scan points (default is all)
+
+        Outputs:
+        --------
+        * array (len(labels) x npts), row j holds scan[labels[j]]
+          (npts = len(points) if points are given).
+          Single values (eg positioners that are not scanned) are
+          repeated for all points.
+
+        Example:
+        --------
+        >>(I,io,Ierr) = scan.get_columns(['I','io','Ierr'])
+        """
+        npts = int(num.prod(self.dims))
+        if points is not None:
+            points = num.asarray(points,dtype=int)
+            out = num.empty((len(labels),len(points)),dtype=float)
+        else:
+            out = num.empty((len(labels),npts),dtype=float)
+        for (j,lbl) in enumerate(labels):
+            c = self._find_label(lbl)
+            if c == None:
+                raise KeyError, "Unknown label '%s'" % lbl
+            val = num.ravel(c[lbl])
+            if len(val) == 1:
+                out[j] = val[0]
+            elif len(val) != npts:
+                raise ValueError, "Label '%s' has %i values, expected %i" % \
+                      (lbl,len(val),npts)
+            elif points is not None:
+                out[j] = val[points]
+            else:
+                out[j] = val
+        return out
+
     ################################################################
     def get_scaler(self,label=None):
         """
@@ -215,6 +312,12 @@ class ScanData:
             label = self.primary_axis[0]
         return self.positioners.get(label)
 
+def _label_sig(cont):
+    """
+    signature of the label containers (identity only)
+    """
+    return tuple([(src,id(c)) for (src,c) in cont])
+
 ########################################################################
 def append(data1,data2,sort=True):
     """
@@ -352,7 +455,48 @@ def merge(data=[],average=True,align=False,fast=True):
     Merge a list of ScanData instances
 
     This works for one dimensional data
-    
+
+    Parameters:
+    -----------
+    * data is a list of ScanData instances (repeated scans)
+    * average is a flag, if True the scalers and peaks (xrf and
+      image integrated quantities), the images and the med spectra
+      are averaged, otherwise they are summed
+    * align is a flag, if True the data of each scan are interpolated
+      onto the primary axis of the first scan
+    * fast is not used (kept for compatibility)
+
+    Outputs:
+    --------
+    * a new ScanData instance
+
+    Notes:
+    ------
+    For each scan a linear interpolation operator (from its own
+    primary axis to that of the first scan) is built once and applied
+    to all of its scalers, peaks, med spectra and images.  Points
+    outside the range of a scan take the value of its first/last
+    point.  Without align the operator is the identity (the scans
+    must have the same number of points).
+
+    Labels containing 'err' (eg 'Ierr', 'Ierr_c') and the xrf peak
+    errors are treated as standard deviations, they are added in
+    quadrature (and divided by the number of scans for the average).
+    Positioners are always averaged.  When align is True the primary
+    axis (scaler or positioner) is that of the first scan.  Scalers/positioners that are
+    not scanned (length != npts) and the state are returned as a
+    list of the values of each scan.
+
+    The med spectra are summed or averaged along with the real/live
+    times and total/input counts, so count rates are preserved (the
+    averaged spectra are rounded to integer counts).  The deadtime
+    corrections are recomputed from the merged counts with the taus
+    of the first scan.
+
+    Example:
+    --------
+    >>m = merge([s1,s2,s3],average=True,align=True)
+    >>pyplot.plot(m['energy'],m['I']/m['io'])
     """
     ndat = len(data)
     if ndat < 2: return None
@@ -368,124 +512,268 @@ def merge(data=[],average=True,align=False,fast=True):
             print "Warning primary axis doesnt match "
         if d.primary_det != data[0].primary_det:
             print "Warning primary detector doesnt match "
-        if d.xrf_lines != data[0].xrf_lines:
-            print "Warning xrf lines dont match"
-        if d.image_rois != data[0].image_rois:
-            print "Warning image rois dont match"
+        if hasattr(d,'xrf') and hasattr(data[0],'xrf'):
+            if d.xrf.lines != data[0].xrf.lines:
+                print "Warning xrf lines dont match"
+        if hasattr(d,'image') and hasattr(data[0],'image'):
+            if d.image.rois != data[0].image.rois:
+                print "Warning image rois dont match"
+        if (align == False) and (d.dims[0] != data[0].dims[0]):
+            print "Scans must have the same number of points (or use align)"
+            return
         if len(name) == 0:
             name = "%s" % d.name
         else:
             name = "%s, %s" % (name, d.name)
         
     # init
-    data_m      = ScanData()
-    data_m.name = name
-    data_m.dims = data[0].dims
-    npts        = data[0].dims[0]
+    data_m      = ScanData(name=name,dims=copy.copy(data[0].dims),
+                           scalers={},positioners={},state={})
+    npts        = int(data[0].dims[0])
     paxis = data_m.primary_axis = copy.copy(data[0].primary_axis)
     pdet  = data_m.primary_det  = copy.copy(data[0].primary_det)
 
-    # the primary axis of data[0] sets the primary
-    # axis of data_m when align is true
+    # one interpolation operator per scan, the primary axis of
+    # data[0] sets the primary axis of data_m when align is true
     if align:
-        newx = data[0][paxis]
+        newx = num.asarray(data[0][paxis[0]],dtype=float)
+        ops  = [_InterpOperator(d[paxis[0]],newx) for d in data]
     else:
-        newx = None
+        ops  = [_InterpOperator(None,npts) for d in data]
 
-    # sum/average scalers
-    for key in data[0].scalers.keys():
-        tmp = []
-        for j in range(ndat):
-            if j == 0:
-                tmp.append(num.array(data[j].scalers[key]))
-            else:
-                s = num.array(data[j].scalers[key])
-                if align and (len(s) == npts):
-                    oldx = data[j][paxis]
-                    s = _spline_interpolate(oldx,s,newx,fast=fast)
-                tmp.append(s)
-        if len(tmp[0]) == npts:
-            tmp = num.sum(tmp,0)
-            if average:
-                tmp = tmp / (1.0*ndat)
-        data_m.scalers.update({key:tmp})
-
-
-    # average positioners
-    for key in data[0].positioners.keys():
-        tmp = []
-        for j in range(ndat):
-            if j == 0:
-                tmp.append(num.array(data[j].positioners[key]))
-            else:
-                s = num.array(data[j].positioner[key])
-                if align and (len(s) == npts):
-                    # does this work for positioners?
-                    oldx = data[j][paxis]
-                    s = _spline_interpolate(oldx,s,newx,fast=fast)
-                tmp.append(s)
-        if len(tmp[0]) == npts:
-            tmp = num.sum(tmp,0)
-            # always average
-            tmp = tmp / (1.0*ndat)
-        data_m.scalers.update({key:tmp})
+    # scalers
+    merged = _merge_dict([d.scalers for d in data],ops,npts,average)
+    data_m.scalers.update(merged)
+
+    # positioners, always averaged
+    merged = _merge_dict([d.positioners for d in data],ops,npts,True)
+    data_m.positioners.update(merged)
+
+    # the aligned primary axis (may be a scaler or a positioner)
+    if align:
+        if paxis[0] in data_m.scalers:
+            data_m.scalers[paxis[0]] = newx.copy()
+        else:
+            data_m.positioners[paxis[0]] = newx.copy()
 
     # combine state info,
     # these are not summed/averaged!  
     for key in data[0].state.keys():
         tmp = []
         for j in range(ndat):
-            tmp.append(data[j].state[key])
+            tmp.append(data[j].state.get(key))
         data_m.state.update({key:tmp})
 
-    # append meds, xrfs, images...
-    data_m.xrf_lines = data[0].xrf_lines
-    data_m.image_rois = data[0].image_rois
+    # xrf peaks and errors, the xrf fits are not merged
+    if _has_all(data,'xrf'):
+        xrf = xrf_data.XrfScan(xrf=[],lines=copy.copy(data[0].xrf.lines))
+        xrf.peaks  = _merge_dict([d.xrf.peaks for d in data],
+                                 ops,npts,average)
+        xrf.errors = _merge_dict([getattr(d.xrf,'errors',{}) for d in data],
+                                 ops,npts,average,err=True)
+        data_m.xrf = xrf
 
-    # should we try to sum the spectra (and images)?
-    for j in range(ndat):
-        data_m.med.append(data[j].med)
-        data_m.xrf.append(data[j].xrf)
-        data_m.image.append(data[j].image)
-        
+    # med spectra
+    if _has_all(data,'med'):
+        data_m.med = _merge_med([d.med for d in data],ops,average)
+
+    # images and the image integrated quantities
+    if _has_all(data,'image'):
+        data_m.image = _merge_image([d.image for d in data],ops,average)
 
-    # treat peaks etc same as scalers....
-    for key in data[0].xrf_peaks.keys():
-        tmp = []
-        for j in range(ndat):
-            if j == 0:
-                tmp.append(num.array(data[j].xrf_peaks[key]))
-            else:
-                s = num.array(data[j].xrf_peaks[key])
-                if align and (len(s) == npts):
-                    oldx = data[j][paxis]
-                    s = _spline_interpolate(oldx,s,newx,fast=fast)
-                tmp.append(s)
-        if len(tmp[0]) == npts:
-            tmp = num.sum(tmp,0)
-            if average:
-                tmp = tmp / (1.0*ndat)
-        data_m.xrf_peaks.update({key:tmp})
-
-    for key in data[0].image_peaks.keys():
-        tmp = []
-        for j in range(ndat):
-            if j == 0:
-                tmp.append(num.array(data[j].image_peaks[key]))
-            else:
-                s = num.array(data[j].image_peaks[key])
-                if align and (len(s) == npts):
-                    oldx = data[j][paxis]
-                    s = _spline_interpolate(oldx,s,newx,fast=fast)
-                tmp.append(s)
-        if len(tmp[0]) == npts:
-            tmp = num.sum(tmp,0)
-            if average:
-                tmp = tmp / (1.0*ndat)
-        data_m.image_peaks.update({key:tmp})
-        
     return data_m
 
+def _has_all(data,attr):
+    """
+    True if all scans have attr
+    """
+    for d in data:
+        if not hasattr(d,attr): return False
+    return True
+
+########################################################################
+class _InterpOperator:
+    """
+    Linear interpolation from the points of one scan onto
+    new x values, ie y_new = w0*y[i0] + w1*y[i1]. 
+
+    The operator is built once per scan and applied along the
+    first axis of any array with the scan dimension (scalers,
+    stacks of spectra, images...).
+    """
+    def __init__(self,oldx,newx):
+        """
+        * oldx is the primary axis of the scan
+        * newx are the new x values.  If oldx is None newx is the
+          number of points and the operator is the identity
+        """
+        if oldx is None:
+            self.identity = True
+            self.npts_old = int(newx)
+            self.npts = int(newx)
+            return
+        oldx = num.asarray(oldx,dtype=float)
+        newx = num.asarray(newx,dtype=float)
+        self.npts_old = len(oldx)
+        self.npts = len(newx)
+        self.identity = (len(oldx) == len(newx)) and num.all(oldx == newx)
+        if self.identity: return
+        # sort the scan axis (eg scans run in the reverse direction)
+        srt  = num.argsort(oldx,kind='mergesort')
+        x    = oldx[srt]
+        if len(x) < 2:
+            i0 = num.zeros(len(newx),dtype=int)
+            self.i0 = srt[i0]
+            self.i1 = srt[i0]
+            self.w0 = num.ones(len(newx))
+            self.w1 = num.zeros(len(newx))
+            return
+        k    = num.clip(num.searchsorted(x,newx) - 1,0,len(x)-2)
+        dx   = x[k+1] - x[k]
+        dx   = num.where(dx == 0,1.,dx)
+        w1   = num.clip((newx - x[k])/dx,0.,1.)
+        self.i0 = srt[k]
+        self.i1 = srt[k+1]
+        self.w0 = 1. - w1
+        self.w1 = w1
+
+    def apply(self,y):
+        """
+        Interpolate the array y (first axis is the scan points)
+        """
+        y = num.asarray(y)
+        if self.identity: return y
+        shp = (self.npts,) + (1,)*(y.ndim - 1)
+        out = y.take(self.i0,axis=0)*self.w0.reshape(shp)
+        out += y.take(self.i1,axis=0)*self.w1.reshape(shp)
+        return out
+
+    def apply_var(self,var):
+        """
+        Interpolate the variances var (uncorrelated errors)
+        """
+        var = num.asarray(var)
+        if self.identity: return var
+        shp = (self.npts,) + (1,)*(var.ndim - 1)
+        out = var.take(self.i0,axis=0)*(self.w0**2).reshape(shp)
+        out += var.take(self.i1,axis=0)*(self.w1**2).reshape(shp)
+        return out
+
+    def weights(self,j):
+        """
+        Return the list of (old point,weight) contributing to new point j
+        """
+        if self.identity: return [(j,1.)]
+        out = []
+        if self.w0[j] != 0: out.append((self.i0[j],self.w0[j]))
+        if self.w1[j] != 0: out.append((self.i1[j],self.w1[j]))
+        return out
+
+def _merge_dict(dicts,ops,npts,average,err=None):
+    """
+    Merge a list of dictionaries of arrays (see merge).  The
+    scanned arrays of each scan (length = npts of the scan) are
+    stacked into one 2D array and interpolated at once.  If err is
+    None labels containing 'err' are errors, otherwise err flags
+    if all the entries are errors
+    """
+    ndat = len(dicts)
+    out  = {}
+    for key in dicts[0].keys():
+        if err is None:
+            is_err = 'err' in key.lower()
+        else:
+            is_err = err
+        vals = [d.get(key) for d in dicts]
+        scanned = True
+        for (v,op) in zip(vals,ops):
+            if (v is None) or (num.ndim(v) != 1) or (len(v) != op.npts_old):
+                scanned = False
+                break
+        if not scanned:
+            # single (numeric) values are averaged
+            single = True
+            for v in vals:
+                if (v is None) or (num.ndim(v) != 0) or \
+                   (type(v) == types.StringType):
+                    single = False
+            if single:
+                out[key] = num.sum(num.asarray(vals,dtype=float))/ndat
+            else:
+                out[key] = vals
+            continue
+        if is_err:
+            tmp = num.zeros(npts)
+            for (v,op) in zip(vals,ops):
+                tmp = tmp + op.apply_var(num.asarray(v,dtype=float)**2)
+            tmp = num.sqrt(tmp)
+        else:
+            tmp = num.zeros(npts)
+            for (v,op) in zip(vals,ops):
+                tmp = tmp + op.apply(num.asarray(v,dtype=float))
+        if average:
+            tmp = tmp / (1.0*ndat)
+        out[key] = tmp
+    return out
+
+def _merge_med(meds,ops,average):
+    """
+    Sum/average med spectra (see merge)
+    """
+    keys = ('real_time','live_time','total_counts','input_counts')
+    data = 0.
+    cnts = {}
+    for key in keys: cnts[key] = 0.
+    for (m,op) in zip(meds,ops):
+        data = data + op.apply(m.get_data_stack())
+        c    = m.get_count_arrays()
+        for key in keys:
+            cnts[key] = cnts[key] + op.apply(c[key])
+    if average:
+        data = data / (1.0*len(meds))
+        for key in keys:
+            cnts[key] = cnts[key] / (1.0*len(meds))
+    # the meds of the first scan are on the new points
+    med  = copy.deepcopy(meds[0].med)
+    data = (data + 0.5).astype(num.int)
+    for j in range(len(med)):
+        for k in range(len(med[j].mca)):
+            mca = med[j].mca[k]
+            mca.data = data[j,k]
+            for key in keys:
+                setattr(mca,key,cnts[key][j,k])
+    med_m = med_data.MedScan(med=med)
+    med_m.update_deadtime()
+    return med_m
+
+def _merge_image(images,ops,average):
+    """
+    Sum/average images and image peaks (see merge)
+    """
+    npts = ops[0].npts
+    ndat = len(images)
+    img  = []
+    for j in range(npts):
+        tmp = 0.
+        for (im,op) in zip(images,ops):
+            for (p,w) in op.weights(j):
+                tmp = tmp + w*num.asarray(im.image[p],dtype=float)
+        if average:
+            tmp = tmp / (1.0*ndat)
+        img.append(tmp)
+    image_m = image_data.ImageScan(image=img)
+    # integration params of the first scan
+    image_m.rois     = copy.deepcopy(images[0].rois)
+    image_m.rotangle = copy.deepcopy(images[0].rotangle)
+    image_m.bgrpar   = copy.deepcopy(images[0].bgrpar)
+    peaks = _merge_dict([im.peaks for im in images],ops,npts,average)
+    image_m.peaks.update(peaks)
+    image_m._is_integrated = True
+    for im in images:
+        if im._is_integrated == False:
+            image_m._is_integrated = False
+    return image_m
+
 ################################################################################
 def _spline_interpolate(oldx, oldy, newx, smoothing=0.001,fast=True, **kw):
     """
@@ -551,18 +839,14 @@ def fit_deadtime(data,x='io',y='Med',norm='Seconds',offset=True,display=True):
             yfit_arr = yfit_arr * norm
         yfit_arr = [yfit_arr]
 
-    # do the fits
-    tau = []
-    a   = []
-    if offset: off = []
+    # do the fits, all detectors at once
+    params = deadtime.fit_array(xfit,yfit_arr,offset=offset)
+    tau = list(params[:,0])
+    a   = list(params[:,1])
+    if offset: off = list(params[:,2])
     else: off = None
-    for yfit in yfit_arr:
-        params = deadtime.fit(xfit,yfit,offset=offset)
-        tau.append(params[0])
-        a.append(params[1])
-        if offset:
-            off.append(params[2])
-        if display:  print params
+    if display:
+        for p in params: print p
 
     # update med taus...
     if y == 'Med':
@@ -574,13 +858,12 @@ def fit_deadtime(data,x='io',y='Med',norm='Seconds',offset=True,display=True):
 
     # show fits if wanted
     if display:
-        (ndet,npts) = yfit_arr.shape
+        (ndet,npts) = num.shape(yfit_arr)
         ycorr_arr   = num.zeros((ndet,npts))
         if y == 'Med':
-            for j in range(npts):
-                for k in range(ndet):
-                    cts = data.med.med[j].mca[k].get_data(correct=True)
-                    ycorr_arr[k][j] = cts.sum()
+            cor = data.med.get_cor_factors()[:,:,num.newaxis]
+            cts = (cor*data.med.get_data_stack() + 0.5).astype(num.int)
+            ycorr_arr = num.transpose(cts.sum(axis=2)).astype(float)
             if norm != None:
                 for k in range(ndet):
                     ycorr_arr[k] = ycorr_arr[k] * norm
@@ -632,8 +915,42 @@ def _display_deadtime_fit(xfit,yfit_arr,ycorr_arr,tau,a,off):
     pyplot.ylabel('y corrected ')
     pyplot.xlabel('x')
     
+########################################################################
+def test_label_index():
+    """
+    Check the label lookup, get_columns and the index updates
+    """
+    scan = ScanData(name='test',dims=[5],
+                    scalers={'io':num.arange(5.),'I':num.ones(5)},
+                    positioners={'phi':num.arange(5.)+10.,'chi':3.,
+                                 'io':num.zeros(5)},
+                    state={})
+    assert scan['io'][1] == 1., "scalers should take precedence"
+    cols = scan.get_columns(['io','chi','phi'],points=[1,3])
+    assert cols.shape == (3,2), "wrong get_columns shape"
+    assert num.all(cols == [[1.,3.],[3.,3.],[11.,13.]]), "wrong get_columns values"
+    assert scan.get_columns(['I']).shape == (1,5), "wrong get_columns shape"
+    try:
+        scan.get_columns(['nope'])
+        assert False, "get_columns should raise KeyError"
+    except KeyError:
+        pass
+    # new label through __setitem__
+    scan['new'] = num.arange(5.)*2.
+    assert scan.scalers['new'][2] == 4. and 'new' in scan, "new label not indexed"
+    # label renamed and removed in the container
+    scan.scalers['I2'] = scan.scalers.pop('I')
+    assert scan['I'] == None and scan['I2'][0] == 1., "rename not indexed"
+    del scan.scalers['io']
+    assert scan['io'][1] == 0., "removed label should fall back to positioners"
+    # replaced container
+    scan.scalers = {'zz':num.ones(5)}
+    assert scan['zz'][0] == 1. and scan['new'] == None, "replaced container not indexed"
+    print "label index ok"
+
 ########################################################################
 ########################################################################
 if __name__ == '__main__':
-    pass
+    """ test """
+    test_label_index()
 
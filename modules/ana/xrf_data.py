@@ -17,12 +17,14 @@ import sys
 import types
 import string
 import copy
+import multiprocessing
 import numpy as num
 
 from  tdl.modules.spectra import medfile_cars
 from  tdl.modules.spectra import medfile_emsa
 from  tdl.modules.spectra import calibration as calib
 from  tdl.modules.xrf.xrf_model import Xrf
+from  tdl.modules.xrf import xrf_bgr
 from  tdl.modules.ana.med_data import read, read_files   
 
 ##############################################################################
@@ -146,7 +148,8 @@ def _med2xrf(med,xrf_params={},lines=None,det_idx=0,emin=-1.,emax=-1.):
     return x
 
 #################################################################################
-def fit(xrf,xrf_params={},use_prev_fit=False,fit_init=-1,guess=False,verbose=True):
+def fit(xrf,xrf_params={},use_prev_fit=False,fit_init=-1,guess=False,verbose=True,
+        varpro=False,nproc=1):
     """
     Given a (list of) xrf objects fit them all
 
@@ -161,13 +164,29 @@ def fit(xrf,xrf_params={},use_prev_fit=False,fit_init=-1,guess=False,verbose=Tru
     * If fit_init >-1 and use_prev_fit=True then fit_init will only
       be used as the seed for fitting the first index only.
     * if guess is true the initial amplitudes will be guessed from the data
+    * if varpro is true the amplitudes are solved by linear least squares
+      at each step (see XrfSpectrum.fit)
+    * if nproc is not 1 the fits are distributed over nproc
+      worker processes, see fit_parallel
+
+    Outputs:
+    --------
+    * dictionary of results aligned with the list of xrf objects,
+      see fit_results.  A fit that raises an error is given
+      status = -1 (and the error message in err_string), the
+      remaining points are still fit.
     """
     if type(xrf) != types.ListType:
         xrf = [xrf]
+    if nproc != 1:
+        return fit_parallel(xrf,xrf_params=xrf_params,
+                            use_prev_fit=use_prev_fit,fit_init=fit_init,
+                            guess=guess,verbose=verbose,varpro=varpro,
+                            nproc=nproc)
 
     if fit_init >=0:
         if verbose: sys.__stdout__.write("Fitting index = %d\n" % fit_init)
-        xrf[fit_init].fit()
+        xrf[fit_init].fit(varpro=varpro)
         params = xrf[fit_init].get_params()
         init = True
     elif len(xrf_params) > 0:
@@ -183,8 +202,170 @@ def fit(xrf,xrf_params={},use_prev_fit=False,fit_init=-1,guess=False,verbose=Tru
             xrf[j].init(params=params)
         elif init:
             xrf[j].init(params=params,guess=guess)
-        xrf[j].fit()
-    return
+        _fit_point(xrf[j],varpro)
+    return fit_results(xrf)
+
+#################################################################################
+def fit_parallel(xrf,xrf_params={},use_prev_fit=False,fit_init=-1,guess=False,
+                 verbose=True,varpro=False,nproc=None,block_size=None):
+    """
+    Fit a list of xrf objects using a pool of worker processes
+
+    Parameters:
+    -----------
+    * xrf_params, fit_init, use_prev_fit, guess and varpro are the
+      same as for fit
+    * nproc is the number of worker processes (default is the
+      number of cpus)
+    * block_size is the number of consecutive points fit by
+      each task (default splits the points into 2*nproc blocks if
+      use_prev_fit is True, otherwise 4*nproc blocks)
+
+    Outputs:
+    --------
+    * dictionary of results aligned with the list of xrf objects,
+      see fit_results.  The xrf objects are also updated with the fits.
+
+    Notes:
+    ------
+    * The seed parameters are from fitting index fit_init (in this
+      process) or xrf_params, as in fit.
+    * If use_prev_fit is True each block is fit sequentially, each
+      point seeded from the previous one.  The fits are done in two
+      stages: first the even numbered blocks, with their first point
+      seeded from the seed parameters, then the odd numbered blocks
+      with their first point seeded from the last point of the
+      neighbouring (previous) block.
+    * A fit that raises an error is given status = -1
+    """
+    if type(xrf) != types.ListType:
+        xrf = [xrf]
+    npts = len(xrf)
+    if npts == 0: return fit_results(xrf)
+    if (nproc == None) or (nproc < 1):
+        nproc = multiprocessing.cpu_count()
+
+    if fit_init >=0:
+        if verbose: sys.__stdout__.write("Fitting index = %d\n" % fit_init)
+        xrf[fit_init].fit(varpro=varpro)
+        params = xrf[fit_init].get_params()
+    elif len(xrf_params) > 0:
+        params = xrf_params
+    else:
+        params = None
+
+    if block_size == None:
+        if use_prev_fit:
+            nblk = 2*nproc
+        else:
+            nblk = 4*nproc
+        block_size = int(num.ceil(float(npts)/nblk))
+    block_size = max(1,int(block_size))
+    blocks = []
+    for j in range(0,npts,block_size):
+        blocks.append(range(j,min(j+block_size,npts)))
+    if use_prev_fit:
+        stages = [blocks[0::2], blocks[1::2]]
+    else:
+        stages = [blocks]
+
+    pool = None
+    if (nproc > 1) and (len(blocks) > 1):
+        pool = multiprocessing.Pool(min(nproc,len(blocks)))
+    try:
+        for k in range(len(stages)):
+            tasks = []
+            for blk in stages[k]:
+                if k == 1:
+                    # seed from the last point of the neighbouring block
+                    tasks.append(([xrf[j] for j in blk], xrf[blk[0]-1].get_params(),
+                                  False, use_prev_fit, varpro))
+                else:
+                    tasks.append(([xrf[j] for j in blk], params,
+                                  guess, use_prev_fit, varpro))
+                if verbose:
+                    sys.__stdout__.write("Fitting index = %d-%d\n" % (blk[0],blk[-1]))
+            if pool != None:
+                results = pool.map(_fit_block, tasks)
+            else:
+                results = map(_fit_block, tasks)
+            # copy the fit results back to the xrf objects
+            for (blk, res) in zip(stages[k], results):
+                for (j, x) in zip(blk, res):
+                    xrf[j].__dict__.update(x.__dict__)
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
+    return fit_results(xrf)
+
+def _fit_block(args):
+    """
+    Fit a block of consecutive xrf objects (worker function for fit_parallel)
+    """
+    (xrf, params, guess, use_prev_fit, varpro) = args
+    for j in range(len(xrf)):
+        if (j > 0) and (use_prev_fit == True):
+            xrf[j].init(params=xrf[j-1].get_params())
+        elif params != None:
+            xrf[j].init(params=params,guess=guess)
+        _fit_point(xrf[j],varpro)
+    return xrf
+
+def _fit_point(xrf,varpro):
+    """
+    Fit a single xrf object, a fit that raises an error
+    is given status = -1
+    """
+    try:
+        xrf.fit(varpro=varpro)
+    except Exception, e:
+        xrf.status = -1
+        xrf.err_string = str(e)
+
+#################################################################################
+def fit_results(xrf,lines=None):
+    """
+    Get the fit results for a (list of) xrf objects
+
+    Parameters:
+    -----------
+    * lines is a list of line labels, default is the
+      peak labels of the first xrf object
+
+    Outputs:
+    --------
+    * dictionary with
+      - 'lines': list of line labels
+      - 'areas': (npts x nlines) array of peak areas
+      - 'errors': (npts x nlines) array of peak area errors
+      - 'status': array of fit status codes (see mpfit)
+      - 'chisqr': array of fit chi-square values
+      - 'n_iter': array of number of iterations
+    """
+    if type(xrf) != types.ListType:
+        xrf = [xrf]
+    if lines == None:
+        lines = []
+        if len(xrf) > 0:
+            for pk in xrf[0].peaks:
+                lines.append(pk.label)
+    npts   = len(xrf)
+    areas  = num.zeros((npts,len(lines)))
+    errors = num.zeros((npts,len(lines)))
+    for j in range(npts):
+        labels = [string.lower(pk.label) for pk in xrf[j].peaks]
+        for k in range(len(lines)):
+            lbl = string.lower(lines[k])
+            if lbl in labels:
+                pk = xrf[j].peaks[labels.index(lbl)]
+                areas[j,k]  = pk.area
+                errors[j,k] = getattr(pk,'area_err',0.)
+    status = num.array([x.status for x in xrf],dtype=int)
+    chisqr = num.array([x.chisqr for x in xrf],dtype=float)
+    n_iter = num.array([x.n_iter for x in xrf],dtype=int)
+    return {'lines':lines,'areas':areas,'errors':errors,
+            'status':status,'chisqr':chisqr,'n_iter':n_iter}
 
 #################################################################################
 def peak_areas(xrf,line):
@@ -201,6 +382,21 @@ def peak_areas(xrf,line):
                 break
     return num.array(results)
 
+#################################################################################
+def peak_errors(xrf,line):
+    """
+    get peak area errors for given line
+    """
+    if type(xrf) != types.ListType:
+        xrf = [xrf]
+    results = []
+    for x in xrf:
+        for pk in x.peaks:
+            if string.lower(pk.label) == string.lower(line):
+                results.append(getattr(pk,'area_err',0.))
+                break
+    return num.array(results)
+
 #################################################################################
 def xrf_plot(xrf,d='Data',f='Fit',p=None,ylog=True,xlog=False,hold=False):
     """
@@ -294,9 +490,11 @@ class XrfScan:
         * lines is list of xrf lines to fit
         """
         if type(xrf) != types.ListType: xrf = [xrf]
-        self.xrf   = xrf
-        self.lines = []
-        self.peaks = {}
+        self.xrf    = xrf
+        self.lines  = []
+        self.peaks  = {}
+        self.errors = {}
+        self.status = num.array([],dtype=int)
         if lines == None:
             self._update_lines()
         else:
@@ -349,13 +547,55 @@ class XrfScan:
 
     ################################################################
     def fit(self,xrf_params={},use_prev_fit=False,fit_init=-1,
-            guess=False,verbose=True):
+            guess=False,verbose=True,varpro=False,nproc=1):
         """
-        fit xrf
+        fit xrf, returns the fit results (see fit)
+
+        if nproc is not 1 the fits are done in parallel (see fit_parallel),
+        nproc=None uses all cpus
         """
-        fit(self.xrf,xrf_params=xrf_params,use_prev_fit=use_prev_fit,
-            fit_init=fit_init,guess=guess,verbose=verbose)
+        res = fit(self.xrf,xrf_params=xrf_params,use_prev_fit=use_prev_fit,
+                  fit_init=fit_init,guess=guess,verbose=verbose,
+                  varpro=varpro,nproc=nproc)
         self._update_peaks()
+        return res
+
+    ################################################################
+    def calc_bgr(self,):
+        """
+        compute the backgrounds of all the xrf spectra
+
+        Notes:
+        ------
+        Spectra with the same background parameters and number of
+        channels are computed together with Background.calc_batch.
+        The results are also stored in the background cache so 
+        subsequent calc/fit calls reuse them.
+        """
+        groups = {}
+        for j in range(len(self.xrf)):
+            x = self.xrf[j]
+            if not x.bgr: continue
+            key = (x.bgr._cache_key(), len(x.data))
+            if groups.has_key(key):
+                groups[key].append(j)
+            else:
+                groups[key] = [j]
+        for idx in groups.values():
+            data  = num.array([self.xrf[j].data for j in idx],dtype=float)
+            slope = num.array([self.xrf[j].energy_slope for j in idx])
+            bgr   = self.xrf[idx[0]].bgr.calc_batch(data,slope=slope)
+            for k in range(len(idx)):
+                x = self.xrf[idx[k]]
+                x.bgr.bgr = bgr[k]
+                xrf_bgr.BGR_CACHE.put(x.bgr,x.data,x.energy_slope,bgr[k])
+
+    ################################################################
+    def get_bgr_cache_stats(self,):
+        """
+        get background cache statistics (see xrf_bgr.BgrCache)
+        """
+        return xrf_bgr.BGR_CACHE.stats()
 
     ################################################################
     def _update_peaks(self,):
@@ -367,9 +607,12 @@ class XrfScan:
             lines.append(pk.label)
         self.lines = lines
         self.peaks = {}
+        self.errors = {}
         for l in lines:
             p = peak_areas(self.xrf,l)
             self.peaks[l] = p
+            self.errors[l] = peak_errors(self.xrf,l)
+        self.status = num.array([x.status for x in self.xrf],dtype=int)
 
 ##############################################################################
 ##############################################################################
@@ -24,8 +24,10 @@ from tdl.modules.utils.mathutil import cosd, sind, tand
 from tdl.modules.utils.mathutil import arccosd, arcsind, arctand
 from tdl.modules.utils.mathutil import cartesian_mag, cartesian_angle
 
-from tdl.modules.geom.polygon import poly_area, poly_area_num, inner_polygon
+from tdl.modules.geom.polygon import poly_area, inner_polygon
 from tdl.modules.geom.polygon import plot_polygon, plot_points, plot_circle
+from tdl.modules.geom.polygon import sort_points_array, clip_polygon_array
+from tdl.modules.geom.polygon import poly_area_array, circle_poly_area_array
 
 ##########################################################################
 def active_area(nm,ki=num.array([0.,1.,0.]),kr=num.array([0.,1.,0.]),
@@ -163,21 +165,15 @@ def _area_round(beam_poly,det_poly,diameter=None,plot=False,fig=None):
         if fig != None: pyplot.figure(fig)
         pyplot.clf()
     A_beam = poly_area(beam_poly)
-    if det_poly != None:
-        inner_poly = inner_polygon(beam_poly,det_poly)
-    else:
-        inner_poly = beam_poly
     if diameter <= 0.:
         diameter = None
-    if diameter == None:
-        A_int = poly_area(inner_poly)
-    else:
-        A_int = poly_area_num(beam_poly,diameter=diameter,plot=plot)
+    A_int = _area_int(beam_poly,det_poly,diameter=diameter)[0]
 
     # make plots
     if plot:
         plot_polygon(beam_poly,fmt='ro-',label='Beam')
         if det_poly != None:
+            inner_poly = inner_polygon(beam_poly,det_poly)
             plot_polygon(det_poly,fmt='ko-',label='Detector')
             plot_points(inner_poly,fmt='go-')
             plot_polygon(inner_poly,fmt='g--',linewidth=4,label='Intersection')
@@ -209,16 +205,16 @@ def _area_polygon(beam_poly,det_poly,sam_poly,plot=False,fig=None):
         if fig != None: pyplot.figure(fig)
         pyplot.clf()
     A_beam = poly_area(beam_poly)
-    if sam_poly == None:
-        inner_poly = beam_poly
-    else:
-        inner_poly = inner_polygon(beam_poly,sam_poly)
-    if det_poly != None:
-        inner_poly = inner_polygon(inner_poly,det_poly)
-    A_int = poly_area(inner_poly)
+    A_int = _area_int(beam_poly,det_poly,sam_poly=sam_poly)[0]
     
     # make plots
     if plot:
+        if sam_poly == None:
+            inner_poly = beam_poly
+        else:
+            inner_poly = inner_polygon(beam_poly,sam_poly)
+        if det_poly != None:
+            inner_poly = inner_polygon(inner_poly,det_poly)
         plot_polygon(beam_poly,fmt='ro-',label='Beam')
         if sam_poly != None:
             plot_polygon(sam_poly,fmt='bo-',label='Sample')
@@ -236,6 +232,170 @@ def _area_polygon(beam_poly,det_poly,sam_poly,plot=False,fig=None):
 
     return (A_beam,A_int)
 
+#########################################################################
+def _area_int(beam_poly,det_poly=None,sam_poly=None,diameter=None):
+    """
+    Compute the intersection area of the beam, detector and
+    sample polygons (exact polygon clipping, see polygon.py)
+
+    Parameters:
+    -----------
+    * beam_poly is an array (npts x nb x 2) (or list of [x,y] pairs)
+      of the beam polygon
+    * det_poly is an array (npts x nd x 2) (or list) of the detector
+      polygon, or None
+    * sam_poly is an array (npts x ns x 2) (or list) of the
+      sample polygon, or None
+    * diameter is the diameter of a round sample (centered on
+      the origin).  If None the sample polygon is used.
+
+    Outputs:
+    --------
+    * array (npts) of intersection areas
+
+    Notes:
+    ------
+    The beam and detector polygons are convex. The sample polygon
+    vertices are sorted by angle (ie the sample is assumed to be
+    star shaped wrt the rotation center, see polygon.inner_polygon),
+    it may be non-convex.
+    """
+    beam_poly = _poly_array(beam_poly)
+    npts = beam_poly.shape[0]
+    if sam_poly is not None and diameter is None:
+        poly  = sort_points_array(_poly_array(sam_poly,npts))
+        nvert = num.zeros(npts,dtype=int) + poly.shape[1]
+        (poly,nvert) = clip_polygon_array(poly,nvert,beam_poly)
+    else:
+        poly  = beam_poly
+        nvert = num.zeros(npts,dtype=int) + poly.shape[1]
+    if det_poly is not None:
+        (poly,nvert) = clip_polygon_array(poly,nvert,_poly_array(det_poly,npts))
+    if diameter is None:
+        return poly_area_array(poly,nvert)
+    else:
+        return circle_poly_area_array(poly,nvert,diameter/2.)
+
+def _poly_array(poly,npts=None):
+    """ polygon list -> (npts x nvert x 2) array """
+    poly = num.asarray(poly,dtype=float)
+    if poly.ndim == 2:
+        poly = poly[num.newaxis,:,:]
+    if npts != None and poly.shape[0] != npts:
+        poly = num.repeat(poly,npts,axis=0)
+    return poly
+
+#########################################################################
+def active_area_array(nm,ki,kr,beam=[],det=None,sample=None):
+    """
+    Array version of active_area.  Calc the area of overlap of
+    beam, sample and detector surface polygon projections for
+    a set of npts goniometer settings.
+
+    Parameters:
+    -----------
+    * nm, ki and kr are arrays (npts x 3) of the surface normal,
+      incident and diffracted beam directions in the lab frame
+      (see active_area)
+
+    * beam is a list (or nb x 3 array) of lab frame vectors defining the
+      beam apperature (the same for all points), or an
+      (npts x nb x 3) array
+
+    * det is a list or array (nd x 3) or (npts x nd x 3) of lab frame
+      vectors defining the detector apperature.
+      If det = None then we ignore it and just compute spill-off
+
+    * sample is either:
+      - a single number, taken as the diameter of a round sample
+      - a list or array (ns x 3) or (npts x ns x 3) of lab frame
+        vectors describing the sample polygon
+      - None, the sample is assumed to be infinite in size    
+
+    Output:
+    -------
+    * (A_beam, A_int) arrays (npts), see active_area.  Both
+      areas are zero for points where the beam or detector
+      projection is parallel to the surface
+    """
+    nm = num.atleast_2d(num.asarray(nm,dtype=float))
+    ki = num.atleast_2d(num.asarray(ki,dtype=float))
+    kr = num.atleast_2d(num.asarray(kr,dtype=float))
+    npts = nm.shape[0]
+    M    = calc_surf_transform_array(nm)
+    ki_s = num.einsum('nij,nj->ni',M,ki)
+    kr_s = num.einsum('nij,nj->ni',M,kr)
+    ok   = (ki_s[:,2] != 0.)
+    # beam
+    beam_poly = _surface_intercept_array(ki_s,_surf_vectors(M,beam))
+    # detector
+    if det is None:
+        det_poly = None
+    else:
+        ok = ok & (kr_s[:,2] != 0.)
+        det_poly = _surface_intercept_array(kr_s,_surf_vectors(M,det))
+    # sample
+    diameter = None
+    sam_poly = None
+    if sample is None:
+        pass
+    elif num.ndim(sample) == 0:
+        if sample > 0.: diameter = float(sample)
+    else:
+        vs = _surf_vectors(M,sample)
+        if num.any(num.fabs(vs[:,:,2]) > 0.01):
+            print "Warning sample hieght problem"
+        sam_poly = vs[:,:,:2]
+    # areas
+    A_beam = num.zeros(npts)
+    A_int  = num.zeros(npts)
+    if num.any(ok):
+        idx = num.where(ok)[0]
+        A_beam[idx] = poly_area_array(beam_poly[idx])
+        if det_poly is not None: det_poly = det_poly[idx]
+        if sam_poly is not None: sam_poly = sam_poly[idx]
+        A_int[idx] = _area_int(beam_poly[idx],det_poly,sam_poly=sam_poly,
+                               diameter=diameter)
+    return (A_beam,A_int)
+
+def _surf_vectors(M,v):
+    """ lab frame vectors (nv x 3) or (npts x nv x 3) -> surface frame """
+    v = num.asarray(v,dtype=float)
+    if v.ndim == 2:
+        return num.einsum('nij,mj->nmi',M,v)
+    return num.einsum('nij,nmj->nmi',M,v)
+
+def _surface_intercept_array(k,v):
+    """
+    Array version of surface_intercept. k is (npts x 3), v is
+    (npts x nv x 3), returns (npts x nv x 2).  Rows with k[2] = 0
+    are returned as zero
+    """
+    kz = num.where(k[:,2] != 0., k[:,2], 1.)
+    sx = num.where(k[:,2] != 0., k[:,0]/kz, 0.)[:,num.newaxis]
+    sy = num.where(k[:,2] != 0., k[:,1]/kz, 0.)[:,num.newaxis]
+    vi = num.empty(v.shape[:2]+(2,))
+    vi[:,:,0] = v[:,:,0] - sx*v[:,:,2]
+    vi[:,:,1] = v[:,:,1] - sy*v[:,:,2]
+    return vi
+
+##########################################################################
+def calc_surf_transform_array(nm):
+    """
+    Array version of calc_surf_transform, nm is (npts x 3),
+    returns M (npts x 3 x 3).  Since the surface basis is
+    orthonormal M = inv(transpose(F)) = F
+    """
+    nm  = num.asarray(nm,dtype=float)
+    v_z = nm / num.sqrt((nm*nm).sum(axis=1))[:,num.newaxis]
+    v   = num.array([0.,-1.,0.])
+    v_y = v - (v_z*v).sum(axis=1)[:,num.newaxis]*v_z
+    v_y = v_y / num.sqrt((v_y*v_y).sum(axis=1))[:,num.newaxis]
+    v_x = num.cross(v_y,v_z)
+    v_x = v_x / num.sqrt((v_x*v_x).sum(axis=1))[:,num.newaxis]
+    return num.concatenate((v_x[:,num.newaxis],v_y[:,num.newaxis],
+                            v_z[:,num.newaxis]),axis=1)
+
 ##########################################################################
 def calc_surf_transform(nm):
     """
@@ -106,6 +106,7 @@ References:
 import numpy as num
 import types
 import copy
+from collections import OrderedDict
 
 from tdl.modules.utils.mathutil import cosd, sind, tand
 from tdl.modules.utils.mathutil import arccosd, arcsind, arctand
@@ -289,6 +290,20 @@ class Psic:
         if lam!= None:  self.or1['lam']=float(lam)
         self._calc_UB()
 
+    def copy(self,):
+        """
+        Return a copy of the instance.  The copy shares the (read only)
+        orientation matrices but has its own lattice, angles and
+        reflections, so it may be modified without affecting self.
+        """
+        new = copy.copy(self)
+        new.lattice = copy.copy(self.lattice)
+        new.angles  = self.angles.copy()
+        new.pangles = self.pangles.copy()
+        new.or0     = self.or0.copy()
+        new.or1     = self.or1.copy()
+        return new
+
     def swap_or(self,):
         """
         Swap the primary and secondary reflection
@@ -367,8 +382,9 @@ class Psic:
         #self.U = num.dot(Tphi, Tc.transpose())
         self.U = num.dot(Tphi, num.linalg.inv(Tc))
 
-        # calc UB
+        # calc UB and its inverse
         self.UB = num.dot(self.U,self.B)
+        self._UBinv = num.linalg.inv(self.UB)
 
         #update h and psuedo angles...
         self.set_angles()
@@ -412,8 +428,106 @@ class Psic:
         self.kr=kr
         
         hphi = num.dot(num.linalg.inv(self.Z),self.Q) / (2.*num.pi) 
-        h    = num.dot(num.linalg.inv(self.UB),hphi)
+        h    = num.dot(self._get_UBinv(),hphi)
         self.h = h
+
+    def _get_UBinv(self,):
+        """
+        return the (cached) inverse of UB
+        """
+        UBinv = getattr(self,'_UBinv',None)
+        if UBinv is None:
+            UBinv = num.linalg.inv(self.UB)
+            self._UBinv = UBinv
+        return UBinv
+
+    ###################################################
+    def calc_array(self,phi=None,chi=None,eta=None,
+                   mu=None,nu=None,delta=None):
+        """
+        Calculate hkl, Q and the psuedo angles for arrays of
+        goniometer angles (in degrees).  The instance angles are
+        not changed.
+
+        Parameters:
+        -----------
+        * phi, chi, eta, mu, nu, delta are arrays (or scalars) of
+          angles, all arrays must be the same length.  Angles
+          passed as None are taken from self.angles
+
+        Outputs:
+        --------
+        * dictionary with the following arrays (npts is the array length)
+          - 'h': (npts x 3) hkl values
+          - 'Q', 'ki', 'kr': (npts x 3) lab frame vectors
+          - 'Z': (npts x 3 x 3) sample rotation matrices
+          - 'nm': (npts x 3) unit reference vector in the lab frame
+          - 'tth','sigma_az','tau_az','naz','alpha','beta',
+            'tau','psi','qaz','omega': (npts) psuedo angles
+
+        Example:
+        --------
+        >>r = psic.calc_array(eta=scan['eta'],mu=scan['mu'],
+                              nu=scan['nu'],delta=scan['del'])
+        >>L = r['h'][:,2]
+        >>beta = r['beta']
+        """
+        ang = {'phi':phi,'chi':chi,'eta':eta,'mu':mu,'nu':nu,'delta':delta}
+        npts = 1
+        for key in ang.keys():
+            if ang[key] is None: ang[key] = self.angles[key]
+            ang[key] = num.atleast_1d(num.asarray(ang[key],dtype=float))
+            npts = max(npts,len(ang[key]))
+        for key in ang.keys():
+            if len(ang[key]) != npts:
+                ang[key] = num.resize(ang[key],npts)
+
+        Z = _calc_Z_array(ang['phi'],ang['chi'],ang['eta'],ang['mu'])
+        (ki,kr) = _calc_kvecs_array(ang['nu'],ang['delta'],self.lattice.lam)
+        Q = kr - ki
+
+        # hkl, note Z is a rotation so inv(Z) = transpose(Z)
+        hphi = num.einsum('nji,nj->ni',Z,Q) / (2.*num.pi)
+        h    = num.einsum('ij,nj->ni',self._get_UBinv(),hphi)
+
+        r = {'h':h,'Q':Q,'ki':ki,'kr':kr,'Z':Z}
+        nu    = ang['nu']
+        delta = ang['delta']
+
+        # psuedo angles, see the _calc_xx methods below
+        r['tth'] = arccosd(cosd(delta)*cosd(nu))
+        n_phi = num.dot(self.UB,self.n)
+        nm = num.einsum('nij,j->ni',Z,n_phi)
+        nm = nm / num.sqrt(_dot3(nm,nm))[:,num.newaxis]
+        r['nm'] = nm
+        n_phi = n_phi/cartesian_mag(n_phi)
+        r['sigma_az'] = num.zeros(npts) + arccosd(n_phi[2])
+        r['tau_az']   = num.zeros(npts) + num.arctan2(-n_phi[1], n_phi[0])*180./num.pi
+        r['naz']   = num.degrees(num.arctan2(nm[:,0],nm[:,2]))
+        r['alpha'] = arcsind(-nm[:,1])
+        krn = kr / num.sqrt(_dot3(kr,kr))[:,num.newaxis]
+        r['beta']  = arcsind(_dot3(nm,krn))
+        tau = _cartesian_angle_array(Q,nm)
+        r['tau']   = tau
+        xx    = cosd(tau)*sind(r['tth']/2.) - sind(r['alpha'])
+        denom = sind(tau)*cosd(r['tth']/2.)
+        ok    = denom != 0
+        with num.errstate(invalid='ignore'):
+            r['psi'] = num.where(ok, arccosd(xx/num.where(ok,denom,1.)), 0.)
+        r['qaz']   = num.degrees(num.arctan2(sind(delta), cosd(delta)*sind(nu)))
+        # omega, T = M^t*H^t
+        eta = ang['eta']
+        mu  = ang['mu']
+        one  = num.ones(npts)
+        zero = num.zeros(npts)
+        Ht = num.swapaxes(_rot_stack(cosd(eta),sind(eta),zero,one,2),1,2)
+        Mt = num.swapaxes(_rot_stack(cosd(mu),-sind(mu),zero,one,0),1,2)
+        T  = num.einsum('nij,njk->nik',Mt,Ht)
+        Qpp = num.einsum('nij,nj->ni',T,Q)
+        Qxz = Qpp.copy()
+        Qxz[:,1] = 0.
+        r['omega'] = _cartesian_angle_array(Qxz,Qpp)
+        return r
         
     ###################################################
     def set_n(self,n=[0,0,1]):
@@ -462,7 +576,7 @@ class Psic:
                            -sind(sig_az)*sind(tau_az), 
                                   cosd(sig_az)        ])
         # n in HKL
-        n_hkl = num.dot(num.linalg.inv(self.UB),n_phi)
+        n_hkl = num.dot(self._get_UBinv(),n_phi)
         n_hkl = n_hkl/ num.max(num.abs(n_hkl))
         
         # note if l-component is negative, then its
@@ -694,16 +808,45 @@ class Psic:
         self.pangles['omega'] = omega
 
 ##########################################################################
-def psic_from_spec(G,angles={}):
+# cache of Psic instances keyed by the spec G array
+# (which includes the lattice, lambda and OR's), see psic_from_spec.
+# the least recently used entry is dropped when the cache is full
+PSIC_CACHE_SIZE = 64
+_PSIC_CACHE = OrderedDict()
+
+def psic_from_spec(G,angles={},cache=True):
     """
     pass spec G array and dictionary of angles
     returns a psic instance
+
+    If cache is True the orientation (UB) calculation is only done
+    once for each unique G, subsequent calls return a copy of the
+    cached instance with the angles set.
     """
-    gonio = Psic()
-    if G != None: gonio.set_spec_G(G)
-    gonio.set_angles(**angles)
+    if (G is None) or (cache == False):
+        gonio = Psic()
+        if G is not None: gonio.set_spec_G(G)
+        gonio.set_angles(**angles)
+        return gonio
+    key = tuple(num.asarray(G,dtype=float).ravel())
+    proto = _PSIC_CACHE.pop(key,None)
+    if proto is None:
+        proto = Psic()
+        proto.set_spec_G(list(G))
+        while len(_PSIC_CACHE) >= PSIC_CACHE_SIZE:
+            _PSIC_CACHE.popitem(last=False)
+    _PSIC_CACHE[key] = proto
+    gonio = proto.copy()
+    if len(angles) > 0:
+        gonio.set_angles(**angles)
     return gonio
 
+def clear_psic_cache():
+    """
+    clear the cache of Psic instances used by psic_from_spec
+    """
+    _PSIC_CACHE.clear()
+
 ##########################################################################
 def spec_psic_G(G):
     """
@@ -806,7 +949,17 @@ def calc_Z(phi=0.0,chi=0.0,eta=0.0,mu=0.0):
     ie a vector defined with all angles zero => vphi.  After rotation
     the lab frame coordinates of the vector => vm are given by:
          vm = Z*vphi
+
+    If any of the angles are arrays the result is a stack of
+    matrices dimensioned (npts x 3 x 3)
     """
+    if (num.ndim(phi) > 0 or num.ndim(chi) > 0 or
+        num.ndim(eta) > 0 or num.ndim(mu) > 0):
+        (phi,chi,eta,mu) = num.broadcast_arrays(num.atleast_1d(phi),
+                                                num.atleast_1d(chi),
+                                                num.atleast_1d(eta),
+                                                num.atleast_1d(mu))
+        return _calc_Z_array(phi,chi,eta,mu)
     P = num.array([[ cosd(phi), sind(phi), 0.],
                    [-sind(phi), cosd(phi), 0.],
                    [  0.,          0.,     1.]],float)
@@ -822,11 +975,65 @@ def calc_Z(phi=0.0,chi=0.0,eta=0.0,mu=0.0):
     Z = num.dot(num.dot(num.dot(M,H),X),P)
     return Z
 
+def _calc_Z_array(phi,chi,eta,mu):
+    """
+    Z for arrays of angles, returns (npts x 3 x 3) array
+    """
+    phi = num.asarray(phi,dtype=float)
+    chi = num.asarray(chi,dtype=float)
+    eta = num.asarray(eta,dtype=float)
+    mu  = num.asarray(mu,dtype=float)
+    one  = num.ones(len(phi))
+    zero = num.zeros(len(phi))
+    P = _rot_stack(cosd(phi),sind(phi),zero,one,2)
+    X = _rot_stack(cosd(chi),-sind(chi),zero,one,1)
+    H = _rot_stack(cosd(eta),sind(eta),zero,one,2)
+    M = _rot_stack(cosd(mu),-sind(mu),zero,one,0)
+    Z = num.einsum('nij,njk->nik',M,H)
+    Z = num.einsum('nij,njk->nik',Z,X)
+    Z = num.einsum('nij,njk->nik',Z,P)
+    return Z
+
+def _rot_stack(c,s,zero,one,axis):
+    """
+    Stack of rotation matrices about a lab axis, in the
+    form used by calc_Z, eg for axis = 2:
+        [[ c, s, 0],
+         [-s, c, 0],
+         [ 0, 0, 1]]
+    """
+    if axis == 2:
+        R = [[ c,    s,    zero],
+             [-s,    c,    zero],
+             [zero, zero,  one ]]
+    elif axis == 1:
+        R = [[ c,   zero,  -s  ],
+             [zero,  one,  zero],
+             [ s,   zero,   c  ]]
+    else:
+        R = [[ one, zero, zero],
+             [zero,  c,    s  ],
+             [zero, -s,    c  ]]
+    return num.transpose(num.array(R,dtype=float),(2,0,1))
+
+def _dot3(u,v):
+    """ row wise dot product of (npts x 3) arrays """
+    return u[:,0]*v[:,0] + u[:,1]*v[:,1] + u[:,2]*v[:,2]
+
+def _cartesian_angle_array(u,v):
+    """ row wise cartesian_angle of (npts x 3) arrays """
+    denom = num.sqrt(_dot3(u,u))*num.sqrt(_dot3(v,v))
+    ok    = denom != 0
+    arg   = _dot3(u,v)/num.where(ok,denom,1.)
+    arg   = num.clip(arg,-1.,1.)
+    return num.where(ok,arccosd(arg),0.)
+
 ##########################################################################
 def calc_Q(nu=0.0,delta=0.0,lam=1.0,ret_k=False):
     """
     Calculate psic Q in the cartesian lab frame.
     nu and delta are in degrees, lam is in angstroms
+    If nu or delta are arrays Q (ki and kr) are (npts x 3) arrays
 
     if ret_k == True return tuple -> (Q,ki,kr)
     """
@@ -844,12 +1051,30 @@ def calc_kvecs(nu=0.0,delta=0.0,lam=1.0):
     nu and delta are in degrees, lam is in angstroms
     """
     k  = (2.* num.pi / lam)
+    if num.ndim(nu) > 0 or num.ndim(delta) > 0:
+        (nu,delta) = num.broadcast_arrays(num.atleast_1d(nu),num.atleast_1d(delta))
+        return _calc_kvecs_array(nu,delta,lam)
     ki = k * num.array([0.,1.,0.],dtype=float)
     kr = k * num.array([sind(delta),
                         cosd(nu)*cosd(delta),
                         sind(nu)*cosd(delta)],dtype=float)
     return (ki,kr)
 
+def _calc_kvecs_array(nu,delta,lam):
+    """
+    ki and kr for arrays of nu and delta, returns (npts x 3) arrays
+    """
+    nu    = num.asarray(nu,dtype=float)
+    delta = num.asarray(delta,dtype=float)
+    k  = (2.* num.pi / lam)
+    ki = num.zeros((len(nu),3))
+    ki[:,1] = k
+    kr = num.empty((len(nu),3))
+    kr[:,0] = k*sind(delta)
+    kr[:,1] = k*(cosd(nu)*cosd(delta))
+    kr[:,2] = k*(sind(nu)*cosd(delta))
+    return (ki,kr)
+
 ##########################################################################
 def calc_D(nu=0.0,delta=0.0):
     """
@@ -869,8 +1094,18 @@ def calc_D(nu=0.0,delta=0.0):
     Since kr is defined by the detector rotation, the lab frame 
     coordinates of the kr vector after detector rotation are
          kr_m = D*kr_phi
-    
+
+    If nu or delta are arrays the result is a stack of
+    matrices dimensioned (npts x 3 x 3)
     """
+    if num.ndim(nu) > 0 or num.ndim(delta) > 0:
+        (nu,delta) = num.broadcast_arrays(num.atleast_1d(nu),
+                                          num.atleast_1d(delta))
+        one  = num.ones(len(nu))
+        zero = num.zeros(len(nu))
+        D1 = _rot_stack(cosd(delta),sind(delta),zero,one,2)
+        D2 = _rot_stack(cosd(nu),-sind(nu),zero,one,0)
+        return num.einsum('nij,njk->nik',D2,D1)
     D1 = num.array([[cosd(delta),  sind(delta),  0.], 
                     [-sind(delta), cosd(delta),  0.],
                     [     0.     ,     0.     ,  1.]])
@@ -3,280 +3,309 @@ Pixel HKL
 
 Authors/Modifications:
 -----------------------
+* Tom Trainor (tptrainor@alaska.edu)
 
 Notes:
 ------
-* Needs to be completed.
+Compute Q and hkl for all the pixels of an area detector mounted
+on the psic detector arm (see gonio_psic).
+
+With all the detector angles at zero (phi frame) the detector is
+centered on the lab-y axis (ie the direct beam) at a distance d from
+the sample.  The vector pointing from the sample to a pixel with
+(row,col) indicies is then
+
+    p = [0,d,0] + (row-row_c)*pr*r + (col-col_c)*pc*c
+
+where (row_c,col_c) is the pixel hit by the center of the detector
+arm (ie kr with nu = delta = 0), pr and pc the pixel sizes (same
+units as d), and r and c the phi frame unit vectors along which the
+row and column indicies increase.  By default rows run along lab-x
+(vertical) and columns along lab-z (horizontal).  Tilted detectors
+can be described by giving r and c explicitly.
+
+The unit pixel vectors (pn = p/|p|) only depend on the detector
+mounting, they are computed once and cached.  For each set of
+angles the scattered wave vector of each pixel is
+
+    kr = k * D * pn
+
+with D the detector rotation matrix (see gonio_psic.calc_D).
+Therefore
+
+    Q = kr - ki
+    h = (1/(2*pi)) * inv(UB) * inv(Z) * Q
+
+which is evaluated as a single 3x3 matrix product over all
+the pixels, ie h = (k/2pi)*M*D*pn - M*ki/2pi with M = inv(UB)*inv(Z).
+
+Example:
+--------
+>>psic = gonio_psic.psic_from_spec(G,angles)
+>>pm = PixelMap(psic,distance=1500.,pixel_size=0.172,
+                center=(97,243),shape=(195,487))
+>>(H,K,L) = pm.calc_hkl(phi=phi,chi=chi,eta=eta,mu=mu,nu=nu,delta=delta)
+>>(row,col) = pm.hkl_to_pixel([1.,0.,2.5])
 """
 ###########################################################
 
 import numpy as num
 
+from tdl.modules.geom import gonio_psic
+
 ###########################################################
-""""
-lam = 1.2;
-k = 2*pi/lam;
-
-# sample det distance (mm)
-y = 5000 ;
-
-# pixel dims (mm)
-del_pixel = 0.175;
-
-# pixel coords
-dx = 500;
-dz = 100;
-
-# vector pointing to pixel
-p = [dx*del_pixel, y, dz*del_pixel];
-
-# normalized
-pn = p/sqrt((dx*del_pixel)^2 + y^2 + (dz*del_pixel)^2);
-v_mag(pn);
-
-
-# get rot matricies for detector arm
-nu = 0
-del = 0
-
-P = [  1,       0,         0    ;
-       0,   cosd(nu), -sind(nu) ;
-       0,   sind(nu),  cosd(nu) ];
-    
-D = [  cosd(del),   sind(del),   0 ;
-      -sind(del),   cosd(del),   0 ;
-          0     ,       0    ,   1 ];
-       
-
-# calc kr for center of det
-kr = P*D*[0;1;0];
-kr = k*kr
-#should be same as
-#kr = k*[ sind(del)           ; 
-#         cosd(nu)*cosd(del)  ; 
-#         sind(nu)*cosd(del) ];
-
-# calc Q for center
-ki = k*[ 0 ;
-         1 ;
-         0 ];      
-Qm = kr - ki
-tth = v_angle(ki,kr, [1 1 1 90 90 90])
-
-# calc kr or rotated pixel vector 
-kr_p = P*D*pn;
-kr_p = k*kr_p
-
-# calc Q for pixel
-Qm_p = kr_p - ki
-tth_p = v_angle(ki,kr_p, [1 1 1 90 90 90])
-
-# now we can calc hkl for the center and the pixel 
-# given Z and UB
-# [Z,Qm,ki,kr,tth] = calc_Z_and_Q(angles,k);
-#[U, UB] = calc_U(h_1, lam_1, angle_1, h_2, lam_2, angle_2, cell);
-#
-# h = (1/(2*pi))*inv(UB)*inv(Z)*Qm_p
-
-########################################################################
-########################################################################
-#HKL scan for goethite (10L) rod, specfile: gt_6_april07_b(fake).spc, scan = 1 0 2.51379
-#############################
-# #S 2  hklscan  0.999939 0.999939  -8.56988e-05 -8.56988e-05  2.06 3.94  29 0.5
-# #D Mon Apr 23 17:06:40 2007
-# #T 0.5  (Seconds)
-# #G0 0 0 1 -0.0001806167054 0.0002695003495 1 0 0 0 0 0 0 50.031 0 0 1 4 2 5 4 0
-# #G1 3.023 4.609 9.963 90 90 90 2.078460241 1.363242636 0.6306519429 90 90 90 0 0 6 1 -1 3 -0.0002 -0.008 -2.59 1.9435 36.2778 15.309 26.6488 13.3275 9.021 -26.4045 13.88 -0.10275 1.0339 1.0339
-# #G3 2.070853321 -0.09753606408 0.02949524505 0.1533409954 1.357964195 -0.03015295668 -0.08972198422 0.06964512884 0.6292397817
-# #G4 0.9999385052 -8.569884087e-05 1.940140169 1.0339 4.000241947 7.548864431 -1.522131988 22.89000882 87.91053344 59.54799609 71.72405792 12.00256456 3.7875 45.7 4 0 0 0 12 0 0 0 0.2 122.798 0 0 0 0 -180 -180 -180 -180 -180 -180 -180 -180 -180 0 0 0 0 0 0 0 0 0 0 0 0
-# #Q 0.999939 -8.56988e-05 1.94014
-# #P0 21.675099 10.833 10.34 4.272 7.5422504 -1.2597501 15.1823 13.5044
-# #P1 8.6210004 0 0.0001072 0.064599998 8.1185004 0 499.93943 0
-# #P2 499.93943 -1816.025 179.96889 0 199.84443 0 2000.0779 0
-# #P3 2000.0779 0 2000.0779 0 2000.0779 0.065399998 -0.1552 -0.1538
-# #P4 0 0 0 0 0 0 0 -5655.4269
-# #P5 0 
-# #ATTEN 0 0 0 0
-# #ALP_BET 4.00024 7.54886
-# #ENERGY 11991.9
-# #N 15
-# #L H  K  L  del  eta  chi  phi  nu  mu  Alpha  Beta  Epoch  io  i1  Bicron  AmpTek_sc  ROI1  ROI2  ROI3  Seconds  IROI
-# 0.999939 -8.56988e-05 2.06    21.8112    10.9035    10.3590     4.4855     8.3050    -1.2860  3.9997   8.2706  510 40 22 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.12483    21.8852    10.9385    10.3700     4.6160     8.7168    -1.3003  3.9993   8.6601  512 40 23 0 0 0 0 0 0.509997 0
-# 0.999939 -8.56988e-05 2.18966    21.9572    10.9755    10.3810     4.7540     9.1298    -1.3138  4.0002   9.0487  515 43 25 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.25448    22.0292    11.0105    10.3940     4.9010     9.5435    -1.3308   3.998   9.4412  517 48 29 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.31931    22.1011    11.0530    10.4060     5.0545     9.9590    -1.3453  3.9997   9.8307  519 48 30 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.38414    22.1683    11.0820    10.4190     5.2180    10.3745    -1.3613  3.9977   10.223  521 42 23 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.44897    22.2413    11.1175    10.4335     5.3880    10.7918    -1.3748  3.9999   10.615  523 48 29 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.51379    22.3113    11.1500    10.4470     5.5685    11.2093    -1.3910   3.999   11.008  525 48 30 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.57862    22.3787    11.1850    10.4620     5.7560    11.6275    -1.4060  4.0002   11.399  527 47 30 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.64345    22.4432    11.2180    10.4770     5.9515    12.0480    -1.4228  3.9995   11.794  529 48 30 0 0 0 0 0 0.509997 0
-###########################################################
-# Give the hkl of interest
-# Do the reverse converions from h to Pixels
-h = [ 1.0021;-0.0028;2.5374]
-
-# arrays from spec file
-Uarray = [3.023 4.609 9.963 90 90 90 2.078460241 1.363242636 0.6306519429 90 90 90 0 0 6 1 -1 3 -0.0002 -0.008 -2.59 1.9435 36.2778 15.309 26.6488 13.3275 9.021 -26.4045 13.88 -0.10275 1.0339 1.0339];
-angles = [22.3113    11.1500    10.4470     5.5685    11.2093    -1.3910 ];
-# get the angles needed for the geometry calcs
-# first parse the data needed to calc the UB matrix.
-cell = [Uarray(1:6)];     # cell parameters (real space)
-h_1 = [Uarray(13:15)];    # hkl of OR1
-h_2 = [Uarray(16:18)];    # hkl of OR2 
-
-# note see calc_U for how these should be parsed
-angle_1 = [Uarray(19:24)];   # motor settings for OR1
-angle_2 = [Uarray(25:30)];   # motor settings for OR2
-lam_1 = Uarray(31);          # lambda for OR1  
-lam_2 = Uarray(32);          # lambda for OR2 
-
-lam = 1.0339;
-k = 2*pi/lam;
-# sample det distance (mm)
-y =1500 ;
-# pixel dims (mm)
-del_pixel = 0.175;
-#center pixels 
-CenPix_x = 235;
-CenPix_y = 85;
-# now we can calc hkl for the center and the pixel 
-# given Z and UB
- [Z,Qm,ki,kr,tth] = calc_Z_and_Q(angles,k);
-[U, UB] = calc_U(h_1, lam_1, angle_1, h_2, lam_2, angle_2, cell);
-
-#matrix of conversion of Pixel to h
-M_PQ = (1/(2*pi))*inv(UB)*inv(Z);
-Qm_p = inv(M_PQ)*h;
-kr_p = Qm_p + ki;
-kr_p = kr_p/k;
-pn = inv(D)*inv(P)*kr_p;
-mod_p = y/pn(2);
-p = pn*mod_p;
-dx = p(1)/del_pixel
-dz = p(3)/del_pixel
-Pix_x = CenPix_x + dz
-Pix_y = CenPix_y + dx
-
-########################################################################
-########################################################################
-#HKL scan for goethite (10L) rod, specfile: gt_6_april07_b(fake).spc, scan = 1 0 2.51379
-#############################
-# #S 2  hklscan  0.999939 0.999939  -8.56988e-05 -8.56988e-05  2.06 3.94  29 0.5
-# #D Mon Apr 23 17:06:40 2007
-# #T 0.5  (Seconds)
-# #G0 0 0 1 -0.0001806167054 0.0002695003495 1 0 0 0 0 0 0 50.031 0 0 1 4 2 5 4 0
-# #G1 3.023 4.609 9.963 90 90 90 2.078460241 1.363242636 0.6306519429 90 90 90 0 0 6 1 -1 3 -0.0002 -0.008 -2.59 1.9435 36.2778 15.309 26.6488 13.3275 9.021 -26.4045 13.88 -0.10275 1.0339 1.0339
-# #G3 2.070853321 -0.09753606408 0.02949524505 0.1533409954 1.357964195 -0.03015295668 -0.08972198422 0.06964512884 0.6292397817
-# #G4 0.9999385052 -8.569884087e-05 1.940140169 1.0339 4.000241947 7.548864431 -1.522131988 22.89000882 87.91053344 59.54799609 71.72405792 12.00256456 3.7875 45.7 4 0 0 0 12 0 0 0 0.2 122.798 0 0 0 0 -180 -180 -180 -180 -180 -180 -180 -180 -180 0 0 0 0 0 0 0 0 0 0 0 0
-# #Q 0.999939 -8.56988e-05 1.94014
-# #P0 21.675099 10.833 10.34 4.272 7.5422504 -1.2597501 15.1823 13.5044
-# #P1 8.6210004 0 0.0001072 0.064599998 8.1185004 0 499.93943 0
-# #P2 499.93943 -1816.025 179.96889 0 199.84443 0 2000.0779 0
-# #P3 2000.0779 0 2000.0779 0 2000.0779 0.065399998 -0.1552 -0.1538
-# #P4 0 0 0 0 0 0 0 -5655.4269
-# #P5 0 
-# #ATTEN 0 0 0 0
-# #ALP_BET 4.00024 7.54886
-# #ENERGY 11991.9
-# #N 15
-# #L H  K  L  del  eta  chi  phi  nu  mu  Alpha  Beta  Epoch  io  i1  Bicron  AmpTek_sc  ROI1  ROI2  ROI3  Seconds  IROI
-# 0.999939 -8.56988e-05 2.06    21.8112    10.9035    10.3590     4.4855     8.3050    -1.2860  3.9997   8.2706  510 40 22 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.12483    21.8852    10.9385    10.3700     4.6160     8.7168    -1.3003  3.9993   8.6601  512 40 23 0 0 0 0 0 0.509997 0
-# 0.999939 -8.56988e-05 2.18966    21.9572    10.9755    10.3810     4.7540     9.1298    -1.3138  4.0002   9.0487  515 43 25 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.25448    22.0292    11.0105    10.3940     4.9010     9.5435    -1.3308   3.998   9.4412  517 48 29 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.31931    22.1011    11.0530    10.4060     5.0545     9.9590    -1.3453  3.9997   9.8307  519 48 30 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.38414    22.1683    11.0820    10.4190     5.2180    10.3745    -1.3613  3.9977   10.223  521 42 23 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.44897    22.2413    11.1175    10.4335     5.3880    10.7918    -1.3748  3.9999   10.615  523 48 29 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.51379    22.3113    11.1500    10.4470     5.5685    11.2093    -1.3910   3.999   11.008  525 48 30 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.57862    22.3787    11.1850    10.4620     5.7560    11.6275    -1.4060  4.0002   11.399  527 47 30 0 0 0 0 0 0.509996 0
-# 0.999939 -8.56988e-05 2.64345    22.4432    11.2180    10.4770     5.9515    12.0480    -1.4228  3.9995   11.794  529 48 30 0 0 0 0 0 0.509997 0
-###########################################################
-# convert pixel to hkl from the center pixel
-#pixels of interest
-Pix_x = 255
-Pix_y = 95
-
-#########
-Uarray = [3.023 4.609 9.963 90 90 90 2.078460241 1.363242636 0.6306519429 90 90 90 0 0 6 1 -1 3 -0.0002 -0.008 -2.59 1.9435 36.2778 15.309 26.6488 13.3275 9.021 -26.4045 13.88 -0.10275 1.0339 1.0339];
-angles = [22.3113    11.1500    10.4470     5.5685    11.2093    -1.3910 ];
-# get the angles needed for the geometry calcs
-# first parse the data needed to calc the UB matrix.
-cell = [Uarray(1:6)];     # cell parameters (real space)
-h_1 = [Uarray(13:15)];    # hkl of OR1
-h_2 = [Uarray(16:18)];    # hkl of OR2 
-
-# note see calc_U for how these should be parsed
-angle_1 = [Uarray(19:24)];   # motor settings for OR1
-angle_2 = [Uarray(25:30)];   # motor settings for OR2
-lam_1 = Uarray(31);          # lambda for OR1  
-lam_2 = Uarray(32);          # lambda for OR2 
-
-lam = 1.0339;
-k = 2*pi/lam;
-
-# sample det distance (mm)
-y =1500 ;
-
-# pixel dims (mm)
-del_pixel = 0.175;
-
-#center pixels 
-CenPix_x = 235;
-CenPix_y = 85;
-# pixel coords
-dx = (195 - CenPix_y) - (195 - Pix_y)
-dz = Pix_x  - CenPix_x
-
-# vector pointing to pixel
-p = [dx*del_pixel; y; dz*del_pixel];
-
-# normalized
-pn = p/sqrt((dx*del_pixel)^2 + y^2 + (dz*del_pixel)^2);
-v_mag(pn);
-
-# get rot matricies for detector arm
-nu = angles(5);
-del = angles(1);
-
-P = [  1,       0,         0    ;
-       0,   cosd(nu), -sind(nu) ;
-       0,   sind(nu),  cosd(nu) ];
-    
-D = [  cosd(del),   sind(del),   0 ;
-      -sind(del),   cosd(del),   0 ;
-          0     ,       0    ,   1 ];
-       
-
-# calc kr for center of det
-kr = P*D*[0;1;0];
-kr = k*kr;
-#should be same as
-#kr = k*[ sind(del)           ; 
-#         cosd(nu)*cosd(del)  ; 
-#         sind(nu)*cosd(del) ];
-
-# calc Q for center
-ki = k*[ 0 ;
-         1 ;
-         0 ];      
-Qm = kr - ki;
-tth = v_angle(ki,kr, [1 1 1 90 90 90]);
-
-# calc kr or rotated pixel vector 
-kr_p = P*D*pn;
-kr_p = k*kr_p;
-
-# calc Q for pixel
-Qm_p = kr_p - ki;
-tth_p = v_angle(ki,kr_p, [1 1 1 90 90 90]);
-
-# now we can calc hkl for the center and the pixel 
-# given Z and UB
- [Z,Qm,ki,kr,tth] = calc_Z_and_Q(angles,k);
-[U, UB] = calc_U(h_1, lam_1, angle_1, h_2, lam_2, angle_2, cell);
-h = (1/(2*pi))*inv(UB)*inv(Z)*Qm_p
+class PixelMap:
+    """
+    Pixel to Q / hkl map of an area detector for the psic geometry.
+
+    The detector frame geometry (the unit vectors pointing to each
+    pixel with all angles at zero) is cached, the angle dependent
+    rotations are recomputed for each call.
+    """
+    def __init__(self,gonio,distance=1000.,pixel_size=0.172,center=None,
+                 shape=(195,487),row_dir=[1.,0.,0.],col_dir=[0.,0.,1.]):
+        """
+        Parameters:
+        -----------
+        * gonio is a Psic instance (defines the wavelength, UB and
+          the default angles)
+        * distance is the sample-detector distance
+        * pixel_size is the pixel size (same units as distance).
+          Either a scalar or (row size, col size)
+        * center is the (row,col) pixel at the center of the detector
+          arm. Default is the center of the detector
+        * shape is the detector (image) shape (nrows,ncols)
+        * row_dir and col_dir are the (phi frame) directions of
+          increasing row and column index
+        """
+        self.gonio = gonio
+        self.shape = (int(shape[0]),int(shape[1]))
+        self.distance = float(distance)
+        if num.ndim(pixel_size) == 0:
+            pixel_size = (pixel_size,pixel_size)
+        self.pixel_size = (float(pixel_size[0]),float(pixel_size[1]))
+        if center is None:
+            center = ((self.shape[0]-1)/2.,(self.shape[1]-1)/2.)
+        self.center = (float(center[0]),float(center[1]))
+        self.row_dir = num.array(row_dir,dtype=float)
+        self.row_dir = self.row_dir/num.sqrt(num.sum(self.row_dir**2))
+        self.col_dir = num.array(col_dir,dtype=float)
+        self.col_dir = self.col_dir/num.sqrt(num.sum(self.col_dir**2))
+        self._pn = None
+
+    def __repr__(self,):
+        lout = "Pixel map: shape = (%i,%i)\n" % self.shape
+        lout = "%sdistance = %g, pixel size = (%g,%g)\n" % \
+               ((lout,self.distance) + self.pixel_size)
+        lout = "%scenter = (%g,%g)\n" % ((lout,) + self.center)
+        return lout
+
+    ###################################################
+    def _get_pn(self,):
+        """
+        Return the (cached) unit vectors pointing from the sample to
+        each pixel in the phi frame, a (3 x npix) array
+        """
+        if self._pn is None:
+            (nr,nc) = self.shape
+            r = (num.arange(nr,dtype=float) - self.center[0])*self.pixel_size[0]
+            c = (num.arange(nc,dtype=float) - self.center[1])*self.pixel_size[1]
+            p = num.empty((3,nr,nc))
+            for j in range(3):
+                p[j] = self.row_dir[j]*r[:,num.newaxis] + \
+                       self.col_dir[j]*c[num.newaxis,:]
+            p[1] = p[1] + self.distance
+            p = p.reshape(3,nr*nc)
+            self._pn = p/num.sqrt(num.sum(p*p,axis=0))
+        return self._pn
+
+    def _angles(self,phi,chi,eta,mu,nu,delta):
+        """
+        angles (None -> gonio angles)
+        """
+        ang = {'phi':phi,'chi':chi,'eta':eta,'mu':mu,'nu':nu,'delta':delta}
+        for key in ang.keys():
+            if ang[key] is None: ang[key] = self.gonio.angles[key]
+            ang[key] = float(ang[key])
+        return ang
+
+    ###################################################
+    def calc_kr(self,nu=None,delta=None):
+        """
+        Calculate kr for all pixels
+
+        Outputs:
+        --------
+        * kr (nrows x ncols x 3) lab frame wave vectors
+        """
+        ang = self._angles(0.,0.,0.,0.,nu,delta)
+        k   = 2.*num.pi/self.gonio.lattice.lam
+        D   = gonio_psic.calc_D(nu=ang['nu'],delta=ang['delta'])
+        kr  = k*num.dot(D,self._get_pn())
+        return kr.T.reshape(self.shape + (3,))
+
+    def calc_Q(self,nu=None,delta=None):
+        """
+        Calculate Q for all pixels
+
+        Outputs:
+        --------
+        * Q (nrows x ncols x 3) lab frame Q vectors
+        """
+        k  = 2.*num.pi/self.gonio.lattice.lam
+        Q  = self.calc_kr(nu=nu,delta=delta)
+        Q[:,:,1] = Q[:,:,1] - k
+        return Q
+
+    def calc_tth(self,nu=None,delta=None):
+        """
+        Calculate the scattering angle (degrees) of all pixels
+        """
+        ang = self._angles(0.,0.,0.,0.,nu,delta)
+        D   = gonio_psic.calc_D(nu=ang['nu'],delta=ang['delta'])
+        # ki is along lab-y
+        c   = num.dot(D[1],self._get_pn())
+        tth = num.degrees(num.arccos(num.clip(c,-1.,1.)))
+        return tth.reshape(self.shape)
+
+    def calc_hkl(self,phi=None,chi=None,eta=None,mu=None,nu=None,
+                 delta=None):
+        """
+        Calculate hkl for all pixels
+
+        Parameters:
+        -----------
+        * phi, chi, eta, mu, nu, delta are the goniometer angles
+          (degrees), angles passed as None are taken from gonio.angles
+
+        Outputs:
+        --------
+        * (H,K,L) each a (nrows x ncols) array
+        """
+        ang = self._angles(phi,chi,eta,mu,nu,delta)
+        k   = 2.*num.pi/self.gonio.lattice.lam
+        Z   = gonio_psic.calc_Z(phi=ang['phi'],chi=ang['chi'],
+                                eta=ang['eta'],mu=ang['mu'])
+        D   = gonio_psic.calc_D(nu=ang['nu'],delta=ang['delta'])
+        # M = inv(UB)*inv(Z)/(2pi), Z is a rotation so inv(Z) = Z^t
+        M   = num.dot(self.gonio._get_UBinv(),Z.T)/(2.*num.pi)
+        A   = k*num.dot(M,D)
+        b   = k*M[:,1]
+        h   = num.dot(A,self._get_pn()) - b[:,num.newaxis]
+        h   = h.reshape((3,) + self.shape)
+        return (h[0],h[1],h[2])
+
+    def calc_hkl_scan(self,phi=None,chi=None,eta=None,mu=None,nu=None,
+                      delta=None):
+        """
+        Generator returning the (H,K,L) pixel maps for each point
+        of a scan.  Angles are arrays (or scalars, None -> gonio.angles)
+
+        Example:
+        --------
+        >>for (H,K,L) in pm.calc_hkl_scan(eta=scan['eta'],...):
+        >>    ...
+        """
+        ang = {'phi':phi,'chi':chi,'eta':eta,'mu':mu,'nu':nu,'delta':delta}
+        npts = 1
+        for key in ang.keys():
+            if ang[key] is None: ang[key] = self.gonio.angles[key]
+            ang[key] = num.atleast_1d(num.asarray(ang[key],dtype=float))
+            npts = max(npts,len(ang[key]))
+        for key in ang.keys():
+            if len(ang[key]) != npts:
+                ang[key] = num.resize(ang[key],npts)
+        for j in range(npts):
+            yield self.calc_hkl(phi=ang['phi'][j],chi=ang['chi'][j],
+                                eta=ang['eta'][j],mu=ang['mu'][j],
+                                nu=ang['nu'][j],delta=ang['delta'][j])
+
+    ###################################################
+    def hkl_to_pixel(self,h,phi=None,chi=None,eta=None,mu=None,nu=None,
+                     delta=None):
+        """
+        Calculate the (fractional) pixel (row,col) at which the
+        reciprocal lattice point h=[h,k,l] is found for the given angles.
+
+        Returns (nan,nan) if the scattered beam does not reach the
+        detector plane.  Note the pixel may be outside the detector.
+        """
+        ang = self._angles(phi,chi,eta,mu,nu,delta)
+        k   = 2.*num.pi/self.gonio.lattice.lam
+        Z   = gonio_psic.calc_Z(phi=ang['phi'],chi=ang['chi'],
+                                eta=ang['eta'],mu=ang['mu'])
+        D   = gonio_psic.calc_D(nu=ang['nu'],delta=ang['delta'])
+        Q   = 2.*num.pi*num.dot(Z,num.dot(self.gonio.UB,num.asarray(h,float)))
+        kr  = Q + num.array([0.,k,0.])
+        # phi frame direction of kr
+        pn  = num.dot(D.T,kr)/k
+        # solve t*pn = [0,d,0] + a*row_dir + b*col_dir
+        A   = num.array([pn,-self.row_dir,-self.col_dir]).T
+        try:
+            (t,a,b) = num.linalg.solve(A,num.array([0.,self.distance,0.]))
+        except num.linalg.LinAlgError:
+            return (num.nan,num.nan)
+        if t <= 0:
+            return (num.nan,num.nan)
+        row = self.center[0] + a/self.pixel_size[0]
+        col = self.center[1] + b/self.pixel_size[1]
+        return (row,col)
 
-"""
+###########################################################
+def pixel_hkl(gonio,shape,distance=1000.,pixel_size=0.172,center=None,
+              row_dir=[1.,0.,0.],col_dir=[0.,0.,1.]):
+    """
+    Calculate (H,K,L) for each pixel of an image at the current
+    gonio angles (see PixelMap)
+    """
+    pm = PixelMap(gonio,distance=distance,pixel_size=pixel_size,
+                  center=center,shape=shape,row_dir=row_dir,
+                  col_dir=col_dir)
+    return pm.calc_hkl()
 
+###########################################################
+def test_pixel_map(npts=5):
+    """
+    Check the PixelMap arrays against per pixel calculations: the
+    center pixel against gonio.h, other pixels against the explicit
+    vector calculation and the hkl_to_pixel inverse, and
+    calc_hkl_scan against calc_hkl
+    """
+    psic = gonio_psic.test2(show=False)
+    pm = PixelMap(psic,distance=1000.,pixel_size=0.172,center=(97,243),
+                  shape=(195,487))
+    k = 2.*num.pi/psic.lattice.lam
+    r = num.random.RandomState(0)
+    angles = {'phi':r.uniform(170.,180.,npts),'chi':r.uniform(-1.,1.,npts),
+              'eta':r.uniform(0.,2.,npts),'mu':r.uniform(20.,25.,npts),
+              'nu':r.uniform(40.,50.,npts),'delta':r.uniform(0.,5.,npts)}
+    scan = pm.calc_hkl_scan(**angles)
+    for j in range(npts):
+        ang = dict([(key,val[j]) for (key,val) in angles.items()])
+        psic.set_angles(**ang)
+        (H,K,L) = pm.calc_hkl(**ang)
+        assert num.allclose([H[97,243],K[97,243],L[97,243]],psic.h), \
+               "center pixel hkl"
+        (Hs,Ks,Ls) = scan.next()
+        assert num.allclose(Hs,H) and num.allclose(Ks,K) and \
+               num.allclose(Ls,L), "calc_hkl_scan"
+        Q = pm.calc_Q(nu=ang['nu'],delta=ang['delta'])
+        D = gonio_psic.calc_D(nu=ang['nu'],delta=ang['delta'])
+        for (row,col) in ((0,0),(10,400),(194,486),(150,17)):
+            p  = num.array([(row-97)*0.172,1000.,(col-243)*0.172])
+            kr = k*num.dot(D,p/num.sqrt(num.sum(p*p)))
+            q  = kr - num.array([0.,k,0.])
+            h  = num.dot(psic._get_UBinv(),num.dot(psic.Z.T,q))/(2.*num.pi)
+            assert num.allclose(Q[row,col],q), "pixel Q"
+            assert num.allclose([H[row,col],K[row,col],L[row,col]],h), \
+                   "pixel hkl"
+            assert num.allclose(pm.hkl_to_pixel(h,**ang),(row,col)), \
+                   "hkl_to_pixel"
+    print "PixelMap matches the per pixel calculations"
 
+###########################################################
+if __name__ == "__main__":
+    """
+    test
+    """
+    test_pixel_map()
@@ -420,6 +420,192 @@ def poly_area_num(polygon,diameter=None,num_int=100,plot=False):
             pyplot.plot(pline[0][j],pline[1][j],'k-')
     return A
 
+##################################################################
+# Array (batched) polygon operations.  
+# A set of npts polygons is held in an array dimensioned
+# (npts x nvert x 2) along with an array (npts) of the number
+# of valid vertices in each polygon.  The valid vertices are
+# always the leading entries of each row and are in cyclic
+# (cw or ccw) order.
+##################################################################
+def poly_area_array(poly,nvert=None):
+    """
+    Shoelace area of a set of polygons
+
+    Parameters:
+    -----------
+    * poly is an array (npts x nvert x 2) of polygon vertices,
+      in cyclic order
+    * nvert is an array (npts) of the number of valid vertices
+      in each polygon.  If None all vertices are used.
+
+    Outputs:
+    --------
+    * array (npts) of polygon areas (always positive)
+    """
+    return num.fabs(_signed_area_array(poly,nvert))
+
+def _signed_area_array(poly,nvert=None):
+    """ shoelace area, positive for ccw polygons """
+    poly = num.asarray(poly,dtype=float)
+    (npts,nv) = poly.shape[:2]
+    if nvert is None: nvert = num.zeros(npts,dtype=int) + nv
+    if nv == 0: return num.zeros(npts)
+    nxt = _next_idx(nvert,nv)
+    rows = num.arange(npts)[:,num.newaxis]
+    p2 = poly[rows,nxt]
+    a = poly[:,:,0]*p2[:,:,1] - p2[:,:,0]*poly[:,:,1]
+    a[num.arange(nv)[num.newaxis,:] >= nvert[:,num.newaxis]] = 0.
+    a = 0.5*a.sum(axis=1)
+    a[nvert < 3] = 0.
+    return a
+
+def _next_idx(nvert,nv):
+    """ index of the next vertex of each (valid) vertex """
+    idx = num.arange(nv)[num.newaxis,:] + 1
+    n   = num.maximum(nvert,1)[:,num.newaxis]
+    return num.where(idx >= n, 0, idx)
+
+def clip_polygon_array(poly,nvert,clip):
+    """
+    Intersect a set of polygons with a set of convex polygons
+    (Sutherland-Hodgman clipping)
+
+    Parameters:
+    -----------
+    * poly is an array (npts x nvert x 2) of the polygons to clip,
+      these may be non-convex
+    * nvert is an array (npts) of the number of valid vertices
+      in each polygon
+    * clip is an array (npts x nclip x 2) of convex clip polygons
+      (all with nclip vertices), either cw or ccw order
+
+    Outputs: (poly,nvert)
+    --------
+    * the vertices and vertex counts of the intersections
+
+    Notes:
+    ------
+    If the subject polygon is non-convex the clipped polygon may
+    contain degenerate (zero area) edges, the area is still correct.
+    A degenerate (zero area) clip polygon, e.g. closed slits, gives
+    an empty intersection (nvert = 0).
+    """
+    poly  = num.asarray(poly,dtype=float)
+    clip  = num.asarray(clip,dtype=float)
+    nvert = num.asarray(nvert,dtype=int).copy()
+    npts  = poly.shape[0]
+    nclip = clip.shape[1]
+    rows  = num.arange(npts)[:,num.newaxis]
+    orient = num.sign(_signed_area_array(clip))
+    nvert[orient == 0] = 0
+    for j in range(nclip):
+        nv = poly.shape[1]
+        if nv == 0: break
+        a = clip[:,j,:][:,num.newaxis,:]
+        b = clip[:,(j+1)%nclip,:][:,num.newaxis,:]
+        e = b - a
+        # f >= 0 for points on the inside of the edge
+        def _f(p):
+            return orient[:,num.newaxis]*(e[:,:,0]*(p[:,:,1]-a[:,:,1]) -
+                                          e[:,:,1]*(p[:,:,0]-a[:,:,0]))
+        valid = num.arange(nv)[num.newaxis,:] < nvert[:,num.newaxis]
+        prv   = (num.arange(nv)[num.newaxis,:] - 1) % num.maximum(nvert,1)[:,num.newaxis]
+        cur   = poly
+        prev  = poly[rows,prv]
+        fc = _f(cur)
+        fp = _f(prev)
+        cin = fc >= 0.
+        pin = fp >= 0.
+        # intercept of the prev->cur segment with the edge
+        cross = (cin != pin) & valid
+        denom = num.where(cross, fp - fc, 1.)
+        t = (fp/denom)[:,:,num.newaxis]
+        inter = prev + t*(cur - prev)
+        # output the intercept (if any) then the current point (if inside)
+        out = num.empty((npts,2*nv,2))
+        out[:,0::2] = inter
+        out[:,1::2] = cur
+        keep = num.empty((npts,2*nv),dtype=bool)
+        keep[:,0::2] = cross
+        keep[:,1::2] = cin & valid
+        # compact the valid vertices to the front of each row
+        order = num.argsort(~keep,axis=1,kind='mergesort')
+        nvert = keep.sum(axis=1)
+        nmax  = max(int(nvert.max()),0)
+        poly  = out[rows,order[:,:nmax]]
+    return (poly,nvert)
+
+def circle_poly_area_array(poly,nvert,radius):
+    """
+    Area of the intersection of a set of polygons with a circle
+    centered on the origin (computed analytically)
+
+    Parameters:
+    -----------
+    * poly is an array (npts x nvert x 2) of polygon vertices
+    * nvert is an array (npts) of the number of valid vertices
+    * radius is the circle radius
+
+    Outputs:
+    --------
+    * array (npts) of areas
+
+    Notes:
+    ------
+    The area is the sum over the polygon edges of the signed area
+    of the intersection of the circle with the triangle formed by
+    the origin and the edge end points.  Each edge is split into
+    the part inside the circle (contributes a triangle) and the parts
+    outside (contribute circular sectors).
+    """
+    poly = num.asarray(poly,dtype=float)
+    (npts,nv) = poly.shape[:2]
+    if nv == 0: return num.zeros(npts)
+    r2   = float(radius)**2.
+    rows = num.arange(npts)[:,num.newaxis]
+    p = poly
+    q = poly[rows,_next_idx(nvert,nv)]
+    d = q - p
+    a = (d*d).sum(axis=2)
+    b = (p*d).sum(axis=2)
+    c = (p*p).sum(axis=2) - r2
+    disc = b*b - a*c
+    hit  = (disc > 0.) & (a > 0.)
+    sq   = num.sqrt(num.where(hit,disc,0.))
+    a_   = num.where(hit,a,1.)
+    t1 = num.where(hit,num.clip((-b - sq)/a_,0.,1.),0.)
+    t2 = num.where(hit,num.clip((-b + sq)/a_,0.,1.),0.)
+    p1 = p + t1[:,:,num.newaxis]*d
+    p2 = p + t2[:,:,num.newaxis]*d
+    def _cross(u,v): return u[:,:,0]*v[:,:,1] - u[:,:,1]*v[:,:,0]
+    def _sector(u,v):
+        return 0.5*r2*num.arctan2(_cross(u,v),(u*v).sum(axis=2))
+    A = _sector(p,p1) + 0.5*_cross(p1,p2) + _sector(p2,q)
+    A[num.arange(nv)[num.newaxis,:] >= nvert[:,num.newaxis]] = 0.
+    A = num.fabs(A.sum(axis=1))
+    A[nvert < 3] = 0.
+    return A
+
+def sort_points_array(poly):
+    """
+    Sort the vertices of a set of polygons (npts x nvert x 2) by
+    angle (ccw w/r/t the x-axis), see sort_points
+    """
+    poly = num.asarray(poly,dtype=float)
+    ang  = num.arctan2(poly[:,:,1],poly[:,:,0]) % (2.*num.pi)
+    idx  = num.argsort(ang,axis=1,kind='mergesort')
+    return poly[num.arange(len(poly))[:,num.newaxis],idx]
+
+def rect_polygon(width,length):
+    """
+    Return the corners of a rectangle ([x,y] points) centered
+    on the origin with total width along x and length along y
+    """
+    x = 0.5*width
+    y = 0.5*length
+    return [[x,y],[-x,y],[-x,-y],[x,-y]]
+
 ##################################################################
 def poly_y_intercepts(polygon):
     """
@@ -562,6 +748,48 @@ def test():
     plot_polygon(inner,fmt='g--',linewidth=4)
     plot_circle(diameter/2.)
 
+def test_array(ntest=100):
+    """
+    Check the array polygon operations against the scalar versions:
+    clipped areas against inner_polygon/poly_area, circle areas
+    against poly_area_num (and exact limits), and the empty result
+    for a degenerate clip polygon
+    """
+    r = num.random.RandomState(0)
+    sample = [[1.,1.], [.5,1.5], [-1.,1.], [-1.,-1.],[0.,.5],[1.,-1.]]
+    polys = []
+    clips = []
+    for j in range(ntest):
+        (th,sc) = (r.uniform(0.,360.),r.uniform(.5,1.5))
+        polys.append([trans_point(p,theta=th,scale=sc) for p in sample])
+        (w,l,th) = (r.uniform(.2,3.),r.uniform(.2,3.),r.uniform(0.,360.))
+        clips.append([trans_point(p,theta=th) for p in rect_polygon(w,l)])
+    # the scalar routines sort the vertices by angle
+    polys = sort_points_array(polys)
+    clips = sort_points_array(clips)
+    nvert = num.zeros(ntest,dtype=int) + polys.shape[1]
+    # clipping
+    (cp,cn) = clip_polygon_array(polys,nvert,clips)
+    area = poly_area_array(cp,cn)
+    for j in range(ntest):
+        ref = poly_area(inner_polygon(clips[j],polys[j]))
+        assert abs(area[j] - ref) < 1.e-10, "clip_polygon_array area"
+    # circle
+    diam = r.uniform(.5,3.,ntest)
+    nclip = num.zeros(ntest,dtype=int) + 4
+    for j in range(ntest):
+        a = circle_poly_area_array(clips[j:j+1],nclip[j:j+1],diam[j]/2.)[0]
+        ref = poly_area_num(clips[j],diameter=diam[j],num_int=2000)
+        assert abs(a - ref) < 1.e-3*ref, "circle_poly_area_array area"
+    big = num.array([rect_polygon(10.,10.),rect_polygon(1.,1.)])
+    a = circle_poly_area_array(big,num.array([4,4]),1.)
+    assert num.allclose(a,[num.pi,1.]), "circle_poly_area_array limits"
+    # degenerate (zero area) clip polygon
+    line = num.array([[[0.,1.],[0.,1.],[0.,-1.],[0.,-1.]]])
+    (cp,cn) = clip_polygon_array(polys[:1],nvert[:1],line)
+    assert cn[0] == 0, "degenerate clip polygon"
+    print "array polygon operations match the scalar versions"
+
 ##########################################################################
 if __name__ == "__main__":
     """
@@ -141,6 +141,11 @@ Example:
 ...>ocr_cor[j] = counts_cor[j].sum()/lt
 >>pyplot.plot(x,ocr)
 >>pyplot.plot(x,ocr_cor)
+
+# or for all points (and detectors) at once
+>>icr = calc_icr_array(ocr,tau)
+>>cor = correction_factor_array(rt,lt,icr,ocr)
+>>counts_cor = counts * cor[:,num.newaxis]
 """
 
 ##############################################################################
@@ -148,6 +153,7 @@ Example:
 import numpy as num
 import scipy
 from   scipy.optimize import leastsq
+from   scipy.special import lambertw
 
 ##############################################################################
 def correction_factor(rt,lt,icr = None,ocr = None):
@@ -188,16 +194,125 @@ def correct_data(data,rt,lt,icr=None,ocr=None):
     cor = correction_factor(rt,lt,icr,ocr)
     return data * cor
 
+def correction_factor_array(rt,lt,icr=None,ocr=None):
+    """
+    Calculate deadtime correction factors for arrays.
+
+    Parameters:
+    -----------
+    * rt, lt, icr and ocr are as in correction_factor, but may be
+      arrays (or scalars) of any shape that broadcast together
+    * icr and/or ocr may be None, in which case only the lt
+      correction is applied
+
+    Outputs:
+    -------
+    * cor = (icr/ocr)*(rt/lt), array with the broadcast shape.
+      Where icr or ocr is not valid (NaN or <= 0, eg from calc_icr_array
+      for non-correctable points) only the lt correction is applied.
+      Where rt or lt <= 0 cor is 1.
+    """
+    rt = num.asarray(rt,dtype=float)
+    lt = num.asarray(lt,dtype=float)
+    ok_t = (rt > 0) & (lt > 0)
+    cor  = num.where(ok_t, rt/num.where(ok_t,lt,1.), 1.)
+    if (icr is None) or (ocr is None):
+        return cor
+    icr = num.asarray(icr,dtype=float)
+    ocr = num.asarray(ocr,dtype=float)
+    with num.errstate(invalid='ignore'):
+        ok = num.isfinite(icr) & num.isfinite(ocr) & (icr > 0) & (ocr > 0)
+    ratio = num.where(ok, icr/num.where(ok,ocr,1.), 1.)
+    return cor * ratio
+
+def calc_correction_array(rt,lt,total_counts,input_counts=-1.,tau=-1.):
+    """
+    Calculate correction factors from arrays of detector count values,
+    eg dimensioned (points x detectors).  This applies the same logic
+    as Mca._calc_correction:
+
+      if tau > 0 icr is computed from the ocr (total_counts/lt)
+      if tau = 0 icr = ocr, ie only the lt correction
+      if tau < 0 and input_counts > 0 icr = input_counts/lt
+      otherwise only the lt correction is applied
+
+    Parameters:
+    -----------
+    * rt, lt, total_counts, input_counts and tau are arrays (or scalars)
+      that broadcast together
+
+    Outputs:
+    --------
+    * (cor, icr) arrays.  icr is NaN where it is not computed or
+      can not be corrected.
+    """
+    rt  = num.asarray(rt,dtype=float)
+    lt  = num.asarray(lt,dtype=float)
+    tot = num.asarray(total_counts,dtype=float)
+    inp = num.asarray(input_counts,dtype=float)
+    tau = num.asarray(tau,dtype=float)
+    ok_lt = lt > 0
+    flt   = num.where(ok_lt,lt,1.)
+    ocr = num.where(ok_lt & (tot > 0), tot/flt, num.nan)
+    icr_tau = calc_icr_array(ocr,num.where(tau >= 0, tau, 0.))
+    icr_inp = num.where(ok_lt & (inp > 0), inp/flt, num.nan)
+    icr = num.where(tau >= 0, icr_tau, icr_inp)
+    cor = correction_factor_array(rt,lt,icr,ocr)
+    cor = num.where(cor > 0, cor, 1.)
+    return (cor,icr)
+
+def calc_icr_array(ocr,tau,mask=False):
+    """
+    Calculate the true icr from arrays of ocr and deadtime factor tau.
+
+    The solution of
+
+        ocr = icr * exp(-icr*tau)    
+
+    on the low count rate side of the deadtime curve (icr < 1/tau) is
+    given by the principal branch of the Lambert W function:
+
+        icr = -W0(-ocr*tau)/tau
+
+    Parameters:
+    -----------
+    * ocr and tau are arrays (or scalars) of any shape that broadcast
+      together
+    * if mask is True also return the mask of valid points
+
+    Outputs:
+    --------
+    * icr array with the broadcast shape.  Points that cannot be corrected
+      (ocr <= 0, ocr >= exp(-1)/tau or not finite) are NaN.  Where tau <= 0
+      icr = ocr, ie icr/ocr = 1
+    * if mask is True returns (icr,mask), where mask is True for valid points
+    """
+    ocr = num.asarray(ocr,dtype=float)
+    tau = num.asarray(tau,dtype=float)
+    (ocr,tau) = num.broadcast_arrays(ocr,tau)
+    with num.errstate(invalid='ignore'):
+        valid = num.isfinite(ocr) & num.isfinite(tau) & (ocr > 0)
+    no_tau = valid & (tau <= 0)
+    x = num.where(valid & (tau > 0), -ocr*tau, 0.)
+    # cannot correct if ocr is at or above the top of the curve
+    valid = valid & (x > -num.exp(-1.))
+    x = num.where(valid, x, 0.)
+    with num.errstate(invalid='ignore',divide='ignore'):
+        icr = -lambertw(x,0).real / num.where(no_tau, 1., tau)
+    icr = num.where(no_tau, ocr, icr)
+    icr = num.where(valid, icr, num.nan)
+    if mask:
+        return (icr, valid)
+    return icr
+
 def calc_icr(ocr,tau):
     """
     Calculate the true icr from a given ocr and corresponding deadtime factor
-    tau using a Newton-Raphson algorithm to solve the following expression.  
+    tau by solving the following expression (see calc_icr_array)
 
         ocr = icr * exp(-icr*tau)    
 
-    Returns None if the loop cannot converge
-    
-    Note below could be improved!
+    Returns None if the ocr cannot be corrected
     """
     # error checks
     if ocr == None: return None
@@ -216,30 +331,8 @@ def calc_icr(ocr,tau):
         print 'ocr exceeds maximum correctible value of %g cps' % max_ocr
         return None
 
-    # Newton loop
-    x1 = ocr
-    cnt = 0
-    while (1):
-        f  = ocr - x1*num.exp(-x1*tau)
-        df = num.exp(-x1*tau) * (x1*tau - 1)
-        x2 = x1 - f/df
-        check = abs(  x2 - x1  )
-        if ( check < 0.01) :
-            icr = x1
-            break
-        else:
-            x1 = x2
-            if (x1 > max_icr):
-                # went over the top, we assume that
-                # the icr is less than 1/tau
-                x1 = 1.1 * ocr
-        if cnt > 100:
-            print 'Warning: icr calculation failed to converge'
-            icr = None
-            break
-        else:
-            cnt = cnt + 1
-
+    icr = float(calc_icr_array(ocr,tau))
+    if num.isnan(icr): return None
     return icr
 
 ##############################################################################
@@ -282,6 +375,71 @@ def fit(Io,ocr,offset=True):
     npts = len(Io)
     if len(ocr) != npts: return None
 
+    params = _fit_guess(Io,ocr,offset)
+    result = leastsq(deadtime_residual,params,args = (Io,ocr,offset))
+    #result = leastsq(deadtime_residual,params,args = (Io,ocr,offset),full_ouput=True)
+    params = result[0]
+
+    return params
+
+def fit_array(Io,ocr,offset=True):
+    """
+    Fit deadtime curves for several detectors sharing the same Io
+
+    Each detector is fit independently (with analytic derivatives),
+    see fit for the model.
+
+    Parameters:
+    -----------
+    * Io is an array (npts) from a linear detector (counts/sec)
+    * ocr is an array (ndet x npts) of output count rates for each
+      detector, eg from MedScan.ocr()
+    * If offset = False, off = 0.0 and only tau and a are returned
+
+    Outputs:
+    --------
+    * params array (ndet x 3), columns are tau, a and off
+      (ndet x 2 if offset is False)
+
+    Example:
+    --------
+    >>params = fit_array(Io/time,medscan.ocr())
+    >>tau = params[:,0]
+    """
+    Io  = num.array(Io,dtype=float)
+    ocr = num.atleast_2d(num.array(ocr,dtype=float))
+    (ndet,npts) = ocr.shape
+    if len(Io) != npts: return None
+    if offset:
+        npar = 3
+    else:
+        npar = 2
+    params = num.zeros((ndet,npar))
+    for k in range(ndet):
+        p0 = _fit_guess(Io,ocr[k],offset)
+        result = leastsq(deadtime_residual,p0,args=(Io,ocr[k],offset),
+                         Dfun=_deadtime_jac,col_deriv=1)
+        params[k] = result[0]
+    return params
+
+def _deadtime_jac(params,Io,ocr,offset):
+    """
+    derivatives of deadtime_residual with respect to the
+    params (one row per parameter)
+    """
+    tau = params[0]
+    icr = params[1]*Io
+    if offset: icr = icr + params[2]
+    e    = num.exp(-icr*tau)
+    dicr = -e*(1. - icr*tau)
+    jac  = [icr**2 * e, dicr*Io]
+    if offset: jac.append(dicr)
+    return num.array(jac)
+
+def _fit_guess(Io,ocr,offset):
+    """ initial guess for deadtime fit """
+    npts = len(Io)
+
     # make a guess at tau, assume max(ocr) is the top of the deadtime curve
     tau = 1./ (num.exp(1.) * max(ocr) )
 
@@ -305,11 +463,6 @@ def fit(Io,ocr,offset=True):
         params = (tau,a,off)
     else:
         params = (tau,a)
-            
-    result = leastsq(deadtime_residual,params,args = (Io,ocr,offset))
-    #result = leastsq(deadtime_residual,params,args = (Io,ocr,offset),full_ouput=True)
-    params = result[0]
-
     return params
 
 def calc_ocr(params,Io,offset):
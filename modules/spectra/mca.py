@@ -13,10 +13,19 @@ Authors/Modifications:
 import numpy as num
 import math
 import types
+import itertools
 
 from tdl.modules.spectra import deadtime
 from tdl.modules.spectra import calibration as calib
 
+########################################################################
+# attributes that change Mca.get_data/get_energy, setting any of
+# these sets Mca._version to a new (globally unique) value, used by
+# Med to cache its data
+MCA_DATA_ATTRS = ('data','channels','tau','cor_factor',
+                  'offset','slope','quad')
+_MCA_VERSION = itertools.count(1)
+
 ########################################################################
 class Mca:
     """
@@ -133,6 +142,22 @@ class Mca:
         self.init_params(mca_params=kws)
         self.init_data(data=data,channels=channels) 
 
+    def __setattr__(self,name,val):
+        """
+        set attribute, updates _version if the data, channels,
+        correction or calibration change.  Note in place changes
+        (eg mca.data[10] = 0) are not tracked, use touch()
+        """
+        self.__dict__[name] = val
+        if name in MCA_DATA_ATTRS:
+            self.__dict__['_version'] = _MCA_VERSION.next()
+
+    def touch(self,):
+        """
+        Mark the data as modified (after in place changes)
+        """
+        self.__dict__['_version'] = _MCA_VERSION.next()
+
     ###############################################################################
     def init_params(self, mca_params={}):
         """
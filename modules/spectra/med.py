@@ -15,6 +15,12 @@ Conventions for Med.get_data and Med.get_energy:
                    bad det's are zeros
  * If Med.align == True the first good detector will be used as the energy reference
  * If Med.correct == True deadtime corrections will be applied on Med.get_data()
+
+Alignment uses a sparse linear interpolation operator for each detector
+(see align_operator), the operators are combined into a single block
+matrix and applied to all detectors in one product.  The operator and the
+result of Med.get_data are cached until the data, calibration, tau/correction
+factors, bad_mca_idx or the align/total/correct flags change.
  
 """
 
@@ -23,6 +29,7 @@ Conventions for Med.get_data and Med.get_energy:
 import numpy as num
 import types
 import exceptions
+from scipy import sparse
 
 from tdl.modules.spectra import mca
 from tdl.modules.spectra import calibration as calib
@@ -88,10 +95,23 @@ class Med:
         self.align       = True
         self.correct     = True
 
+        # cached alignment operator and data
+        self._align_cache = None
+        self._data_cache  = None
+
         # update params
         self.init_params(params=kws)
         self.update_correction(tau=None)
         
+    def __getstate__(self,):
+        """
+        pickle without the data cache (the mca versions are only
+        unique within a process)
+        """
+        state = self.__dict__.copy()
+        state['_data_cache'] = None
+        return state
+
     ########################################################################
     def re_init(self,n_detectors=1,nchans=2048,**kws):
         """
@@ -220,6 +240,24 @@ class Med:
           [n_detectors, nchans]
             
           If the "total" keyword is set then the array dimensions are [1,nchans]
+
+        Notes:
+        ------
+        The result is cached until the med params or the mca data,
+        corrections or calibrations are set.  After changing mca data
+        in place call mca.touch()
+        """
+        key   = self._data_key()
+        cache = getattr(self,'_data_cache',None)
+        if (cache != None) and (cache[0] == key):
+            return cache[1].copy()
+        data = self._calc_data()
+        self._data_cache = (key, data)
+        return data.copy()
+
+    def _calc_data(self,):
+        """
+        Compute the (corrected, aligned and totaled) data array
         """
         # see how many channels, all mcas must be same length!!
         temp = self.mca[0].get_data()
@@ -235,14 +273,10 @@ class Med:
 
         # align if requested.
         if self.align == True and self.n_detectors > 1:
-            first_good = self._get_align_idx()
-            ref_energy = self.mca[first_good].get_energy()
-            for d in range(self.n_detectors):
-                if d not in self.bad_mca_idx:
-                    energy = self.mca[d].get_energy()
-                    temp   = spline_interpolate(energy, data[d,:], ref_energy)
-                    # note adding .5 rounds the data
-                    data[d,:] = (temp+.5).astype(num.int)
+            op   = self._get_align_operator()
+            temp = op * data.ravel().astype(float)
+            # note adding .5 rounds the data
+            data = (temp.reshape(data.shape)+.5).astype(num.int)
 
         # make a total if requested. 
         if self.total == True and self.n_detectors > 1:
@@ -305,6 +339,55 @@ class Med:
                 ret.append(mca.get_calib_params())
             return ret
 
+    #########################################################################
+    def _get_align_operator(self,):
+        """
+        Get the block diagonal operator that aligns all detectors
+        to the first good detector.  The operator is [n_detectors*nchans,
+        n_detectors*nchans] and is applied to the flattened data array.
+        Rows for bad detectors are zero.
+        """
+        first_good = self._get_align_idx()
+        key = (first_good, tuple(self.bad_mca_idx), self._calib_key())
+        cache = getattr(self,'_align_cache',None)
+        if (cache != None) and (cache[0] == key):
+            return cache[1]
+        ref_energy = self.mca[first_good].get_energy()
+        nchans = len(ref_energy)
+        ops = []
+        for d in range(self.n_detectors):
+            if d in self.bad_mca_idx:
+                ops.append(sparse.csr_matrix((nchans,nchans)))
+            elif d == first_good:
+                ops.append(sparse.identity(nchans,format='csr'))
+            else:
+                energy = self.mca[d].get_energy()
+                ops.append(align_operator(energy,ref_energy))
+        op = sparse.block_diag(ops,format='csr')
+        self._align_cache = (key, op)
+        return op
+
+    def _calib_key(self,):
+        """ calibration parameters of all detectors (alignment cache key) """
+        key = []
+        for m in self.mca:
+            ch = num.asarray(m.channels)
+            if len(ch) > 0:
+                key.append((m.offset,m.slope,m.quad,len(ch),ch[0],ch[-1]))
+            else:
+                key.append((m.offset,m.slope,m.quad,0,0,0))
+        return tuple(key)
+
+    def _data_key(self,):
+        """
+        key for the get_data cache, the mcas bump their _version
+        when the data, correction or calibration are set (see
+        mca.Mca.__setattr__)
+        """
+        mcas = tuple([getattr(m,'_version',None) for m in self.mca])
+        return (mcas, tuple(self.bad_mca_idx), self.correct, self.align,
+                self.total, self.n_detectors)
+
     #########################################################################
     def _get_align_idx(self,):
         """ find first good detector for alignment """
@@ -337,6 +420,43 @@ class Med:
 
         return (en,da)
 
+################################################################################
+def align_operator(energy, ref_energy):
+    """
+    Sparse linear interpolation operator for energy alignment
+
+    Parameters:
+    -----------
+    * energy is the (monotonic) energy array of the detector
+    * ref_energy is the energy array to align to
+
+    Outputs:
+    --------
+    * sparse matrix op [len(ref_energy), len(energy)] such that
+      op * data gives data interpolated onto ref_energy
+
+    Notes:
+    ------
+    Each row has at most two non-zero weights.  Values outside
+    the range of energy are set to the end points (as num.interp).
+    """
+    energy     = num.asarray(energy,dtype=float)
+    ref_energy = num.asarray(ref_energy,dtype=float)
+    n    = len(energy)
+    nref = len(ref_energy)
+    if n == 1:
+        return sparse.csr_matrix(num.ones((nref,1)))
+    idx = num.searchsorted(energy,ref_energy,side='right') - 1
+    idx = num.clip(idx,0,n-2)
+    w   = (ref_energy - energy[idx]) / (energy[idx+1] - energy[idx])
+    w   = num.clip(w,0.,1.)
+    rows = num.arange(nref)
+    op = sparse.csr_matrix((num.concatenate((1.-w,w)),
+                            (num.concatenate((rows,rows)),
+                             num.concatenate((idx,idx+1)))),
+                           shape=(nref,n))
+    return op
+
 ################################################################################
 ################################################################################
 """
@@ -8,6 +8,17 @@ Authors/Modifications:
 * See http://cars9.uchicago.edu/software/python/index.html
 * Modified for Tdl, tpt
 
+Notes:
+------
+The ascii reader parses the header tags into a list of (tag,value) pairs
+and reads the DATA block in one call into an integer array.  With
+cache=True the parsed header and data are saved to a binary (.npz) file
+(file + '.npz', or in cache_dir) along with the modification time of
+the ascii file.  Subsequent reads use the cache if the mtime is unchanged.
+
+read_med_files and read_mca_files can read the files concurrently
+using a process (or thread) pool, see nproc.
+
 """
 
 #########################################################################
@@ -15,6 +26,8 @@ Authors/Modifications:
 import numpy as num
 import string
 import os
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 from tdl.modules.spectra.mca import Mca
 from tdl.modules.spectra.med import Med
@@ -40,22 +53,67 @@ class Environment:
 
 ##############################################################################
 def read_med_files(file_prefix,start=0,end=100,nfmt=3,
-                   bad_mca_idx=[],total=True,align=True,correct=True,tau=None):
+                   bad_mca_idx=[],total=True,align=True,correct=True,tau=None,
+                   nproc=1,threads=False,cache=False,cache_dir=None):
     """
     Read multiple files given prefix, start and end numbers and fmt len
+
+    Parameters:
+    -----------
+    * nproc is the number of worker processes (or threads) used to
+      read the files.  nproc=1 (default) reads serially, nproc=None
+      uses the number of cpus
+    * if threads is True use a thread pool rather than a process pool
+    * cache and cache_dir are passed to read_ascii_file
+
+    See read_med for the other arguments
     """
-    med = []
+    files = _file_range(file_prefix,start,end,nfmt)
+    args  = []
+    for file in files:
+        args.append((file,{'bad_mca_idx':bad_mca_idx,'total':total,
+                           'align':align,'correct':correct,'tau':tau,
+                           'cache':cache,'cache_dir':cache_dir}))
+    return _map_files(_read_med_args,args,nproc=nproc,threads=threads)
+
+def _read_med_args(args):
+    """ worker for read_med_files """
+    (file,kws) = args
+    return read_med(file,**kws)
+
+def _file_range(file_prefix,start,end,nfmt):
+    """ list of file names file_prefix.nnn """
     format = '%' + str(nfmt) + '.' + str(nfmt) + 'd'
+    files = []
     for j in range(start,end+1):
-        ext   = format % j
-        file  = file_prefix + '.' + ext
-        tmp   = read_med(file,bad_mca_idx=bad_mca_idx,total=total,
-                         align=align, correct=correct,tau=tau)
-        med.append(tmp)
-    return med
+        files.append(file_prefix + '.' + (format % j))
+    return files
+
+def _map_files(func,args,nproc=1,threads=False):
+    """
+    Apply func to each of args, in order, using a pool of
+    nproc processes (or threads)
+    """
+    if (nproc == None) or (nproc < 1):
+        nproc = multiprocessing.cpu_count()
+    nproc = min(nproc,len(args))
+    if nproc <= 1:
+        return map(func,args)
+    if threads:
+        pool = ThreadPool(nproc)
+    else:
+        pool = multiprocessing.Pool(nproc)
+    try:
+        chunk  = max(1,len(args)/(4*nproc))
+        result = pool.map(func,args,chunk)
+    finally:
+        pool.close()
+        pool.join()
+    return result
 
 ##############################################################################
-def read_med(file,bad_mca_idx=[],total=True,align=True,correct=True,tau=None):
+def read_med(file,bad_mca_idx=[],total=True,align=True,correct=True,tau=None,
+             cache=False,cache_dir=None):
     """
     Reads a disk file into an Med object. The file contains the information
     from the Med object which makes sense to store permanently, but does
@@ -64,6 +122,7 @@ def read_med(file,bad_mca_idx=[],total=True,align=True,correct=True,tau=None):
     Parameters:
     -----------
     * file: The name of the disk file to read.
+    * cache and cache_dir are passed to read_ascii_file
 
     Notes:
     ------
@@ -74,7 +133,7 @@ def read_med(file,bad_mca_idx=[],total=True,align=True,correct=True,tau=None):
 
     """
     # read the file
-    r = read_ascii_file(file)
+    r = read_ascii_file(file,cache=cache,cache_dir=cache_dir)
     if r == None: return None
 
     # some info
@@ -82,6 +141,8 @@ def read_med(file,bad_mca_idx=[],total=True,align=True,correct=True,tau=None):
     path, fname = os.path.split(file)
 
     # check for boge detectors
+    # (copy so bad detectors dont accumulate in the callers list)
+    bad_mca_idx = list(bad_mca_idx)
     check_det = True
     if check_det == True:
         for j in range(n_detectors):
@@ -106,21 +167,27 @@ def read_med(file,bad_mca_idx=[],total=True,align=True,correct=True,tau=None):
 
 ##############################################################################
 def read_mca_files(file_prefix,start=0,end=100,nfmt=3,
-                   detector=0,tau=None):
+                   detector=0,tau=None,nproc=1,threads=False,
+                   cache=False,cache_dir=None):
     """
     Read multiple files given prefix, start and end numbers and fmt len
+
+    See read_med_files for nproc, threads, cache and cache_dir
     """
-    data = []
-    format = '%' + str(nfmt) + '.' + str(nfmt) + 'd'
-    for j in range(start,end+1):
-        ext   = format % j
-        file  = file_prefix + '.' + ext
-        tmp   = read_mca(file,detector=detector,tau=tau)
-        data.append(tmp)
-    return data
+    files = _file_range(file_prefix,start,end,nfmt)
+    args  = []
+    for file in files:
+        args.append((file,{'detector':detector,'tau':tau,
+                           'cache':cache,'cache_dir':cache_dir}))
+    return _map_files(_read_mca_args,args,nproc=nproc,threads=threads)
+
+def _read_mca_args(args):
+    """ worker for read_mca_files """
+    (file,kws) = args
+    return read_mca(file,**kws)
 
 #############################################################################
-def read_mca(file, detector=0, tau=None):
+def read_mca(file, detector=0, tau=None, cache=False, cache_dir=None):
     """
     Reads a disk file into an MCA object.  
     If the data file has multiple detectors then the detector
@@ -129,6 +196,7 @@ def read_mca(file, detector=0, tau=None):
     Parameters:
     * file: The name of the disk file to read.
     * detector: Index of detector to read
+    * cache and cache_dir are passed to read_ascii_file
 
     Notes.
     ------
@@ -138,7 +206,7 @@ def read_mca(file, detector=0, tau=None):
       in the returned object as mca.rois
 
     """
-    r = read_ascii_file(file)
+    r = read_ascii_file(file,cache=cache,cache_dir=cache_dir)
     if r == None: return None
 
     path, fname = os.path.split(file)
@@ -155,7 +223,7 @@ def read_mca(file, detector=0, tau=None):
     return data
 
 ########################################################################
-def read_ascii_file(file):
+def read_ascii_file(file,cache=False,cache_dir=None):
     """
     Reads a disk file.  The file is a tagged ASCII format.
 
@@ -167,6 +235,9 @@ def read_ascii_file(file):
     Parameters:
     -----------
     * file: The name of the disk file to read.
+    * cache: If True use (or create) a binary cache of the file
+    * cache_dir: directory for the cache files, default is the
+      directory of the file
             
     Outputs:
     --------
@@ -181,35 +252,116 @@ def read_ascii_file(file):
     >>m = read_ascii_file('mca.001')
     >>m['elapsed'][0].real_time
     """
+    (header,data) = _read_file(file,cache=cache,cache_dir=cache_dir)
+    if header is None: return None
+    return _build_mcas(file,header,data)
+
+########################################################################
+def _cache_file(file,cache_dir=None):
+    """ name of the binary cache file """
+    if cache_dir == None:
+        return file + '.npz'
+    return os.path.join(cache_dir, os.path.basename(file) + '.npz')
+
+def _read_file(file,cache=False,cache_dir=None):
+    """
+    Read the header lines and the (flat) integer DATA array from
+    the file or from its cache.  Returns (None,None) on failure.
+    """
+    try:
+        mtime = os.path.getmtime(file)
+    except:
+        print "File '%s' not found" % file
+        return (None,None)
+    if cache:
+        cfile = _cache_file(file,cache_dir)
+        if os.path.exists(cfile):
+            try:
+                c = num.load(cfile)
+                try:
+                    if float(c['mtime']) == mtime:
+                        header = [str(h) for h in c['header']]
+                        data = c['data']
+                        if data.size == 0: data = None
+                        return (header,data)
+                finally:
+                    c.close()
+            except:
+                pass
     try:
         fp = open(file, 'r')
+        text = fp.read()
+        fp.close()
     except:
         print "File '%s' not found" % file
-        return None
-    
-    line = ''
- 
+        return (None,None)
+    (header,data) = _parse_text(text)
+    if cache:
+        if data is None:
+            cdata = num.array([],dtype=num.int)
+        else:
+            cdata = data
+        try:
+            num.savez(cfile,header=num.array(header,dtype=str),
+                      data=cdata,mtime=mtime)
+        except:
+            print "Unable to write cache file '%s'" % cfile
+    return (header,data)
+
+def _parse_text(text):
+    """
+    Split the file text into a list of header lines and
+    an integer array from the DATA block.  A blank line ends
+    the header (anything after it, including DATA, is ignored)
+    """
+    if text.startswith('DATA:'):
+        pos = 0
+    else:
+        pos = text.find('\nDATA:')
+        if pos > -1: pos = pos + 1
+    if pos == -1:
+        head = text
+    else:
+        head = text[0:pos]
+    header = []
+    for line in head.splitlines():
+        line = line.strip()
+        if line == '':
+            return (header,None)
+        header.append(line)
+    if pos == -1:
+        return (header,None)
+    idx = text.find('\n',pos)
+    if idx == -1:
+        data = num.array([],dtype=num.int)
+    else:
+        data = num.fromstring(text[idx+1:],dtype=num.int,sep=' ')
+    return (header,data)
+
+def _build_mcas(file,header,data):
+    """
+    Build the mca, roi and environment objects from the header
+    lines and the data array
+    """
     start_time = ''
     n_detectors = 0
     nchans = 0
     mcas = []
     max_rois = 0
+    nrois = []
     rois = []
     environment = []
-    data = None
 
-    while(1):
-        line = fp.readline()
-        line = line.strip()
-        if (line == ''): break
-        pos = string.find(line, ' ')
-        if (pos == -1): pos = len(line)
-        tag = line[0:pos]
-        value = string.strip(line[pos:])
-        values = string.split(value)
-
-        # scan through tags
-        # NOte the elements and channels tags
+    for line in header:
+        tv = line.split(None,1)
+        tag = tv[0]
+        if len(tv) > 1:
+            value = tv[1]
+        else:
+            value = ''
+        values = value.split()
+
+        # Note the elements and channels tags
         # should be at the top of the file,
         # elements comes before channels!
         if (tag == 'VERSION:'):
@@ -223,31 +375,13 @@ def read_ascii_file(file):
             for det in range(n_detectors):
                 name = 'mca%s' % str(det)
                 mcas.append(Mca(name=name,nchans=nchans))
-        elif (tag == 'REAL_TIME:'):
-            for d in range(n_detectors):
-                mcas[d].start_time = start_time
-                mcas[d].real_time = float(values[d])
-        elif (tag == 'LIVE_TIME:'):  
-            for d in range(n_detectors):
-                mcas[d].live_time = float(values[d])
-        elif (tag == 'INPUT_COUNTS:'):  
-            for d in range(n_detectors):
-                mcas[d].input_counts = float(values[d])
-        elif (tag == 'TAU:'):  
+        elif tag in _MCA_TAGS:
+            attr = _MCA_TAGS[tag]
             for d in range(n_detectors):
-                mcas[d].tau = float(values[d])
-        elif (tag == 'CAL_OFFSET:'):
-            for d in range(n_detectors):
-                mcas[d].offset = float(values[d])
-        elif (tag == 'CAL_SLOPE:'):
-            for d in range(n_detectors):
-                mcas[d].slope = float(values[d])
-        elif (tag == 'CAL_QUAD:'):  
-            for d in range(n_detectors):
-                mcas[d].quad = float(values[d])
-        elif (tag == 'TWO_THETA:'):
-            for d in range(n_detectors):
-                mcas[d].two_theta = float(values[d])
+                setattr(mcas[d],attr,float(values[d]))
+            if tag == 'REAL_TIME:':
+                for d in range(n_detectors):
+                    mcas[d].start_time = start_time
         # Note 'ROIS' tag must come before the 'ROI_' tags!
         elif (tag == 'ROIS:'):
             nrois = []
@@ -259,26 +393,24 @@ def read_ascii_file(file):
                 for d in range(n_detectors):
                     for r in range(nrois[d]):
                         rois[d].append(Roi())
-        # parse rois
+        # parse rois, tag = ROI_i_LEFT:, ROI_i_RIGHT: or ROI_i_LABEL:
+        # (ignored if there was no ROIS tag)
         elif (tag[0:4] == 'ROI_'):
-            for i in range(max_rois):
-                roi = 'ROI_'+str(i)+'_'
-                if (tag == roi+'LEFT:'):
-                    for d in range(n_detectors):
-                        if (i < nrois[d]):
-                            rois[d][i].left = int(values[d])
-                    break
-                elif (tag == roi+'RIGHT:'):
-                    for d in range(n_detectors):
-                        if (i < nrois[d]):
-                            rois[d][i].right = int(values[d])
-                    break
-                elif (tag == roi+'LABEL:'):
-                    labels = string.split(value, '&')
-                    for d in range(n_detectors):
-                        if (i < nrois[d]):
-                            rois[d][i].label = string.strip(labels[d])
-                    break
+            try:
+                (i,field) = tag[4:-1].split('_',1)
+                i = int(i)
+            except ValueError:
+                continue
+            if field == 'LABEL':
+                labels = string.split(value, '&')
+            for d in range(min(n_detectors,len(nrois))):
+                if (i < nrois[d]):
+                    if field == 'LEFT':
+                        rois[d][i].left = int(values[d])
+                    elif field == 'RIGHT':
+                        rois[d][i].right = int(values[d])
+                    elif field == 'LABEL':
+                        rois[d][i].label = string.strip(labels[d])
         elif (tag == 'ENVIRONMENT:'):
             env = Environment()
             p1 = string.find(value, '=')
@@ -287,19 +419,19 @@ def read_ascii_file(file):
             env.value = value[p1+2: p1+2+p2]
             env.description = value[p1+2+p2+3:-1]
             environment.append(env)
-        # DATA should be the final tag
-        elif (tag == 'DATA:'):
-            for chan in range(nchans):
-                line = fp.readline()
-                counts = string.split(line)
-                for d in range(n_detectors):
-                    mcas[d].data[chan]=int(counts[d])
-            for d in range(n_detectors):
-                mcas[d].total_counts = mcas[d].data.sum()
         else:
             print 'Unknown tag = '+tag+' in file: ' + file + '.'
-    ##########
-    fp.close()
+
+    # DATA, channels are rows and detectors are columns
+    if data is not None:
+        npts = nchans*n_detectors
+        if data.size < npts:
+            print "Incomplete DATA in file: %s" % file
+            return None
+        data = data[0:npts].reshape((nchans,n_detectors))
+        for d in range(n_detectors):
+            mcas[d].data = data[:,d].copy()
+            mcas[d].total_counts = mcas[d].data.sum()
 
     # Build dictionary to return
     r = {}
@@ -310,6 +442,16 @@ def read_ascii_file(file):
     r['environment'] = environment
     return r
 
+# header tags with one float value per detector --> Mca attribute
+_MCA_TAGS = {'REAL_TIME:':'real_time',
+             'LIVE_TIME:':'live_time',
+             'INPUT_COUNTS:':'input_counts',
+             'TAU:':'tau',
+             'CAL_OFFSET:':'offset',
+             'CAL_SLOPE:':'slope',
+             'CAL_QUAD:':'quad',
+             'TWO_THETA:':'two_theta'}
+
 #########################################################################
 def write_file(detector, file):
     """
@@ -280,6 +280,79 @@ def get_rois_dict(mca, bgr_width=3,correct=True):
         net[roi.label]   = roi.net
     return (total,net)
 
+##########################################################################
+def calc_rois(data, left, right, bgr_width=3, cor=None):
+    """
+    Compute ROI total and net counts for a stack of spectra
+
+    Parameters:
+    -----------
+    * data: array of counts with channels as the last axis, 
+      eg (points x detectors x channels)
+    * left, right: arrays of the roi left and right channels.  The last
+      axis is the roi index, eg (nrois,) for the same rois on all spectra
+      or (detectors x nrois) for rois defined per detector.  The leading
+      dimensions must broadcast against data.shape[:-1]
+    * bgr_width: number of channels used for the background on either side
+      of the roi (scalar or broadcastable with left)
+    * cor: deadtime correction factors (eg points x detectors), must broadcast
+      against data.shape[:-1].  The data are corrected (and rounded) as in
+      Mca.get_data(correct=True) before the rois are computed.
+
+    Outputs:
+    --------
+    * (total, net), integer arrays of shape data.shape[:-1] + (nrois,)
+
+    Notes:
+    ------
+    The results are the same as Roi.update_counts applied to each spectrum.
+    The sums are computed from cumulative sum (prefix) arrays so the cost
+    is independent of the roi widths.
+    """
+    data = num.asarray(data)
+    if cor is not None:
+        cor  = num.asarray(cor,dtype=float)[...,num.newaxis]
+        data = (cor*data + 0.5).astype(num.int)
+    shape  = data.shape[:-1]
+    nchans = data.shape[-1]
+    npnt   = int(num.prod(shape))
+
+    # prefix sums, psum[...,k] = data[...,0:k].sum()
+    if data.dtype.kind in ('i','u','b'):
+        psum = num.zeros(shape + (nchans+1,), dtype=num.int64)
+    else:
+        psum = num.zeros(shape + (nchans+1,), dtype=float)
+    num.cumsum(data, axis=-1, out=psum[...,1:])
+    psum = psum.reshape((npnt,nchans+1))
+
+    left  = num.asarray(left,dtype=num.int)
+    right = num.asarray(right,dtype=num.int)
+    nrois = left.shape[-1]
+    bw    = num.asarray(bgr_width,dtype=num.int)
+    oshape = shape + (nrois,)
+    left  = num.broadcast_to(left,oshape).reshape((npnt,nrois))
+    right = num.broadcast_to(right,oshape).reshape((npnt,nrois))
+    bw    = num.broadcast_to(bw,oshape).reshape((npnt,nrois))
+    row   = num.arange(npnt)[:,num.newaxis]
+
+    def _slice_sum(lo,hi):
+        # sum(data[lo:hi]) with python slice semantics (lo,hi >= 0)
+        lo = num.clip(lo,0,nchans)
+        hi = num.clip(hi,0,nchans)
+        hi = num.maximum(hi,lo)
+        return psum[row,hi] - psum[row,lo]
+
+    total = _slice_sum(left, right+1)
+    fbw   = num.where(bw > 0, bw, 1).astype(float)
+    ll    = num.maximum(left-bw, 0)
+    bgr_left  = num.where(bw > 0, _slice_sum(ll,left)/fbw, 0.)
+    rr    = num.minimum(right+bw, nchans-1)
+    bgr_right = num.where(bw > 0, _slice_sum(right+1,rr+1)/fbw, 0.)
+    n_sel = (right - left + 1).astype(float)
+    bgr   = num.trunc(((bgr_left + bgr_right)/2.0)*n_sel)
+    net   = total - bgr.astype(total.dtype)
+    return (total.reshape(oshape), net.reshape(oshape))
+
 ##########################################################################
 ##########################################################################
 def med_get_rois(med, bgr_width=3,correct=True):
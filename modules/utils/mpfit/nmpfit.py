@@ -1338,9 +1338,8 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
                 self.covar = numpy.zeros([nn, nn], numpy.float)
 
                 for i in range(n):
-                    #indices = ifree+ifree[i]*n
-                    #numpy.put(self.covar, indices, cv[:,i])
-                    numpy.put(self.covar, i, cv[:,i])
+                    indices = ifree+ifree[i]*nn
+                    numpy.put(self.covar, indices, cv[:,i])
                 ## Compute errors in parameters
                 catch_msg = 'computing parameter errors'
                 self.perror = numpy.zeros(nn, numpy.float)
@@ -1492,22 +1491,25 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
             mperr = 0
             fjac = numpy.zeros(nall, numpy.float)
             numpy.put(fjac, ifree, 1.0)  ## Specify which parameters need derivatives
-            [status, fp] = self.call(fcn, xall, functkw, fjac=fjac)
+            [status, fp, pderiv] = self.call(fcn, xall, functkw, fjac=fjac)
+            ## The user function returns the [m,nall] partial derivative
+            ## array of the model (see ANALYTIC DERIVATIVES above)
+            fjac = numpy.asarray(pderiv, dtype=numpy.float)
 
-            if len(fjac) != m*nall:
+            if fjac.size != m*nall:
                 print 'ERROR: Derivative matrix was not computed properly.'
                 return(None)
 
             ## This definition is c1onsistent with CURVEFIT
             ## Sign error found (thanks Jesus Fernandez <fernande@irm.chu-caen.fr>)
-            fjac.shape = [m,nall]
+            fjac = numpy.reshape(fjac, [m,nall])
             fjac = -fjac
 
             ## Select only the free parameters
             if len(ifree) < nall:
                 fjac = fjac[:,ifree]
                 fjac.shape = [m, n]
-                return(fjac)
+            return(fjac)
 
         fjac = numpy.zeros([m, n], numpy.float)
 
@@ -1857,7 +1859,7 @@ e.g. mpfit.status, mpfit.errmsg, mpfit.params, npfit.niter, mpfit.covar.
 
         for j in range(n):
             r[j:n,j] = r[j,j:n]
-        x = numpy.diagonal(r)
+        x = numpy.diagonal(r).copy()
         wa = qtb.copy()
 
         ## Eliminate the diagonal matrix d using a givens rotation
@@ -124,6 +124,11 @@ Inputs to calc
         Slope for the conversion from channel number to energy.
         Ie the slope from calibration
 
+calc uses an array implementation of the above (see calc_bgr),
+which also computes the backgrounds of a set of spectra
+(nspectra x nchans) in one call (see Background.calc_batch).
+The original per-channel version is kept as Background._calc_loop.
+
 Todo:
 -----
 * fix compress so works for arbitrary factor
@@ -135,7 +140,9 @@ Todo:
 #############################################################################
 
 import copy
+import hashlib
 import numpy as num
+from numpy.lib.stride_tricks import as_strided
 
 #############################################################################
 class Background:
@@ -262,6 +269,53 @@ class Background:
         -----------
         * data is the spectrum
         * slope is the slope of conversion channels to energy
+
+        Notes:
+        ------
+        Uses the array implementation (see calc_bgr).  The result
+        is stored in self.bgr
+        """
+        self.bgr = calc_bgr(data, slope=slope,
+                            bottom_width=self.bottom_width,
+                            top_width=self.top_width,
+                            exponent=self.exponent,
+                            tangent=self.tangent,
+                            compress=self.compress)
+        return self.bgr
+
+    ##################################################################################
+    def calc_batch(self, data, slope=1.0):
+        """
+        compute backgrounds for a set of spectra in one call
+
+        Parameters:
+        -----------
+        * data is a (nspectra x nchans) array
+        * slope is the slope of conversion channels to energy,
+          either a scalar or an array of length nspectra
+
+        Outputs:
+        --------
+        * (nspectra x nchans) array of backgrounds. Note self.bgr
+          is not modified
+        """
+        data = num.asarray(data, dtype=float)
+        if data.ndim != 2:
+            raise ValueError, "calc_batch requires a 2D (nspectra x nchans) array"
+        return calc_bgr(data, slope=slope,
+                        bottom_width=self.bottom_width,
+                        top_width=self.top_width,
+                        exponent=self.exponent,
+                        tangent=self.tangent,
+                        compress=self.compress)
+
+    ##################################################################################
+    def _calc_loop(self, data, slope=1.0):
+        """
+        compute background using per-channel loops
+
+        This is the reference implementation of the algorithm,
+        calc should give identical results.
         """
         REFERENCE_AMPL=100.
         TINY = 1.E-20
@@ -393,6 +447,335 @@ class Background:
         self.bottom_width = parameters[0]
         self.top_width    = parameters[1]
 
+    ##################################################################################
+    def _cache_key(self,):
+        """
+        Return a tuple of the parameters that determine the background
+        """
+        return (float(self.bottom_width), float(self.top_width),
+                int(self.exponent), bool(self.tangent), int(self.compress))
+
+#############################################################################
+class BgrCache:
+    """
+    Cache of computed backgrounds
+
+    Attributes:
+    -----------
+    * max_size = 256   # Max number of backgrounds to keep
+    * hits     = 0     # Number of lookups that reused a background
+    * misses   = 0     # Number of lookups that computed a background
+
+    Notes:
+    ------
+    The background is a function of the background parameters,
+    the energy slope and the data only.  Entries are keyed on
+    (Background._cache_key(), slope, data fingerprint) where the
+    fingerprint is an md5 digest of the data buffer.  Therefore
+    a cached background is reused for repeated calcs during a fit
+    and for any spectrum with the same data and parameters
+    (e.g. re-fitting the points of a scan).  When the cache is full
+    the oldest entry is discarded.
+    """
+    def __init__(self,max_size=256):
+        self.max_size = int(max_size)
+        self.clear()
+
+    def __repr__(self):
+        """ display """
+        lout = 'Xrf Background Cache:\n'
+        lout = lout + '   size   = %i (max = %i)\n' % (len(self._cache), self.max_size)
+        lout = lout + '   hits   = %i\n' % self.hits
+        lout = lout + '   misses = %i\n' % self.misses
+        return lout
+
+    def clear(self,):
+        """
+        Remove all entries and reset the statistics
+        """
+        self._cache = {}
+        self._order = []
+        self.hits   = 0
+        self.misses = 0
+
+    def stats(self,):
+        """
+        Return a dictionary of cache statistics
+        """
+        nlook = self.hits + self.misses
+        if nlook > 0:
+            rate = float(self.hits)/nlook
+        else:
+            rate = 0.
+        return {'hits':self.hits, 'misses':self.misses,
+                'size':len(self._cache), 'hit_rate':rate}
+
+    def calc(self, bgr, data, slope=1.0):
+        """
+        Compute the background of data using bgr (a Background instance),
+        reusing a cached result when possible.  Sets bgr.bgr and returns it.
+        """
+        key = self._key(bgr, data, slope)
+        if self._cache.has_key(key):
+            self.hits = self.hits + 1
+            bgr.bgr = self._cache[key].copy()
+            return bgr.bgr
+        self.misses = self.misses + 1
+        bgr.calc(data, slope=slope)
+        self._put(key, bgr.bgr)
+        return bgr.bgr
+
+    def put(self, bgr, data, slope, result):
+        """
+        Store a background computed elsewhere (e.g. by Background.calc_batch)
+        """
+        self._put(self._key(bgr, data, slope), result)
+
+    def _key(self, bgr, data, slope):
+        data = num.ascontiguousarray(data, dtype=float)
+        fp   = hashlib.md5(data.tostring()).hexdigest()
+        return (bgr._cache_key(), float(slope), len(data), fp)
+
+    def _put(self, key, result):
+        if self.max_size <= 0:
+            return
+        if self._cache.has_key(key):
+            self._order.remove(key)
+        elif len(self._order) >= self.max_size:
+            old = self._order.pop(0)
+            del self._cache[old]
+        self._cache[key] = num.array(result)
+        self._order.append(key)
+
+# module level cache shared by all spectra
+BGR_CACHE = BgrCache()
+
+#############################################################################
+REFERENCE_AMPL = 100.
+TINY           = 1.E-20
+HUGE           = 1.E20
+MAX_TANGENT    = 2
+# max number of elements in the (spectra x channels x window)
+# work arrays, spectra are processed in blocks below this size
+MAX_BLOCK      = 2000000
+
+def calc_bgr(data, slope=1.0, bottom_width=4.0, top_width=0.0,
+             exponent=2, tangent=False, compress=4):
+    """
+    Array implementation of the background algorithm
+
+    Parameters:
+    -----------
+    * data is a spectrum (nchans) or a set of spectra (nspectra x nchans)
+    * slope is the slope of conversion channels to energy.  For a
+      set of spectra this may be an array of length nspectra
+    * bottom_width, top_width, exponent, tangent and compress
+      are the background parameters (see Background)
+
+    Outputs:
+    --------
+    * integer array of backgrounds with the same shape as data
+
+    Notes:
+    ------
+    Gives the same result as Background._calc_loop.  The loops over
+    channels are replaced by gathers over (spectrum, channel, window offset)
+    arrays, so the work per spectrum is a few array operations on
+    nchans*window elements. Sets of spectra are processed in blocks
+    (see MAX_BLOCK) to limit memory use.  Data are treated as floats.
+    """
+    data = num.array(data, dtype=float)
+    single = (data.ndim == 1)
+    if single:
+        data = data[num.newaxis,:]
+    (nspec, nchans) = data.shape
+    slope = num.resize(num.asarray(slope, dtype=float), nspec)
+    if nspec == 0 or nchans == 0:
+        bgr = num.zeros(data.shape, dtype=num.int)
+        if single: return bgr[0]
+        return bgr
+
+    # Compress scratch spectra
+    compress = int(compress)
+    if (compress > 1) and ((nchans % compress) != 0):
+        print 'Warning compress must be integer divisor of array length'
+        compress = 1
+    if compress > 1:
+        scratch = num.reshape(data, (nspec, nchans/compress, compress))
+        scratch = num.sum(scratch, 2)/compress
+        slope   = slope * compress
+    else:
+        scratch = data
+    ncomp = scratch.shape[1]
+
+    # block size
+    nwin  = 2*ncomp + 3
+    nblk  = max(1, MAX_BLOCK/(ncomp*nwin))
+
+    bckgnd = num.zeros(scratch.shape, dtype=float)
+    for j in range(0, nspec, nblk):
+        scr = scratch[j:j+nblk]
+        slp = slope[j:j+nblk]
+        # Fit functions which come down from top
+        if (top_width > 0.):
+            chan_width = top_width / (2. * slp)
+            denom = chan_width**exponent
+            (pf, max_index, npf) = _power_funct(scr, denom, exponent)
+            scr = _bgr_top(scr, pf, max_index, npf)
+        # Fit functions which come up from below
+        chan_width = bottom_width / (2. * slp)
+        denom = chan_width**exponent
+        denom[chan_width == 0.] = TINY
+        (pf, max_index, npf) = _power_funct(scr, denom, exponent)
+        bckgnd[j:j+nblk] = _bgr_bottom(scr, pf, max_index, npf, tangent)
+
+    # Expand spectra
+    if (compress > 1):
+        bckgnd = num.array([expand_array(b, compress) for b in bckgnd])
+
+    # Bgr should be positive integers??
+    bgr = bckgnd.astype(int)
+    bgr[bgr <= 0] = 0
+    if single:
+        return bgr[0]
+    return bgr
+
+def _power_funct(scratch, denom, exponent):
+    """
+    Compute the power function lookup table for each spectrum,
+    truncated to values <= max counts of the spectrum.
+
+    Returns (pf, max_index, npf) where pf is a (nspectra x npf.max())
+    array, max_index is the max window index for each spectrum and
+    pf[s, k] is defined for k < npf[s].
+    """
+    (nspec, nchans) = scratch.shape
+    max_counts = scratch.max(axis=1)
+    indices = num.arange(float(nchans*2+1)) - nchans
+    pf_all  = indices**exponent * (REFERENCE_AMPL / denom[:,num.newaxis])
+    pf_list = []
+    npf = num.zeros(nspec, dtype=int)
+    for s in range(nspec):
+        pf = num.compress((pf_all[s] <= max_counts[s]), pf_all[s])
+        npf[s] = len(pf)
+        pf_list.append(pf)
+    pf_arr = num.zeros((nspec, max(npf.max(), 1)), dtype=float)
+    for s in range(nspec):
+        pf_arr[s, :npf[s]] = pf_list[s]
+    max_index = npf/2 - 1
+    return (pf_arr, max_index, npf)
+
+def _windows(arr, lo, hi, fill):
+    """
+    Sliding windows of a (nspectra x nchans) array.  Returns a strided
+    (nspectra x nchans x hi-lo+1) view w, with w[s,j,k] = arr[s,j+lo+k]
+    and fill for channels outside the array.  Requires lo <= 0 <= hi.
+    """
+    (nspec, nchans) = arr.shape
+    nwin = hi - lo + 1
+    tmp  = num.empty((nspec, nchans + nwin - 1), dtype=float)
+    tmp.fill(fill)
+    tmp[:, -lo:nchans-lo] = arr
+    (s0, s1) = tmp.strides
+    return as_strided(tmp, shape=(nspec, nchans, nwin), strides=(s0, s1, s1))
+
+def _offset_funct(pf, max_index, npf, lo, hi, fill, bottom=False):
+    """
+    Power function tabulated by window offset d = lo..hi, ie
+    pfd[s, d-lo] = pf[s, d + max_index[s]] for offsets inside the
+    window of spectrum s, fill otherwise
+    """
+    offset = num.arange(lo, hi+1)[num.newaxis,:]
+    mi     = max_index[:,num.newaxis]
+    good   = num.abs(offset) <= mi
+    if bottom:
+        # the bottom-up window always includes the next channel
+        good = good | ((mi == -1) & (offset == 1))
+    pfidx  = offset + mi
+    good   = good & (pfidx >= 0) & (pfidx < npf[:,num.newaxis])
+    pfidx  = num.clip(pfidx, 0, pf.shape[1]-1)
+    pfd    = pf[num.arange(len(pf))[:,num.newaxis], pfidx]
+    pfd[~good] = fill
+    return pfd
+
+def _bgr_top(scratch, pf, max_index, npf):
+    """
+    Fit functions which come down from the top (concave up)
+
+    bckgnd[j] = max(scratch[j], max_c(scratch[c] + pf[j - c + max_index]))
+    """
+    hi = max(max_index.max(), 0)
+    lo = -hi
+    pfd = _offset_funct(pf, max_index, npf, lo, hi, -num.inf)
+    # w[s,j,k] = scratch[s,c], c = j - d, d = hi - k
+    w = _windows(scratch, -hi, -lo, -num.inf)
+    test = w + pfd[:,num.newaxis,::-1]
+    return num.maximum(scratch, test.max(axis=2))
+
+def _tangent_slope(scratch):
+    """
+    Slope of the tangent to each spectrum at each channel
+    """
+    (nspec, nchans) = scratch.shape
+    cen   = num.arange(nchans)
+    first = num.maximum(cen - MAX_TANGENT, 0)
+    last  = num.minimum(cen + MAX_TANGENT, nchans-1)
+    denom = num.maximum(cen, 1).astype(float)
+    nt    = 2*MAX_TANGENT + 1
+    idx   = first[:,num.newaxis] + num.arange(nt)[num.newaxis,:]
+    good  = idx <= last[:,num.newaxis]
+    idx   = num.clip(idx, 0, nchans-1)
+    slope = (scratch[:,:,num.newaxis] - scratch[:,idx]) / denom[:,num.newaxis]
+    slope[:,~good] = 0.
+    slope = num.sum(slope, 2)
+    return slope / (last - first)
+
+def _bgr_bottom(scratch, pf, max_index, npf, tangent=False):
+    """
+    Fit functions which come up from below (concave down)
+    """
+    (nspec, nchans) = scratch.shape
+    ncen = nchans - 1
+    lo   = -max(max_index.max(), 0)
+    hi   = max(max_index.max(), 1)
+    offset = num.arange(lo, hi+1)
+
+    # lin_offset = scratch[c] + ((j - first[c]) - nc[c]/2) * tslope[c]
+    if tangent and nchans > 1:
+        cen    = num.arange(nchans)[num.newaxis,:]
+        mi     = max_index[:,num.newaxis]
+        first  = num.maximum(cen - mi, 0)
+        last   = num.maximum(num.minimum(cen + mi, nchans-1), first)
+        xoff   = (cen - first - (last - first + 1)/2).astype(float)
+        tslope = _tangent_slope(scratch)
+    else:
+        tslope = None
+
+    # height of the function centered on each channel
+    pfd  = _offset_funct(pf, max_index, npf, lo, hi, num.inf, bottom=True)
+    w    = _windows(scratch, lo, hi, num.inf)
+    if tslope is None:
+        lin = scratch[:,:,num.newaxis]
+    else:
+        x   = xoff[:,:,num.newaxis] + offset[num.newaxis,num.newaxis,:]
+        lin = scratch[:,:,num.newaxis] + x * tslope[:,:,num.newaxis]
+    test   = w - lin + pfd[:,num.newaxis,:]
+    height = test.min(axis=2)
+    height[:,ncen:] = -num.inf
+
+    # max of the functions at each channel, over centers c = j - d
+    pfd  = _offset_funct(pf, max_index, npf, lo, hi, num.inf, bottom=True)
+    pfd  = pfd[:,num.newaxis,::-1]
+    if tslope is None:
+        w    = _windows(height + scratch, -hi, -lo, -num.inf)
+        test = w - pfd
+    else:
+        x    = _windows(xoff, -hi, -lo, 0.) + offset[num.newaxis,num.newaxis,::-1]
+        lin  = _windows(scratch, -hi, -lo, 0.) + x * _windows(tslope, -hi, -lo, 0.)
+        test = (_windows(height, -hi, -lo, -num.inf) + lin) - pfd
+    bckgnd = num.arange(float(nchans)) - HUGE
+    return num.maximum(bckgnd, test.max(axis=2))
+
 ############################################################
 def compress_array(array, compress):
    """
@@ -65,8 +65,8 @@ optimized.  Not optimizing the energy calibration coefficients can
 both speed up the fitting process and lead to more stable results when 
 fitting small peaks.  This function does a sanity check and will not
 optimize these energy calibration coefficients unless at least 2 peaks
-have their .energy_flag field set to 0, so that they use these global
-calibration coefficients.
+have their .energy_flag field set to 1 (fixed energy), so that they use
+these global calibration coefficients.
 
 The FWHM of the peaks is assumed to obey the relation:
      fwhm = fwhm_offset + (fwhm_slope * sqrt(energy))
@@ -79,13 +79,13 @@ assumed to be correct and are not optimized. Not optimizing the FWHM
 coeffcients can both speed up the fitting process and lead to more 
 stable results when fitting very small peaks. This function does a 
 sanity check and will not optimize these FWHM calibration coefficients 
-unless at least 2 peaks have their .fwhm_flag field set to 0, so that 
+unless at least 2 peaks have their .fwhm_flag field set to 1, so that 
 they use these global calibration coefficients.
 
 This function also optimizes the following parameters:
      - The amplitudes of all peaks whose .ampl_factor field is 0
-     - The energies of all peaks whose .energy_flag field is 1
-     - The FWHM of all peaks whose .fwhm_flag field is 1
+     - The energies of all peaks whose .energy_flag field is 0
+     - The FWHM of all peaks whose .fwhm_flag field is 0
 
 The parameter which is the minimized during the fitting process is 
 chi**2, defined as:
@@ -186,7 +186,7 @@ class XrfPeak:
         lout = lout + '   energy    = %10.3f, flag = %i\n' % (self.energy, self.energy_flag)
         lout = lout + '   fwhm      = %10.3f, flag = %i\n' % (self.fwhm, self.fwhm_flag)
         lout = lout + '   amplitude = %10.3f, amp factor = %i\n' % (self.ampl, self.ampl_factor)
-        lout = lout + '   area      = %10.3f\n' % (self.area)
+        lout = lout + '   area      = %10.3f +/- %10.3f\n' % (self.area, self.area_err)
         return lout
 
     ###########################################################################
@@ -233,6 +233,7 @@ class XrfPeak:
                                       #  -1.0 = Fix amplitude at 0.0
         self.max_sigma      = 8.      # Max sigma for peak contribution
         self.area           = 0.      # Area of peak
+        self.area_err       = 0.      # Error in the area (from fit)
 
         self.init(params=kws) 
     
@@ -253,6 +254,7 @@ class XrfPeak:
             if 'ampl_factor' in keys: self.ampl_factor = float(params['ampl_factor'])
             if 'max_sigma' in keys:   self.max_sigma   = float(params['max_sigma'])
             if 'area' in keys:        self.area        = float(params['area'])
+            if 'area_err' in keys:    self.area_err    = float(params['area_err'])
 
     ###########################################################################
     def get_params(self):
@@ -268,7 +270,8 @@ class XrfPeak:
                   'ampl':self.ampl,
                   'ampl_factor':self.ampl_factor,
                   'max_sigma':self.max_sigma,
-                  'area':self.area}
+                  'area':self.area,
+                  'area_err':self.area_err}
         return params
 
     ###########################################################################
@@ -359,6 +362,23 @@ class XrfPeak:
 
         return( (idx_min,idx_max) )
 
+######################################################################
+def _en_ranges(energy, cen, fwhm, max_sigma):
+    """
+    Array version of XrfPeak._en_range, returns (idx_min, idx_max)
+    arrays for peaks with energies cen and widths fwhm.
+    """
+    sigma = max_sigma*(fwhm/SIGMA_TO_FWHM)
+    nchan = len(energy)
+    del_e   = num.abs(energy - cen[:,num.newaxis])
+    idx_cen = num.argmin(del_e, axis=1)
+    slope = (energy[nchan-1] - energy[0]) / nchan
+    del_sig_chan = num.abs(sigma / slope)
+    half = num.floor(del_sig_chan/2.).astype(int)
+    idx_min = num.clip(idx_cen - half, 0, nchan-1)
+    idx_max = num.clip(idx_cen + half, 0, nchan-1)
+    return (idx_min, idx_max)
+
 #######################################################################################
 class XrfSpectrum:
     """
@@ -372,6 +392,8 @@ class XrfSpectrum:
     * bgr                   = None      # Background model, see xrf_bgr module
                                         #   if none, we'll assume here that the data
                                         #   has been background subtracted
+    * bgr_cache             = True      # Flag to reuse cached backgrounds
+                                        #   see xrf_bgr.BgrCache
     ### Parameters 
     * energy_offset         =  0.       # Energy calibration offset (keV)
     * energy_slope          =  1.       # Energy calibration slope 
@@ -482,6 +504,7 @@ class XrfSpectrum:
 
         # Background
         self.bgr                   = None      # background model
+        self.bgr_cache             = True      # reuse cached backgrounds
 
         # Parameters
         self.energy_offset         =  0.       # Energy calibration offset
@@ -715,42 +738,269 @@ class XrfSpectrum:
         """
         Predicts a Gaussian spectrum 
         """
-        self.predicted = num.zeros(self.nchan, dtype=num.float)
         energy = self.get_energy()
-        
-        for peak in self.peaks:
-            (counts, (idx_min, idx_max) )   = peak._calc_range(energy, compute_area=compute_areas)
-            self.predicted[idx_min:idx_max] = self.predicted[idx_min:idx_max] + counts
+        (cnts, (idx_min, idx_max)) = self._calc_matrix(energy)
+        if len(self.peaks) > 0:
+            self.predicted = cnts.sum(axis=0)
+        else:
+            self.predicted = num.zeros(self.nchan, dtype=num.float)
+        if compute_areas:
+            self._calc_areas(energy, cnts, idx_min, idx_max)
 
         if self.bgr:
-            self.bgr.calc(self.data,slope=self.energy_slope)
+            self._calc_bgr()
             self.predicted = self.predicted + self.bgr.bgr
 
+    ####################################################################################
+    def _calc_bgr(self,):
+        """
+        Compute the background, using the background cache if enabled
+        """
+        if getattr(self,'bgr_cache',True):
+            xrf_bgr.BGR_CACHE.calc(self.bgr,self.data,slope=self.energy_slope)
+        else:
+            self.bgr.calc(self.data,slope=self.energy_slope)
+        return self.bgr.bgr
+
+    ####################################################################################
+    def get_bgr_cache_stats(self,):
+        """
+        Return a dictionary of background cache statistics
+        (hits, misses, size and hit_rate).
+
+        Notes:
+        ------
+        The cache is shared by all spectra, see xrf_bgr.BgrCache.
+        Use xrf_bgr.BGR_CACHE.clear() to reset.
+        """
+        return xrf_bgr.BGR_CACHE.stats()
+
     ####################################################################################
     def calc_peaks(self,):
         """
         Return array with predicted values for each peak 
         """
-        npks   = len(self.peaks)
-        cnts   = num.zeros((npks,self.nchan), dtype=num.float)
         energy = self.get_energy()
+        (cnts, (idx_min, idx_max)) = self._calc_matrix(energy)
+        self._calc_areas(energy, cnts, idx_min, idx_max)
+        return cnts
+
+    ####################################################################################
+    def _calc_matrix(self, energy, basis=False):
+        """
+        Compute all the peaks as a (npeaks x nchan) matrix.
 
-        for j in range(npks):
-            (tmp, (idx_min, idx_max) ) = self.peaks[j]._calc_range(energy)
-            cnts[j,idx_min:idx_max] = tmp
+        Parameters:
+        -----------
+        * energy is the energy array
+        * basis is a flag to also return the unit amplitude peak shapes
 
-        # could use this also for calulating the total predicted signal
-        # self.predicted = cnt.sum(axis=1) + self.bgr.calc(self.data,slope=self.energy_slope)
+        Outputs:
+        --------
+        * (cnts, (idx_min, idx_max)) or if basis is True
+          (cnts, (idx_min, idx_max), shape).
+          cnts[j] is zero outside the range idx_min[j]:idx_max[j]
+          that peak j makes a significant contribution (see XrfPeak._calc_range)
+        """
+        npks  = len(self.peaks)
+        nchan = len(energy)
+        cen   = num.array([pk.energy for pk in self.peaks], dtype=float)
+        fwhm  = num.array([pk.fwhm for pk in self.peaks], dtype=float)
+        ampl  = num.array([pk.ampl for pk in self.peaks], dtype=float)
+        msig  = num.array([pk.max_sigma for pk in self.peaks], dtype=float)
+        if npks == 0 or nchan == 0:
+            cnts = num.zeros((npks,nchan), dtype=num.float)
+            idx  = num.zeros(npks, dtype=int)
+            if basis: return (cnts, (idx, idx), cnts.copy())
+            return (cnts, (idx, idx))
+
+        (idx_min, idx_max) = _en_ranges(energy, cen, fwhm, msig)
+        chan  = num.arange(nchan)
+        mask  = (chan >= idx_min[:,num.newaxis]) & (chan < idx_max[:,num.newaxis])
+        sigma = fwhm/SIGMA_TO_FWHM
+        shape = num.exp(-((energy - cen[:,num.newaxis])**2 / (2. * sigma[:,num.newaxis]**2)))
+        shape[~mask] = 0.
+        cnts  = ampl[:,num.newaxis] * shape
+        if basis:
+            return (cnts, (idx_min, idx_max), shape)
+        return (cnts, (idx_min, idx_max))
+
+    ####################################################################################
+    def _calc_areas(self, energy, cnts, idx_min, idx_max):
+        """
+        Set the peak areas from the peak matrix
+        """
+        for j in range(len(self.peaks)):
+            (mi, ma) = (idx_min[j], idx_max[j])
+            self.peaks[j].area = num.trapz(cnts[j,mi:ma], energy[mi:ma])
+
+    ####################################################################################
+    def _calc_jac(self,):
+        """
+        Compute the partial derivatives of the predicted spectrum with
+        respect to the fit parameters (see _preFit for the order).
         
-        return cnts
+        Outputs:
+        --------
+        * (nchan x nparams) array
+
+        Notes:
+        ------
+        Includes the peak amplitudes, energies and fwhm's, the global
+        fwhm coefficients (for peaks with fwhm_flag = 1), amplitudes
+        tied through ampl_factor, and the energy calibration offset
+        and slope.  The peak ranges are held fixed.  The derivatives
+        with respect to free background parameters are computed by
+        finite differences (see _calc_bgr_jac).
+        """
+        energy = self.get_energy()
+        chan   = num.asarray(self.channels, dtype=float)
+        npks   = len(self.peaks)
+        jac    = num.zeros((len(energy), self.nparams), dtype=float)
+        if self.bgr:
+            self._calc_bgr_jac(jac)
+        if npks == 0:
+            return jac
+        (cnts, rng, shape) = self._calc_matrix(energy, basis=True)
+        cen   = num.array([pk.energy for pk in self.peaks], dtype=float)
+        fwhm  = num.array([pk.fwhm for pk in self.peaks], dtype=float)
+        sigma = fwhm/SIGMA_TO_FWHM
+        de    = energy - cen[:,num.newaxis]
+        # d(cnts)/d(energy) and d(cnts)/d(fwhm) for each peak
+        d_cen  = cnts * de / (sigma**2)[:,num.newaxis]
+        d_fwhm = cnts * de**2 / (SIGMA_TO_FWHM*sigma**3)[:,num.newaxis]
+
+        (dA, dF, dC) = self._calc_sens()
+        jac = jac + num.dot(shape.T, dA) + num.dot(d_fwhm.T, dF) + \
+              num.dot(d_cen.T, dC)
+        # energy calibration
+        d_en = d_cen.sum(axis=0)
+        jac[:,0] = jac[:,0] - d_en
+        jac[:,1] = jac[:,1] - d_en*chan
+        return jac
+
+    def _calc_bgr_jac(self, jac):
+        """
+        Fill the jac columns of the free background parameters with
+        one sided finite differences (same step as mpfit).  The
+        background does not depend on the other parameters.
+        """
+        base = 4 + 3*len(self.peaks)
+        nbgr = len(self.bgr.parinfo)
+        pars = [self.bgr.bottom_width, self.bgr.top_width]
+        if base + nbgr > self.nparams:
+            return jac
+        bgr0 = num.array(self._calc_bgr(), dtype=float)
+        eps  = num.sqrt(num.finfo(float).eps)
+        try:
+            for j in range(nbgr):
+                info = self.parinfo[base+j]
+                if info.get('fixed'): continue
+                h = info.get('step', 0.)
+                if not h > 0.:
+                    h = eps*abs(pars[j])
+                if h == 0.:
+                    h = eps
+                p = list(pars)
+                p[j] = p[j] + h
+                self.bgr._update(p)
+                jac[:,base+j] = (self._calc_bgr() - bgr0)/h
+        finally:
+            self.bgr._update(pars)
+            self._calc_bgr()
+        return jac
+
+    ####################################################################################
+    def _calc_sens(self,):
+        """
+        Derivatives of the peak amplitudes, fwhm's and energies with
+        respect to the fit parameters. Returns (dA, dF, dC), each
+        (npeaks x nparams) arrays.
+        """
+        npks = len(self.peaks)
+        dA = num.zeros((npks, self.nparams))
+        dF = num.zeros((npks, self.nparams))
+        dC = num.zeros((npks, self.nparams))
+        last = None
+        for k in range(npks):
+            peak = self.peaks[k]
+            np   = 4 + 3*k
+            dC[k,np] = 1.
+            if (peak.fwhm_flag == 1):
+                dF[k,2] = 1.
+                if peak.energy > 0.:
+                    dF[k,3]  = num.sqrt(peak.energy)
+                    dF[k,np] = self.fwhm_slope/(2.*num.sqrt(peak.energy))
+            else:
+                dF[k,np+1] = 1.
+            if (peak.ignore == True) or (peak.ampl_factor < 0.):
+                pass
+            elif (peak.ampl_factor == 0.):
+                dA[k,np+2] = 1.
+                last = k
+            elif (peak.ampl_factor > 0.) and (last != None):
+                ref   = self.peaks[last]
+                fk    = max(peak.fwhm, .001)
+                ratio = peak.ampl_factor*ref.fwhm/fk
+                dA[k] = ratio*dA[last] + (ref.ampl*peak.ampl_factor/fk)*dF[last]
+                if peak.fwhm > .001:
+                    dA[k] = dA[k] - (ref.ampl*ratio/fk)*dF[k]
+        return (dA, dF, dC)
 
     ####################################################################################
-    def fit(self,guess=True,opt_bgr=True, quiet=1):
+    def _calc_area_err(self, covar, nfree):
+        """
+        Set the peak area errors from the parameter covariance matrix.
+
+        Parameters:
+        -----------
+        * covar is the (nparams x nparams) covariance of the fit parameters
+        * nfree is the number of free parameters
+
+        Notes:
+        ------
+        The area of a gaussian is ampl*fwhm*sqrt(pi/(4 ln 2)), the errors
+        are propagated through the amplitude and fwhm dependence on the
+        fit parameters (see _calc_sens).  If chi_exp = 0 (unit weights)
+        the covariance is scaled by chisqr/(nchan - nfree).
+        For a varpro fit covar must include the amplitudes and their
+        correlation with the other free parameters (see fit)
+        """
+        for peak in self.peaks:
+            peak.area_err = 0.
+        if covar is None or len(self.peaks) == 0:
+            return
+        if self.chi_exp == 0.:
+            res = (self.predicted - self.data) * self.weights
+            dof = max(self.nchan - nfree, 1)
+            covar = covar * num.sum(res**2)/dof
+        (dA, dF, dC) = self._calc_sens()
+        c = num.sqrt(num.pi/(4.*num.log(2.)))
+        for k in range(len(self.peaks)):
+            peak = self.peaks[k]
+            grad = c*(peak.fwhm*dA[k] + peak.ampl*dF[k])
+            var  = num.dot(grad, num.dot(covar, grad))
+            peak.area_err = num.sqrt(max(var, 0.))
+
+    ####################################################################################
+    def fit(self,guess=True,opt_bgr=True, quiet=1, jac=True, varpro=False):
         """
         Fit the data
+
+        Parameters:
+        -----------
+        * guess is a flag to guess the initial peak parameters
+        * opt_bgr is a flag to include the background in the fit model,
+          if False the background is subtracted from the data before the fit
+        * quiet is passed to mpfit
+        * jac is a flag to use analytic derivatives (see _calc_jac),
+          otherwise mpfit computes the derivatives by finite differences
+        * varpro is a flag to use variable projection: the amplitudes
+          are not fit parameters, rather they are solved by non-negative
+          linear least squares at each step (see _solve_ampl)
         """
         if self.bgr:
-            self.bgr.calc(self.data,slope=self.energy_slope)
+            self._calc_bgr()
             if opt_bgr == False:
                 data = copy.copy(self.data)
                 self.data = data - self.bgr.bgr
@@ -761,20 +1011,66 @@ class XrfSpectrum:
             opt_bgr   = False
 
         # Prep and call lsq
-        self._preFit(guess=guess)
-        functkw = {'fit':self}
-        m = mpfit.mpfit(_fit_peaks, parinfo=self.parinfo, functkw=functkw, 
-                        quiet=quiet, xtol=self.tolerance, maxiter=self.max_iter)
+        self._preFit(guess=guess,varpro=varpro)
+        nfree = 0
+        for par in self.parinfo:
+            if not par['fixed']: nfree = nfree + 1
+        if varpro and (nfree == 0):
+            # only the amplitudes are free, ie a linear problem
+            m = None
+            params = [par['value'] for par in self.parinfo]
+        else:
+            functkw = {'fit':self}
+            if jac:
+                autoderivative = 0
+            else:
+                autoderivative = 1
+            m = mpfit.mpfit(_fit_peaks, parinfo=self.parinfo, functkw=functkw, 
+                            quiet=quiet, xtol=self.tolerance, maxiter=self.max_iter,
+                            autoderivative=autoderivative)
+            params = m.params
 
         # Make sure final results are updated
-        self._update(m.params)
+        self._update(params)
+        covar = num.zeros((self.nparams, self.nparams))
+        if (m != None) and (m.covar is not None):
+            covar[:,:] = m.covar
+        if varpro:
+            (basis, ampl) = self._solve_ampl()
+            # covariance of the free parameters and the (active)
+            # amplitudes from the full jacobian, so the amplitude
+            # errors include their correlation with the energies
+            # and fwhm's. zero amplitudes are at the constraint
+            idx  = self._ampl_param_idx()
+            act  = num.where(ampl > 0.)[0]
+            if len(act) > 0:
+                pa   = num.array(idx)[act]
+                free = [j for j in range(self.nparams)
+                        if not self.parinfo[j]['fixed']]
+                free = num.array(free + list(pa), dtype=int)
+                jf   = self._calc_jac()[:, free] * self.weights[:,num.newaxis]
+                covar[:,:] = 0.
+                covar[free[:,num.newaxis], free[num.newaxis,:]] = \
+                    num.linalg.pinv(num.dot(jf.T, jf))
+                nfree = nfree + len(act)
         self.calc(compute_areas=True)
+        self._calc_area_err(covar, nfree)
+        if m == None:
+            res = (self.predicted - self.data) * self.weights
+            chisqr = num.sum(res**2)
         if opt_bgr == False and bgr_model != None:
             self.bgr  = bgr_model
             self.data = data
             self.predicted = self.predicted + self.bgr.bgr
 
         # some of the results
+        if m == None:
+            self.n_iter = 0
+            self.n_eval = 1
+            self.chisqr = chisqr
+            self.status = 1
+            self.err_string = ''
+            return
         if (m.status <= 0): print m.errmsg
         self.n_iter = m.niter
         self.n_eval = m.nfev
@@ -783,11 +1079,91 @@ class XrfSpectrum:
         self.err_string = m.errmsg
 
     ############################################################################################
-    def _preFit(self,guess=True):
+    def _ampl_param_idx(self,):
+        """
+        Parameter indices of the free amplitudes (the order of the
+        amplitudes returned by _solve_ampl)
+        """
+        idx = []
+        for k in range(len(self.peaks)):
+            peak = self.peaks[k]
+            if (peak.ignore == True) or (peak.ampl_factor < 0.):
+                continue
+            if (peak.ampl_factor == 0.):
+                idx.append(4 + 3*k + 2)
+        return idx
+
+    ############################################################################################
+    def _solve_ampl(self,):
+        """
+        Solve for the peak amplitudes given the current peak energies and
+        widths, using non-negative linear least squares.  Sets the amplitudes
+        of the free peaks (ampl_factor = 0) and of the peaks tied to them.
+        
+        Outputs:
+        --------
+        * (basis, ampl), basis is the (nchan x nfree) weighted design matrix
+          and ampl the solved amplitudes of the free peaks
+
+        Notes:
+        ------
+        Each free peak contributes one basis column that includes the
+        peaks tied to it through ampl_factor.  The background and the
+        peaks with fixed amplitude are subtracted from the data.
+        """
+        from scipy.optimize import nnls
+
+        energy = self.get_energy()
+        (cnts, rng, shape) = self._calc_matrix(energy, basis=True)
+        const = num.zeros(len(energy), dtype=float)
+        if self.bgr:
+            const = const + self._calc_bgr()
+        cols = []
+        free = []
+        last = None
+        for k in range(len(self.peaks)):
+            peak = self.peaks[k]
+            if (peak.ignore == True) or (peak.ampl_factor < 0.):
+                continue
+            elif (peak.ampl_factor == 0.):
+                cols.append(shape[k].copy())
+                free.append(k)
+                last = k
+            elif (peak.ampl_factor > 0.) and (last != None):
+                ratio = peak.ampl_factor*(self.peaks[last].fwhm/max(peak.fwhm, .001))
+                cols[-1] = cols[-1] + ratio*shape[k]
+            else:
+                const = const + cnts[k]
+        if len(free) == 0:
+            return (num.zeros((len(energy),0)), num.zeros(0))
+        basis = num.transpose(cols) * self.weights[:,num.newaxis]
+        target = (self.data - const) * self.weights
+        (ampl, rnorm) = nnls(basis, target)
+
+        # set amplitudes
+        for j in range(len(free)):
+            self.peaks[free[j]].ampl = ampl[j]
+        last = None
+        for peak in self.peaks:
+            if (peak.ignore == True) or (peak.ampl_factor < 0.):
+                continue
+            elif (peak.ampl_factor == 0.):
+                last = peak
+            elif (peak.ampl_factor > 0.) and (last != None):
+                peak.ampl = (last.ampl * peak.ampl_factor)
+                peak.ampl = peak.ampl * (last.fwhm / max(peak.fwhm, .001))
+        return (basis, ampl)
+
+    ############################################################################################
+    def _preFit(self,guess=True,varpro=False):
         """
         Constructs fit weights and param info
+
+        If varpro is True the amplitudes are held fixed in the
+        parameter info, they are solved by _solve_ampl
         """
         self._initFitParams()
+        self._varpro = varpro
         self._initPeaks(guess=guess)
         
         # Compute sigma of observations to computed weighted residuals
@@ -817,32 +1193,50 @@ class XrfSpectrum:
             self.parinfo.append({'value':0., 'fixed':0, 'limited':[0,0],
                                  'limits':[0., 0.], 'step':0.})
 
+        # Sanity check for the varpro fit (see notes above), only
+        # optimize the energy calibration if at least 2 peaks have fixed
+        # energies (energy_flag = 1) and the global fwhm coefficients if
+        # at least 2 peaks follow the global curve (fwhm_flag = 1).
+        # Otherwise these are degenerate with the peak parameters.
+        # The standard fit is unchanged
+        fix_energy = (self.energy_flag == 1)
+        fix_fwhm   = (self.fwhm_flag == 1)
+        if varpro:
+            n_en = 0
+            n_fwhm = 0
+            for peak in self.peaks:
+                if peak.ignore == True: continue
+                if peak.energy_flag == 1: n_en = n_en + 1
+                if peak.fwhm_flag == 1: n_fwhm = n_fwhm + 1
+            fix_energy = fix_energy or (n_en < 2)
+            fix_fwhm   = fix_fwhm or (n_fwhm < 2)
+
         # Energy calibration offset
         np = 0
         self.parinfo[np]['value']   = self.energy_offset
         self.parinfo[np]['parname'] = 'Energy offset'
-        if (self.energy_flag == 1):
+        if fix_energy:
             self.parinfo[np]['fixed']=1
 
         # Energy calibration slope
         np = np+1
         self.parinfo[np]['value']   = self.energy_slope
         self.parinfo[np]['parname'] = 'Energy slope'
-        if (self.energy_flag == 1):
+        if fix_energy:
             self.parinfo[np]['fixed']=1
 
         # Global FWHM offset
         np = np+1
         self.parinfo[np]['value']   = self.fwhm_offset
         self.parinfo[np]['parname'] = 'FWHM offset'
-        if (self.fwhm_flag == 1):
+        if fix_fwhm:
             self.parinfo[np]['fixed']=1
 
         # Global FWHM slope
         np = np+1
         self.parinfo[np]['value']   = self.fwhm_slope
         self.parinfo[np]['parname'] = 'FWHM slope'
-        if (self.fwhm_flag == 1):
+        if fix_fwhm:
             self.parinfo[np]['fixed']=1
 
         # Peaks
@@ -889,6 +1283,8 @@ class XrfSpectrum:
                 self.parinfo[np]['limits']  =[0.,0.]
             elif (peak.ampl_factor > 0.):
                 self.parinfo[np]['fixed']=1
+            if varpro:
+                self.parinfo[np]['fixed']=1
 
         # get bgr fit parameter info
         if self.bgr:
@@ -971,10 +1367,23 @@ class XrfSpectrum:
 def _fit_peaks(parameters, fjac = None, fit = None):
     """ Private function """
     fit._update(parameters)
+    if getattr(fit,'_varpro',False):
+        (basis, ampl) = fit._solve_ampl()
     fit.calc(compute_areas=False)
     status = 0
     res = (fit.predicted - fit.data) * fit.weights
-    return (status, res )
+    if fjac is None:
+        return (status, res )
+    # mpfit expects the negative of the residual derivatives
+    pderiv = -fit._calc_jac() * fit.weights[:,num.newaxis]
+    if getattr(fit,'_varpro',False):
+        # Kaufman's approximation to the variable projection jacobian:
+        # project out the span of the (active) amplitude basis
+        basis = basis[:, ampl > 0.]
+        if basis.shape[1] > 0:
+            (q, r) = num.linalg.qr(basis)
+            pderiv = pderiv - num.dot(q, num.dot(q.T, pderiv))
+    return (status, res, pderiv)
 
 ########################################################################
 ########################################################################
@@ -1045,6 +1454,43 @@ def test_fit():
     #############################
     pyplot.show()
     
+########################################################################
+def test_varpro():
+    """
+    Check that a varpro fit of a spectrum with the default peak flags
+    (energies fixed, fwhm on the global curve, free calibration and
+    fwhm coefficients) gives the same chi**2 and area errors as the
+    standard fit
+    """
+    r = num.random.RandomState(3)
+    chans = num.arange(2048)
+    en = 1.0 + 0.01*chans
+    cens = [2.5,3.1,4.,5.2,6.,7.,8.3,9.9]
+    data = 50.0 + num.zeros(len(chans))
+    for c in cens:
+        sigma = (0.1 + 0.04*num.sqrt(c))/2.35482
+        data = data + 400.*num.exp(-(en-c)**2/(2.*sigma**2))
+    data = r.poisson(data).astype(float)
+    chisqr = []
+    area_err = []
+    for varpro in (False,True):
+        params = {'fit':{'energy_offset':1.,'energy_slope':0.0101,
+                         'fwhm_offset':0.12,'fwhm_slope':0.03,
+                         'chi_exp':0.5},
+                  'bgr':{'bottom_width':4,'compress':4},
+                  'pk':[{'label':'p%i' % k,'energy':c}
+                        for (k,c) in enumerate(cens)]}
+        xspec = XrfSpectrum(data=data,chans=chans,params=params,guess=True)
+        xspec.fit(varpro=varpro)
+        assert xspec.n_iter > 0, "fit did not iterate"
+        chisqr.append(xspec.chisqr)
+        area_err.append(num.array([pk.area_err for pk in xspec.peaks]))
+    assert abs(chisqr[1] - chisqr[0]) < 1.e-3*chisqr[0], \
+           "varpro chi**2 %g, standard %g" % (chisqr[1],chisqr[0])
+    assert num.allclose(area_err[1], area_err[0], rtol=0.02), \
+           "varpro area errors %s, standard %s" % (area_err[1],area_err[0])
+    print "varpro chi**2 = %g, standard chi**2 = %g" % (chisqr[1],chisqr[0])
+
 ########################################################################
 if __name__ == "__main__":
     #test_peak()
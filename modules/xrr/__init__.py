@@ -4,3 +4,4 @@ reflection standing wave data
 """
 from .xref import RefModel
 from .interface_model import Layer, Model
+from .model_fit import ModelFit
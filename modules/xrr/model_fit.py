@@ -0,0 +1,900 @@
+"""
+Least squares fitting of interface models to reflectivity
+and reflection FY data using analytic derivatives
+
+Notes:
+------
+The reflectivity / FY calculation in this module is a numpy
+transcription of the c-library calculation (see lib/src/xrr/xrr.c
+and xref.py for the conventions and definitions of all the
+quantities).  The difference is that here every quantity in the
+layer recursion (g, r, t, X, Ai, Ar, I, atten) is carried along with
+its derivatives with respect to the fit parameters (forward mode),
+therefore a single call gives R, FY and the full Jacobian.
+
+The chain from a fit parameter to R/FY is split in two parts:
+* the slab profile map: fit parameters --> slab arrays d, rho, sigma
+  and comp (see interface_model.Slab).  This is cheap (no angle
+  dependence) and its derivatives are computed by central
+  differences of Slab.calc_dist.
+* the layer recursion: slab arrays --> R, FY.  This is the expensive
+  part, and is differentiated analytically (calc_ref)
+
+Parameters are identified with tuples:
+* ('thickness',j)   thickness of layer j (angstroms)
+* ('density',j)     density of layer j (g/cm^3)
+* ('roughness',j)   roughness of the top interface of layer j
+* ('dist',comp,didx,key) key (e.g. 'cen','sig','CX') of the interface
+                    distribution didx of component comp
+* 'scale'           reflectivity scale factor (calc_params[13])
+* 'fyscale'         FY scale factor
+* 'theta_off'       angle offset (degrees), theta_calc = theta + theta_off
+
+Example:
+--------
+>>fit = ModelFit(model,R=Rdat,FY=FYdat,wR=1.0,wFY=0.5)
+>>fit.add_param(('roughness',0),limits=(0.,30.))
+>>fit.add_param(('dist','Fe2_O3',0,'cen'))
+>>fit.add_param('scale')
+>>fit.fit()
+>>print fit
+"""
+#######################################################################
+
+import types, copy
+import numpy as num
+
+from tdl.modules.utils.mpfit import nmpfit as mpfit
+
+#######################################################################
+def _rad(theta):
+    """ degrees --> radians """
+    return theta*num.pi/180.
+
+def _conv_matrix(x, wconv):
+    """
+    Matrix form of the (unpadded) gaussian convolution
+    in lib/src/utils/numfcns.c, ie y_conv = num.dot(W,y)
+    """
+    if wconv <= 0.0:
+        return None
+    a = (x[num.newaxis,:] - x[:,num.newaxis])/(0.600561*wconv)
+    W = num.exp(-1.*a**2)
+    W = W / W.sum(axis=1)[:,num.newaxis]
+    return W
+
+def _norm_idx(x, xnorm):
+    """
+    Index used for FY normalization (see norm_array in numfcns.c)
+    """
+    idx = num.where(x >= xnorm)[0]
+    if len(idx) == 0:
+        return len(x) - 1
+    return idx[0]
+
+#######################################################################
+def calc_ref(theta, d, rho, sigma, comp, elem_z, fp, fpp, amu, mu_at,
+             calc_params, dprim=None, calc_fy=True):
+    """
+    Compute reflectivity, FY and their derivatives
+
+    Parameters:
+    -----------
+    * theta is the array of angles (degrees)
+    * d, rho, sigma, comp, elem_z, fp, fpp, amu and mu_at are
+      the arrays defined in xref.RefModel
+    * calc_params is the calc_params array (see xref.RefModel)
+    * dprim is a dictionary of derivatives of the model arrays
+      with respect to the npar fit parameters:
+        dprim['d']     shape = (npar,nlayer)
+        dprim['rho']   shape = (npar,nlayer)
+        dprim['sigma'] shape = (npar,nlayer-1)
+        dprim['comp']  shape = (npar,nelem,nlayer)
+        dprim['theta'] shape = (npar,)   (degrees)
+      missing entries are taken as zero.  If dprim is None
+      no derivatives are computed
+    * calc_fy is a flag to compute the FY (requires calc_params[6] >= 0)
+
+    Returns:
+    --------
+    * (R, Y, dR, dY), where dR and dY have shape (npar,ntheta).
+      Y and dY are None if the FY is not computed
+
+    Notes:
+    ------
+    * The Debye-Waller roughness term for interface i always uses
+      sigma[i] (the c-library skips it based on the value of sigma[i+1])
+    * the c-library zeros tiny values of X and Ai, this is not done here
+    """
+    theta  = num.asarray(theta, dtype=num.double)
+    d      = num.asarray(d, dtype=num.double)
+    rho    = num.asarray(rho, dtype=num.double)
+    sigma  = num.asarray(sigma, dtype=num.double)
+    comp   = num.asarray(comp, dtype=num.double)
+    nlayer = len(d)
+    nthet  = len(theta)
+    nelem  = len(elem_z)
+
+    ### derivative arrays
+    if dprim is None:
+        dprim = {}
+        npar  = 0
+    else:
+        npar  = 0
+        for key in dprim.keys():
+            npar = max(npar, len(dprim[key]))
+    def _get(key, shape):
+        tmp = dprim.get(key)
+        if tmp is None:
+            return num.zeros((npar,) + shape, dtype=num.double)
+        return num.asarray(tmp, dtype=num.double).reshape((npar,) + shape)
+    dd     = _get('d', (nlayer,))
+    drho   = _get('rho', (nlayer,))
+    dsigma = _get('sigma', (nlayer-1,))
+    dcomp  = _get('comp', (nelem,nlayer))
+    dtheta = _get('theta', ())
+
+    ### params
+    energy   = calc_params[0]
+    wconv    = calc_params[1]
+    slen     = calc_params[2]
+    bvert    = calc_params[3]
+    bhorz    = calc_params[4]
+    aflag    = calc_params[5]
+    fy_idx   = int(calc_params[6])
+    adet     = calc_params[8]
+    tnorm    = calc_params[9]
+    rflag    = calc_params[10]
+    delz     = calc_params[11]
+    pdepth   = num.fabs(calc_params[12])
+    rscale   = calc_params[13]
+    lam = 12398.0 / energy
+    k   = 2.*num.pi / lam
+    if (fy_idx < 0) or (fy_idx > nelem-1): calc_fy = False
+
+    ### layer properties, angle independent (see calc_del_bet_mu)
+    fpt   = num.dot(fp, comp)
+    fppt  = num.dot(fpp, comp)
+    amut  = num.dot(amu, comp)
+    zt    = num.dot(elem_z, comp)
+    mut   = num.dot(amu*mu_at, comp)
+    dfpt  = num.dot(fp, dcomp)
+    dfppt = num.dot(fpp, dcomp)
+    damut = num.dot(amu, dcomp)
+    dzt   = num.dot(elem_z, dcomp)
+    dmut  = num.dot(amu*mu_at, dcomp)
+    vac   = (amut <= 0.0)
+    if vac.any():
+        amut[vac] = 1.0e-20
+        damut[:,vac] = 0.0
+    con   = (415.181 * rho) / ((energy**2) * amut)
+    dcon  = (415.181 / energy**2) * (drho/amut - rho*damut/amut**2)
+    dl    = con * (zt + fpt)
+    ddl   = dcon * (zt + fpt) + con * (dzt + dfpt)
+    bt    = con * fppt
+    dbt   = dcon * fppt + con * dfppt
+    if calc_fy:
+        mu  = 1.0e-8 * rho * mut / amut
+        dmu = 1.0e-8 * ((drho*mut + rho*dmut)/amut - rho*mut*damut/amut**2)
+    else:
+        mu  = num.zeros(nlayer, dtype=num.double)
+        dmu = num.zeros((npar,nlayer), dtype=num.double)
+
+    ### angle terms
+    th    = _rad(theta)
+    dth   = _rad(dtheta)[:,num.newaxis]
+    sth   = num.sin(th)
+    cth   = num.cos(th)
+    c2    = cth**2
+    dc2   = -2.*cth*sth*dth
+    q     = 2.*k*sth
+    dq    = 2.*k*cth*dth
+
+    ### g for each layer, g = sqrt(n^2 - cos(theta)^2)
+    n     = 1.0 - dl - 1.0j*bt
+    dn    = -ddl - 1.0j*dbt
+    g     = num.sqrt((n**2)[:,num.newaxis] - c2[num.newaxis,:])
+    dg    = ((n[num.newaxis,:,num.newaxis] * dn[:,:,num.newaxis]
+             - 0.5*dc2[:,num.newaxis,:]) / g[num.newaxis,:,:])
+
+    ### roughness for each interface, dw = exp(-(q*sig)^2)
+    qs    = q[num.newaxis,:] * sigma[:,num.newaxis]
+    dqs   = (dq[:,num.newaxis,:] * sigma[num.newaxis,:,num.newaxis] +
+             q[num.newaxis,num.newaxis,:] * dsigma[:,:,num.newaxis])
+    dw    = num.exp(-1.0*qs**2)
+    ddw   = -2.0 * (dw*qs)[num.newaxis,:,:] * dqs
+
+    def _calc_r(j):
+        """ r for the j+1/j interface and derivative """
+        g1, g2   = g[j], g[j+1]
+        dg1, dg2 = dg[:,j], dg[:,j+1]
+        s   = g2 + g1
+        r0  = (g2 - g1) / s
+        dr0 = 2.*(g1*dg2 - g2*dg1) / s**2
+        r   = r0 * dw[j]
+        dr  = dr0 * dw[j] + r0 * ddw[:,j]
+        return (r0, dr0, r, dr)
+
+    ### X recursion, start at the bottom (see calc_X)
+    X  = num.zeros((nlayer,nthet), dtype=num.complex)
+    dX = num.zeros((npar,nlayer,nthet), dtype=num.complex)
+    for j in range(1,nlayer):
+        (r0, dr0, r, dr) = _calc_r(j-1)
+        if j == 1:
+            u  = num.zeros(nthet, dtype=num.complex)
+            du = num.zeros((npar,nthet), dtype=num.complex)
+        else:
+            ph  = num.exp(-2.0j*k*d[j-1]*g[j-1])
+            dph = ph * (-2.0j*k) * (dd[:,j-1,num.newaxis]*g[j-1] + d[j-1]*dg[:,j-1])
+            u   = X[j-1] * ph
+            du  = dX[:,j-1] * ph + X[j-1] * dph
+        den     = 1.0 + r*u
+        X[j]    = (r + u) / den
+        dX[:,j] = (dr*(1.0 - u**2) + du*(1.0 - r**2)) / den**2
+
+    ### reflectivity
+    Xt = X[nlayer-1]
+    R  = num.abs(Xt)**2
+    dR = 2.0 * num.real(num.conj(Xt)[num.newaxis,:] * dX[:,nlayer-1])
+
+    ### spill off and area corrections
+    spill  = num.ones(nthet, dtype=num.double)
+    dspill = num.zeros((npar,nthet), dtype=num.double)
+    area   = num.ones(nthet, dtype=num.double)
+    darea  = num.zeros((npar,nthet), dtype=num.double)
+    if (aflag > 0.0) and (slen > 0.0):
+        spill  = (slen/bvert) * sth
+        dspill = (slen/bvert) * cth * dth * num.ones(nthet)
+        clip   = (spill > 1.0)
+        spill[clip]    = 1.0
+        dspill[:,clip] = 0.0
+        #
+        small = (sth < 1.0e-10)
+        ssth  = num.where(small, 1.0, sth)
+        a     = bvert / ssth
+        da    = -1.0 * bvert * cth / ssth**2 * dth * num.ones(nthet)
+        clip  = small | (a > slen)
+        a[clip]    = slen
+        da[:,clip] = 0.0
+        area  = 0.01 * a * bhorz
+        darea = 0.01 * da * bhorz
+        #
+        dR = dR * spill + R * dspill
+        R  = R * spill
+    if rscale > 0.0:
+        R  = R * rscale
+        dR = dR * rscale
+
+    ### convolution, this is linear in R so just
+    ### apply the same matrix to the derivatives
+    W = _conv_matrix(theta, wconv)
+    if W is not None:
+        R  = num.dot(W, R)
+        dR = num.dot(dR, W.T)
+
+    if calc_fy == False:
+        return (R, None, dR, None)
+
+    ### A recursion, start at the top (see calc_A)
+    Ai  = num.zeros((nlayer,nthet), dtype=num.complex)
+    Ar  = num.zeros((nlayer,nthet), dtype=num.complex)
+    dAi = num.zeros((npar,nlayer,nthet), dtype=num.complex)
+    dAr = num.zeros((npar,nlayer,nthet), dtype=num.complex)
+    Ai[nlayer-1]    = 1.0
+    Ar[nlayer-1]    = X[nlayer-1]
+    dAr[:,nlayer-1] = dX[:,nlayer-1]
+    for j in range(nlayer-2,-1,-1):
+        if j == 0:
+            ph   = num.ones(nthet, dtype=num.complex)
+            dph  = num.zeros((npar,nthet), dtype=num.complex)
+        else:
+            ph   = num.exp(-1.0j*k*d[j]*g[j])
+            dph  = ph * (-1.0j*k) * (dd[:,j,num.newaxis]*g[j] + d[j]*dg[:,j])
+        ph2  = ph**2
+        dph2 = 2.0 * ph * dph
+        (r0, dr0, r, dr) = _calc_r(j)
+        if rflag == 0.0:
+            s  = g[j+1] + g[j]
+            t  = 2.0 * g[j+1] / s
+            dt = dr0
+        else:
+            t  = 1.0 + r
+            dt = dr
+        a_num  = t * Ai[j+1] * ph
+        da_num = dt*Ai[j+1]*ph + t*dAi[:,j+1]*ph + t*Ai[j+1]*dph
+        a_den  = 1.0 + ph2 * X[j] * r
+        da_den = dph2*X[j]*r + ph2*dX[:,j]*r + ph2*X[j]*dr
+        Ai[j]    = a_num / a_den
+        dAi[:,j] = (da_num*a_den - a_num*da_den) / a_den**2
+        Ar[j]    = Ai[j] * X[j]
+        dAr[:,j] = dAi[:,j]*X[j] + Ai[j]*dX[:,j]
+
+    ### element concentrations (see calc_FY)
+    x   = comp[fy_idx]
+    dx  = dcomp[:,fy_idx]
+    N   = x * rho / amut
+    dN  = (dx*rho + x*drho)/amut - x*rho*damut/amut**2
+
+    ### attenuation of fy from the top of each layer
+    ### S[j] = sum_{m=j+1}^{nlayer-2} mu[m]*d[m]
+    ad    = num.fabs(d)
+    dad   = num.sign(d) * dd
+    md    = mu * ad
+    dmd   = dmu * ad + mu * dad
+    S     = num.zeros(nlayer, dtype=num.double)
+    dS    = num.zeros((npar,nlayer), dtype=num.double)
+    for j in range(nlayer-2):
+        S[j]    = md[j+1:nlayer-1].sum()
+        dS[:,j] = dmd[:,j+1:nlayer-1].sum(axis=1)
+    sin_det = num.sin(_rad(adet))
+
+    ### integrate
+    Y   = num.zeros(nthet, dtype=num.double)
+    dY  = num.zeros((npar,nthet), dtype=num.double)
+    one = num.ones(nthet, dtype=num.double)
+    for j in range(nlayer):
+        if N[j] <= 0.0: continue
+        # integration depth, for the base layer this
+        # may be a multiple of the penetration depth
+        if (j == 0) and (pdepth > 0.0):
+            gpp = num.imag(g[0])
+            dj  = pdepth * num.fabs(1.0/(2.*k*gpp))
+            ddj = -1.0 * pdepth * num.sign(gpp) * num.imag(dg[:,0]) / (2.*k*gpp**2)
+        else:
+            dj  = ad[j] * one
+            ddj = dad[:,j,num.newaxis] * one
+        # slices, the last slice is extended to dj
+        delta  = num.where(delz >= dj, dj, delz)
+        ddelta = num.where(delz >= dj, ddj, 0.0)
+        nslice = int(num.ceil((dj/delta).max())) + 1
+        for s in range(nslice):
+            exists = ((s + 0.5)*delta < dj)
+            if not exists.any(): break
+            last = ((s + 1.5)*delta > dj)
+            lb   = s * delta
+            dlb  = s * ddelta
+            ub   = num.where(last, dj, (s+1)*delta)
+            dub  = num.where(last, ddj, (s+1)*ddelta)
+            wz   = (ub - lb) * exists
+            dwz  = (dub - dlb) * exists
+            z    = 0.5*(ub + lb)
+            dz   = 0.5*(dub + dlb)
+            # field intensity
+            if j == 0:
+                ei  = num.exp(-1.0j*k*z*g[j])
+                E   = Ai[j]*ei
+                dE  = dAi[:,j]*ei + Ai[j]*ei*(-1.0j*k)*(dz*g[j] + z*dg[:,j])
+            else:
+                ei  = num.exp(1.0j*k*z*g[j])
+                er  = num.exp(-1.0j*k*z*g[j])
+                E   = Ai[j]*ei + Ar[j]*er
+                dE  = (dAi[:,j]*ei + Ai[j]*ei*(1.0j*k)*(dz*g[j] + z*dg[:,j]) +
+                       dAr[:,j]*er + Ar[j]*er*(-1.0j*k)*(dz*g[j] + z*dg[:,j]))
+            I  = num.abs(E)**2
+            dI = 2.0 * num.real(num.conj(E)[num.newaxis,:] * dE)
+            # attenuation
+            if j == 0:
+                att  = (mu[0]*z + S[0]) / sin_det
+                datt = (dmu[:,0,num.newaxis]*z + mu[0]*dz + dS[:,0,num.newaxis]) / sin_det
+            else:
+                att  = (mu[j]*(dj - z) + S[j]) / sin_det
+                datt = (dmu[:,j,num.newaxis]*(dj - z) + mu[j]*(ddj - dz) +
+                        dS[:,j,num.newaxis]) / sin_det
+            att  = num.exp(-1.0*att)
+            datt = -1.0 * att * datt
+            Y  = Y + I*N[j]*wz*att
+            dY = dY + (dI*N[j]*wz*att + I*dN[:,j,num.newaxis]*wz*att +
+                       I*N[j]*dwz*att + I*N[j]*wz*datt)
+
+    ### area corrections
+    if (aflag > 0.0) and (slen > 0.0):
+        f  = area * spill
+        df = darea * spill + area * dspill
+        dY = dY * f + Y * df
+        Y  = Y * f
+
+    ### convolve and normalize
+    if W is not None:
+        Y  = num.dot(W, Y)
+        dY = num.dot(dY, W.T)
+    idx = _norm_idx(theta, tnorm)
+    if Y[idx] != 0.0:
+        yn = Y[idx]
+        dY = dY/yn - Y[num.newaxis,:]*dY[:,idx,num.newaxis]/yn**2
+        Y  = Y/yn
+
+    return (R, Y, dR, dY)
+
+#######################################################################
+class ModelFit:
+    """
+    Fit an interface model (interface_model.Model) to
+    reflectivity and/or FY data
+
+    Notes:
+    ------
+    * The model should be slabified before creating the fit, and
+      model.theta should correspond to the data
+    * The model parameters (calc_params) energy, fyel etc. should
+      be set on the model.  These are fixed during the fit
+    * Thickness parameters scale the slabs that belong to a layer (ie
+      the number of slabs is fixed).  Density parameters scale the
+      slab densities of a layer computed from the component
+      distributions, the parameter value is the mean density of the
+      layer slabs.  Roughness parameters set the
+      roughness of the interface at the top of a layer.  Distribution
+      parameters are passed to the slab model and the distributions
+      are recomputed (Slab.calc_dist).
+    * The reflectivity and FY residuals are weighted by wR and wFY.
+      If logR is True the residuals of log10(R) are used (R <= 0
+      is clipped to 1e-30 and has zero derivatives)
+    """
+    def __init__(self,model,R=None,FY=None,Rerr=None,FYerr=None,
+                 wR=1.0,wFY=1.0,logR=False):
+        """
+        Parameters:
+        -----------
+        * model is an interface_model.Model instance
+        * R and FY are the data arrays (same length as model.theta)
+        * Rerr and FYerr are the data errors (default is 1)
+        * wR and wFY are weights for the R and FY residuals
+        * logR is a flag to fit log10(R)
+        """
+        self.model  = model
+        self.R      = None
+        self.FY     = None
+        self.Rerr   = None
+        self.FYerr  = None
+        self.wR     = float(wR)
+        self.wFY    = float(wFY)
+        self.logR   = logR
+        self.set_data(R=R,FY=FY,Rerr=Rerr,FYerr=FYerr)
+        #
+        self.pid    = []     # parameter identifiers
+        self.pinfo  = []     # parinfo list for mpfit
+        self.p0     = []     # initial values
+        self.result = None   # mpfit result
+        self.covar  = None   # parameter covariance matrix
+        self.perror = None   # parameter errors
+        self.chisqr = 0.0
+        self.redchi = 0.0
+        self.hstep  = 1.0e-5 # relative step for the profile derivatives
+        self._state = None   # reference slab model
+        self.reset()
+
+    ########################################################################
+    def __repr__(self):
+        """ display """
+        lout = "==== Interface Model Fit ====\n"
+        if self.result is not None:
+            lout = "%s status = %i, niter = %i, nfev = %i, chisqr = %g, redchi = %g\n" % \
+                   (lout, self.result.status, self.result.niter, self.result.nfev,
+                    self.chisqr, self.redchi)
+        p = self.get_params()
+        for j in range(len(self.pid)):
+            if self.perror is not None:
+                err = self.perror[j]
+            else:
+                err = 0.0
+            lout = "%s %-30s = %12.6g +/- %10.4g %s\n" % (lout,
+                                                        self.pinfo[j]['parname'],
+                                                        p[j], err,
+                                                        (self.pinfo[j]['fixed'] and '(fixed)') or '')
+        return lout
+
+    ########################################################################
+    def set_data(self,R=None,FY=None,Rerr=None,FYerr=None):
+        """
+        Set the data arrays
+        """
+        ntheta = len(self.model.theta)
+        def _arr(x):
+            x = num.array(x, dtype=num.double)
+            if len(x) != ntheta:
+                raise ValueError, "Data length must equal len(model.theta)"
+            return x
+        if R is not None:
+            self.R    = _arr(R)
+            self.Rerr = num.ones(ntheta, dtype=num.double)
+        if Rerr is not None:
+            self.Rerr = _arr(Rerr)
+        if FY is not None:
+            self.FY    = _arr(FY)
+            self.FYerr = num.ones(ntheta, dtype=num.double)
+        if FYerr is not None:
+            self.FYerr = _arr(FYerr)
+
+    ########################################################################
+    def add_param(self,pid,value=None,limits=None,fixed=False,name=None):
+        """
+        Add a fit parameter
+
+        Parameters:
+        -----------
+        * pid is the parameter identifier (see module doc)
+        * value is the initial value (default is the current model value)
+        * limits is a tuple of (min,max), use None for no limit
+        * fixed is a flag to hold the parameter fixed
+        * name is the parameter name (for display)
+        """
+        if type(pid) == types.StringType:
+            pid = (pid,)
+        else:
+            pid = tuple(pid)
+        if pid[0] not in ('thickness','density','roughness','dist',
+                          'scale','fyscale','theta_off'):
+            raise ValueError, "Unknown parameter %s" % str(pid)
+        if pid in self.pid:
+            raise ValueError, "Parameter %s already defined" % str(pid)
+        if pid[0] == 'roughness':
+            if pid[1] >= len(self.model.layer) - 1:
+                raise ValueError, "The top layer has no roughness"
+        if pid[0] == 'dist':
+            cidx = self.model.slab._comp_idx(pid[1])
+            if cidx == -1:
+                raise ValueError, "Component %s not found" % str(pid[1])
+            pid = ('dist', cidx, int(pid[2]), pid[3])
+            inter = self.model.slab.distpar[cidx].inter
+            if (pid[2] >= len(inter)) or (not inter[pid[2]].has_key(pid[3])):
+                raise ValueError, "Distribution parameter %s not found" % str(pid)
+        p0 = self._model_value(pid)
+        if value is None: value = p0
+        if name is None: name = ':'.join([str(x) for x in pid])
+        pinfo = {'parname':name,'value':float(value),'fixed':int(fixed),
+                 'limited':[0,0],'limits':[0.,0.]}
+        if limits is not None:
+            for j in (0,1):
+                if limits[j] is not None:
+                    pinfo['limited'][j] = 1
+                    pinfo['limits'][j]  = float(limits[j])
+        self.pid.append(pid)
+        self.p0.append(p0)
+        self.pinfo.append(pinfo)
+
+    ########################################################################
+    def _model_value(self,pid):
+        """
+        Get the value of a parameter in the reference model
+        """
+        model = self.model
+        state = self._state
+        if pid[0] == 'thickness':
+            return float(state['thickness'][pid[1]])
+        elif pid[0] == 'density':
+            return float(state['density'][pid[1]])
+        elif pid[0] == 'roughness':
+            idx = model.slab.layer_range[pid[1]]['idxmax']
+            return float(state['sig'][idx])
+        elif pid[0] == 'dist':
+            return float(state['dist'][pid[1]][1][pid[2]][pid[3]])
+        elif pid[0] == 'scale':
+            return float(model.get_params()['rscale'])
+        elif pid[0] == 'fyscale':
+            return 1.0
+        elif pid[0] == 'theta_off':
+            return 0.0
+
+    ########################################################################
+    def get_params(self):
+        """
+        Return the current parameter values
+        """
+        return num.array([p['value'] for p in self.pinfo], dtype=num.double)
+
+    ########################################################################
+    def reset(self):
+        """
+        Save the current slab model as the reference model.
+        Parameters are applied relative to the reference model, so
+        call this (and redefine the parameters) after changing the
+        model outside of the fit (e.g. adding distributions)
+        """
+        model = self.model
+        if model.slab is None:
+            raise ValueError, "Please slabify the model"
+        slab = model.slab
+        slab.calc_dist()
+        dist = []
+        for dpar in slab.distpar:
+            dist.append((copy.deepcopy(dpar.subs), copy.deepcopy(dpar.inter),
+                         copy.deepcopy(dpar.top)))
+        # reference layer thickness and (mean) density
+        thick = []
+        dens  = []
+        for j in range(len(model.layer)):
+            idx = num.where(slab.zidx == j)
+            thick.append(slab.d[idx].sum())
+            dens.append(slab.rho[idx].mean())
+        self._state = {'d':slab.d.copy(),'sig':slab.sig.copy(),'dist':dist,
+                       'thickness':thick,'density':dens}
+        self.pid    = []
+        self.pinfo  = []
+        self.p0     = []
+
+    ########################################################################
+    def _init_ref(self):
+        """
+        Get the energy dependent constants (fp, fpp etc)
+        """
+        model = self.model
+        if model._initR: model._init_ref()
+        ref = model.ref
+        if ref._init_en: ref.init_energy()
+        if ref._init_fy: ref.init_fy()
+
+    ########################################################################
+    def _set_profile(self,p):
+        """
+        Apply the profile parameters to the slab model and return
+        copies of the slab arrays (d, rho, sigma, comp)
+        """
+        slab  = self.model.slab
+        state = self._state
+        # restore reference distributions
+        for (dpar,(subs,inter,top)) in zip(slab.distpar, state['dist']):
+            dpar.subs.clear();  dpar.subs.update(subs)
+            dpar.top.clear();   dpar.top.update(top)
+            for (dist,dist0) in zip(dpar.inter,inter):
+                dist.clear()
+                dist.update(dist0)
+        # thickness
+        d = state['d'].copy()
+        for (pid,p0,pj) in zip(self.pid,self.p0,p):
+            if pid[0] == 'thickness':
+                idx = num.where(slab.zidx == pid[1])
+                if p0 != 0.0:
+                    d[idx] = state['d'][idx] * pj/p0
+        slab.d[:] = d
+        if len(d) > 1:
+            slab.z[0]  = -1.0*d[0]
+            slab.z[1:] = num.concatenate(([0.0], num.cumsum(d[1:-1])))
+        slab._get_zrange()
+        # distribution params
+        for (pid,pj) in zip(self.pid,p):
+            if pid[0] == 'dist':
+                slab.distpar[pid[1]].inter[pid[2]][pid[3]] = pj
+        slab.calc_dist()
+        # density
+        for (pid,p0,pj) in zip(self.pid,self.p0,p):
+            if pid[0] == 'density':
+                idx = num.where(slab.zidx == pid[1])
+                if p0 != 0.0:
+                    slab.rho[idx] = slab.rho[idx] * pj/p0
+        # roughness
+        sig = state['sig'].copy()
+        for (pid,pj) in zip(self.pid,p):
+            if pid[0] == 'roughness':
+                sig[slab.layer_range[pid[1]]['idxmax']] = pj
+        slab.sig[:] = sig
+        return (slab.d.copy(), slab.rho.copy(), slab.sig.copy(), slab.fZ.copy())
+
+    ########################################################################
+    def calc(self,p=None,jac=False):
+        """
+        Compute the model R and FY for the parameters p
+
+        Returns:
+        --------
+        * (R, FY, dR, dFY), the derivatives have shape (npar,ntheta) and
+          are None if jac is False.  FY and dFY are None if there is
+          no FY data
+        """
+        self._init_ref()
+        if p is None: p = self.get_params()
+        p      = num.asarray(p, dtype=num.double)
+        model  = self.model
+        ref    = model.ref
+        npar   = len(p)
+        nlayer = len(model.slab.d)
+        nelem  = len(model.slab.elem_z)
+        calc_fy = (self.FY is not None)
+
+        # parameter indicies
+        jscale = jfy = jth = None
+        prof   = []
+        for j in range(npar):
+            ty = self.pid[j][0]
+            if ty == 'scale':       jscale = j
+            elif ty == 'fyscale':   jfy    = j
+            elif ty == 'theta_off': jth    = j
+            else: prof.append(j)
+
+        # profile derivatives by central differences
+        dprim = None
+        if jac:
+            dprim = {'d':num.zeros((npar,nlayer)),
+                     'rho':num.zeros((npar,nlayer)),
+                     'sigma':num.zeros((npar,nlayer-1)),
+                     'comp':num.zeros((npar,nelem,nlayer)),
+                     'theta':num.zeros(npar)}
+            for j in prof:
+                h = self.hstep * max(num.fabs(p[j]), 1.0)
+                pp = p.copy(); pp[j] = p[j] + h
+                (d1,rho1,sig1,comp1) = self._set_profile(pp)
+                pp[j] = p[j] - h
+                (d2,rho2,sig2,comp2) = self._set_profile(pp)
+                dprim['d'][j]     = (d1 - d2)/(2.*h)
+                dprim['rho'][j]   = (rho1 - rho2)/(2.*h)
+                dprim['sigma'][j] = (sig1 - sig2)/(2.*h)
+                dprim['comp'][j]  = (comp1 - comp2)/(2.*h)
+            if jth is not None: dprim['theta'][jth] = 1.0
+        (d,rho,sig,comp) = self._set_profile(p)
+
+        # calc
+        calc_params = ref.calc_params.copy()
+        calc_params[13] = 1.0
+        theta = model.theta
+        if jth is not None: theta = theta + p[jth]
+        (R,Y,dR,dY) = calc_ref(theta, d, rho, sig, comp,
+                               ref.elem_z, ref.fp, ref.fpp, ref.amu, ref.mu_at,
+                               calc_params, dprim=dprim, calc_fy=calc_fy)
+        if jscale is not None:
+            scale = p[jscale]
+        else:
+            scale = ref.calc_params[13]
+            if scale <= 0.0: scale = 1.0
+        if jac:
+            dR = dR * scale
+            if jscale is not None: dR[jscale] = R
+        R = R * scale
+        if Y is not None and jfy is not None:
+            if jac:
+                dY = dY * p[jfy]
+                dY[jfy] = Y
+            Y = Y * p[jfy]
+        return (R,Y,dR,dY)
+
+    ########################################################################
+    def _residuals(self,p,fjac=None):
+        """
+        Weighted residuals and derivatives for mpfit
+        """
+        jac = (fjac is not None)
+        (R,Y,dR,dY) = self.calc(p,jac=jac)
+        dev  = []
+        pder = []
+        if self.R is not None:
+            w = self.wR / self.Rerr
+            if self.logR:
+                # R <= 0 is clipped, the residual is constant there
+                Rc = num.where(R > 0.0, R, 1.0e-30)
+                dev.append(w*(num.log10(self.R) - num.log10(Rc)))
+                if jac:
+                    wl = num.where(R > 0.0, w / (Rc*num.log(10.)), 0.0)
+                    pder.append((dR * wl).T)
+            else:
+                dev.append(w*(self.R - R))
+                if jac: pder.append((dR * w).T)
+        if (self.FY is not None) and (Y is not None):
+            w = self.wFY / self.FYerr
+            dev.append(w*(self.FY - Y))
+            if jac: pder.append((dY * w).T)
+        dev = num.concatenate(dev)
+        if jac:
+            return [0, dev, num.concatenate(pder, axis=0)]
+        return [0, dev]
+
+    ########################################################################
+    def fit(self,quiet=1,**kws):
+        """
+        Run the fit.  Additional keywords are passed to mpfit
+        (e.g. maxiter, xtol, ftol)
+
+        After the fit the model is left in the final state, and the
+        fit results are in self.result, self.covar and self.perror
+        """
+        if len(self.pid) == 0:
+            print "No fit parameters"
+            return
+        parinfo = copy.deepcopy(self.pinfo)
+        p0 = self.get_params()
+        self.result = mpfit.mpfit(self._residuals, p0, parinfo=parinfo,
+                                  autoderivative=0, quiet=quiet, **kws)
+        if self.result.status <= 0:
+            print "Fit error: ", self.result.errmsg
+            return
+        p = self.result.params
+        for j in range(len(p)):
+            self.pinfo[j]['value'] = p[j]
+        self._update_model(p)
+
+        # covariance/errors, scaled by the reduced chi^2
+        (status, dev) = self._residuals(p)
+        self.chisqr = num.sum(dev**2)
+        nfree  = len(p) - sum([x['fixed'] for x in self.pinfo])
+        dof    = max(len(dev) - nfree, 1)
+        self.redchi = self.chisqr / dof
+        if self.result.covar is not None:
+            self.covar  = self.result.covar * self.redchi
+            self.perror = num.sqrt(num.fabs(num.diag(self.covar)))
+        return self.result
+
+    ########################################################################
+    def _update_model(self,p):
+        """
+        Set the model to the parameter values p
+        """
+        self._set_profile(p)
+        model = self.model
+        for (pid,pj) in zip(self.pid,p):
+            if pid[0] == 'thickness':
+                model.layer[pid[1]].thickness = pj
+            elif pid[0] == 'density':
+                model.layer[pid[1]].density = pj
+            elif pid[0] == 'roughness':
+                model.layer[pid[1]].roughness = pj
+            elif pid[0] == 'scale':
+                model.set_param(rscale=pj)
+
+    ########################################################################
+    def correlation(self):
+        """
+        Return the parameter correlation matrix
+        """
+        if self.covar is None: return None
+        s = num.sqrt(num.fabs(num.diag(self.covar)))
+        s[s == 0.0] = 1.0
+        return self.covar / num.outer(s,s)
+
+#######################################################################
+
+#######################################################################
+def test_jac():
+    """
+    Check the analytic derivatives of ModelFit against
+    central differences of the residuals (R, FY and logR)
+    """
+    from tdl.modules.utils import compound
+    from tdl.modules.xrr import interface_model
+    qtz   = compound.Component(formula={'Si':1,'O':2})
+    fe2o3 = compound.Component(formula={'Fe':2,'O':3})
+    N2    = compound.Component(formula={'N':2})
+    subs  = interface_model.Layer(comp=[(qtz,1.),(fe2o3,0.000001)],density=2.65,
+                                  thickness=1000.,roughness=8.)
+    m1    = interface_model.Layer(comp=[(qtz,1.),(fe2o3,0.01)],density=2.45,
+                                  thickness=40.,roughness=5.)
+    top   = interface_model.Layer(comp=[(N2,1.)],density=0.001,
+                                  thickness=1000.,roughness=0.)
+    calc_params = {'energy':10000.,'wconv':0.01,'slen':20.,'bvert':0.01,
+                   'aflag':1.,'fyenergy':7000.,'delz':5.,'pdepth':2.0}
+    theta = num.arange(0.02, 1.0, 0.02)
+    model = interface_model.Model(substrate=subs,layers=[m1],top=top,
+                                  theta=theta,params=calc_params)
+    model.slabify(delta=5.)
+    model.set_param(fyel='Fe')
+    model.slab.add_dpar('Fe2_O3',dist={'type':'gauss','cen':20.,'sig':8.,'CX':10.})
+    ones = num.ones(len(theta))
+    for logR in (False,True):
+        fit = ModelFit(model,R=ones,FY=ones,wFY=0.5,logR=logR)
+        fit.add_param(('thickness',1))
+        fit.add_param(('density',1))
+        fit.add_param(('roughness',0))
+        fit.add_param(('dist','Fe2_O3',1,'cen'))
+        fit.add_param('scale',value=1.0)
+        fit.add_param('fyscale')
+        fit.add_param('theta_off')
+        (R,Y,dR,dY) = fit.calc()
+        fit.set_data(R=R*1.1,FY=Y*0.9)
+        p = fit.get_params() + num.array([1.,0.05,1.,2.,0.,0.,0.001])
+        (status,dev,pder) = fit._residuals(p,fjac=1)
+        for j in range(len(p)):
+            h  = 1.0e-3 * max(num.fabs(p[j]), 0.01)
+            pp = p.copy(); pp[j] = p[j] + h
+            dev1 = fit._residuals(pp)[1]
+            pp[j] = p[j] - h
+            dev2 = fit._residuals(pp)[1]
+            # mpfit derivatives are -d(dev)/dp
+            num_der = -(dev1 - dev2)/(2.*h)
+            err = num.fabs(num_der - pder[:,j]).max()/max(num.fabs(num_der).max(),1.e-30)
+            assert err < 1.e-3, "%s (logR=%s) derivative error %g" % \
+                   (fit.pinfo[j]['parname'],logR,err)
+    # clipped R (scale = 0) has zero logR derivatives
+    p[4] = 0.0
+    (status,dev,pder) = fit._residuals(p,fjac=1)
+    assert num.all(pder[:len(theta)] == 0.0), "clipped logR derivatives not zero"
+    print "ModelFit derivatives ok"
+
+#######################################################################
+if __name__ == "__main__":
+    """ test """
+    test_jac()
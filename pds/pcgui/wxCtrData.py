@@ -529,10 +529,7 @@ class wxCtrData(model.Background, wxUtil):
         ctr = self.get_ctr()
         if ctr == None: return
         point  = int(self.components.PointNum.stringSelection)
-        if point in ctr.bad:
-            ctr.bad.remove(point)
-        else:
-            ctr.bad.append(point)
+        ctr.set_bad(point,bad=(point not in ctr.bad))
         self.update_point()
     
     def update_point(self,update_gui=True):
@@ -741,7 +738,8 @@ class wxCtrData(model.Background, wxUtil):
         for j in range(npts):
             print "Setting params for point:", j
             self.update_ctr_from_params(point=j)
-            self.integrate_point(point=j,update_plots=False)
+        # only re-integrate / re-correct points whose params changed
+        ctr.update(idx=range(npts),verbose=True)
         if self.components.AutoPlotCtr.checked==True:
             self._plot_ctr()
         elif self.components.AutoPlotCtrHK.checked==True:
@@ -755,7 +753,8 @@ class wxCtrData(model.Background, wxUtil):
         for j in self.set:
             print "Setting params for point:", j
             self.update_ctr_from_params(point=j)
-            self.integrate_point(point=j,update_plots=False)
+        # only re-integrate / re-correct points whose params changed
+        ctr.update(idx=self.set,verbose=True)
         if self.components.AutoPlotCtr.checked==True:
             self._plot_ctr()
         elif self.components.AutoPlotCtrHK.checked==True:
@@ -771,7 +770,7 @@ class wxCtrData(model.Background, wxUtil):
         for j in range(npts):
             print "Setting param for point:" , j
             ctr_data.set_params(ctr,j,intpar=intpar,corrpar=corrpar)
-            self.integrate_point(point=j,update_plots=False)
+        ctr.update(idx=range(npts),verbose=True)
         if self.components.AutoPlotCtr.checked==True:
             self._plot_ctr()
         elif self.components.AutoPlotCtrHK.checked==True:
@@ -788,7 +787,7 @@ class wxCtrData(model.Background, wxUtil):
         for j in self.set:
             print "Setting param for point:", j
             ctr_data.set_params(ctr,j,intpar=intpar,corrpar=corrpar)
-            self.integrate_point(point=j,update_plots=False)
+        ctr.update(idx=self.set,verbose=True)
         if self.components.AutoPlotCtr.checked==True:
             self._plot_ctr()
         elif self.components.AutoPlotCtrHK.checked==True: